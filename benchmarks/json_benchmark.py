@@ -0,0 +1,86 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Micro-benchmark of the JSON API encoding, comparing the to_json based encoder with
+the isinstance based encoder it replaced. Run from the repository root:
+
+    python benchmarks/json_benchmark.py
+"""
+
+import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from quarterapp.domain import Activity, Category, Color, Quarter, TimeSheet, Comment
+from quarterapp.json_utils import json_encode, JSON_BACKEND
+
+class LegacyEncoder(json.JSONEncoder):
+    """
+    The encoder previously used by JsonApiHandler
+    """
+    def default(self, obj):
+        if isinstance(obj, Category):
+            if hasattr(obj, "activities"):
+                return { "id" : obj.id, "title" : obj.title, "activities" : obj.activities}
+            else:
+                return { "id" : obj.id, "title" : obj.title }
+        if isinstance(obj, Activity):
+            return { "id" : obj.id, "category" : obj.category_id, "title" : obj.title,
+                     "color" : obj.color.hex(), "enabled" : obj.enabled() }
+        if isinstance(obj, TimeSheet):
+            return { "date" : obj.date_as_string(), "quarters" : obj.quarters  }
+        if isinstance(obj, Quarter):
+            return { "id" : obj.id, "offset" : obj.offset, "activity" : obj.activity_id }
+        if isinstance(obj, Comment):
+            return { "id" : obj.id, "comment" : obj.comment }
+
+def legacy_encode(structure):
+    return LegacyEncoder().encode(structure).replace("'", "\"")
+
+def full_sheet():
+    return TimeSheet(datetime.date(2013, 2, 4), [i % 12 for i in range(96)], id = 42)
+
+def catalog(activity_count = 200, category_count = 10):
+    categories = []
+    for c in range(category_count):
+        category = Category(title = "Category %d" % c, id = c)
+        category.activities = []
+        categories.append(category)
+    for a in range(activity_count):
+        category = categories[a % category_count]
+        category.activities.append(Activity(id = a, title = "Activity %d" % a,
+            color = Color("#fcaf3e"), category_id = category.id))
+    return { "categories" : categories }
+
+def run(name, structure, number):
+    print "%s" % name
+    for label, encode in (("legacy", legacy_encode), ("to_json", json_encode)):
+        seconds = min(timeit.repeat(lambda: encode(structure), repeat = 5, number = number))
+        print "  %-8s %8.1f us/op  %6d bytes" % (label, seconds / number * 1e6, len(encode(structure)))
+
+def main():
+    print "Encoder backend: %s" % JSON_BACKEND
+    run("96 quarter sheet", full_sheet(), 2000)
+    run("200 activity catalog", catalog(), 500)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmark of requests per second with an increasing number of worker processes, on a
+mix of sheet reads and writes. Each run starts quarterapp on a fresh database and
+lets a number of client processes hammer it for a while. Run from the repository root:
+
+    python benchmarks/serve_benchmark.py [workers ...]
+
+Options are given as environment variables, CLIENTS (default 16), SECONDS (default 10)
+and WRITES, the share of requests that are writes (default 0.25).
+"""
+
+import cookielib
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+import urllib2
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PORT = 9123
+CLIENTS = int(os.environ.get("CLIENTS", 16))
+SECONDS = float(os.environ.get("SECONDS", 10))
+WRITES = float(os.environ.get("WRITES", 0.25))
+
+# The user created by the initial migration
+USERNAME = "one@example.com"
+PASSWORD = "123qweASD"
+
+CONFIGURATION = """
+base_url = "localhost:%(port)d"
+port = %(port)d
+processes = %(workers)d
+debug = False
+cookie_secret = "benchmark"
+mail_host = "localhost"
+mail_port = 25
+mail_sender = "no-reply@example.com"
+mail_user = ""
+mail_password = ""
+"""
+
+def url(path):
+    return "http://localhost:%d%s" % (PORT, path)
+
+def start_server(workers):
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "quarterapp.conf"), "w") as conf:
+        conf.write(CONFIGURATION % { "port" : PORT, "workers" : workers })
+    env = dict(os.environ, PYTHONPATH = ROOT)
+    server = subprocess.Popen([sys.executable, "-c", "import quarterapp.quarterapp as q; q.main()",
+        "--logging=warning"], cwd = directory, env = env, preexec_fn = os.setsid)
+    for i in range(100):
+        try:
+            socket.create_connection(("localhost", PORT)).close()
+            return server, directory
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception("Server did not start")
+
+def stop_server(server, directory):
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait()
+    shutil.rmtree(directory)
+
+def login():
+    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+    opener.open(url("/login"), urllib.urlencode({ "username" : USERNAME, "password" : PASSWORD }))
+    return opener
+
+def setup_activity():
+    opener = login()
+    opener.open(url("/api/category"), urllib.urlencode({ "title" : "Work" }))
+    response = opener.open(url("/api/activity"), urllib.urlencode({ "category" : 1, "title" : "Dev",
+        "color" : "#fcaf3e", "enabled" : "true" }))
+    return json.loads(response.read())["id"]
+
+def client(activity_id):
+    opener = login()
+    dates = [str(datetime.date(2013, 1, 1) + datetime.timedelta(days = i)) for i in range(60)]
+    requests = 0
+    errors = 0
+    end = time.time() + SECONDS
+    while time.time() < end:
+        date = random.choice(dates)
+        try:
+            if random.random() < WRITES:
+                request = urllib2.Request(url("/api/sheet/" + date), urllib.urlencode({
+                    "indexes" : ",".join(str(i) for i in random.sample(range(96), 4)),
+                    "activity" : activity_id }))
+                request.get_method = lambda: "PUT"
+                opener.open(request).read()
+            else:
+                opener.open(url("/api/sheet/" + date)).read()
+            requests += 1
+        except urllib2.URLError:
+            errors += 1
+    return requests, errors
+
+def run(workers):
+    server, directory = start_server(workers)
+    try:
+        activity_id = setup_activity()
+        pool = multiprocessing.Pool(CLIENTS)
+        results = pool.map(client, [activity_id] * CLIENTS)
+        pool.close()
+    finally:
+        stop_server(server, directory)
+    requests = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    return requests / SECONDS, errors
+
+def main():
+    workers_list = [int(workers) for workers in sys.argv[1:]] or [1, 2, 4]
+    print "%d clients, %d%% writes, %.0f seconds per run, %d CPUs" % (CLIENTS, WRITES * 100, SECONDS,
+        multiprocessing.cpu_count())
+    for workers in workers_list:
+        rate, errors = run(workers)
+        print "  %2d workers %8.1f req/s  %d errors" % (workers, rate, errors)
+
+if __name__ == "__main__":
+    main()
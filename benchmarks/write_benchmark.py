@@ -0,0 +1,102 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of concurrent writes to a database file, comparing the group commit writer
+with each storage worker thread committing its own writes. Writes are made the way
+the server makes them, from coroutines on the IOLoop through AsyncStorage. Run from
+the repository root:
+
+    python benchmarks/write_benchmark.py [clients] [writes per client] [windows]
+
+The group commit writer is measured with each of the comma separated windows, in
+seconds, by default only with GROUP_COMMIT_WINDOW.
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from quarterapp.domain import Activity, Category, Color, Quarter, User
+from quarterapp.storage.default import DefaultStorage, GROUP_COMMIT_WINDOW
+from quarterapp.storage.executor import AsyncStorage, DEFAULT_WORKERS
+
+@gen.coroutine
+def write_sheets(async_storage, user, activity, first_day, writes):
+    for i in range(writes):
+        day = first_day + datetime.timedelta(days = i)
+        yield async_storage.add_quarters_to_sheet(day, [Quarter(offset = i % 96, activity_id = activity.id)], user)
+
+def run(group_commit, client_count, writes, window = GROUP_COMMIT_WINDOW):
+    directory = tempfile.mkdtemp()
+    try:
+        storage = DefaultStorage(os.path.join(directory, "quarterapp.db"), group_commit = group_commit)
+        if storage._writer:
+            storage._writer.window = window
+        async_storage = AsyncStorage(storage, DEFAULT_WORKERS)
+        clients = []
+        for c in range(client_count):
+            user = User("user%d@example.com" % c)
+            storage.save_user(user)
+            category = Category("Work")
+            storage.save_category(category, user)
+            activity = Activity(title = "Dev", color = Color("#fcaf3e"))
+            storage.save_activity(activity, category, user)
+            clients.append((user, activity))
+        stats = storage._writer.stats() if storage._writer else None
+
+        @gen.coroutine
+        def all_clients():
+            yield [write_sheets(async_storage, user, activity, datetime.date(2013, 1, 1), writes)
+                for user, activity in clients]
+
+        start = time.time()
+        IOLoop.current().run_sync(all_clients)
+        seconds = time.time() - start
+
+        if stats:
+            after = storage._writer.stats()
+            stats = dict((key, after[key] - stats[key]) for key in after)
+        async_storage.shutdown()
+        storage.close()
+        return seconds, stats
+    finally:
+        shutil.rmtree(directory)
+
+def main():
+    client_count = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    writes = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    windows = [float(window) for window in sys.argv[3].split(",")] if len(sys.argv) > 3 else [GROUP_COMMIT_WINDOW]
+    total = client_count * writes
+    print "%d clients writing %d sheets each, %d storage workers" % (client_count, writes, DEFAULT_WORKERS)
+    runs = [("per thread", False, None)] + [("group %gs" % window, True, window) for window in windows]
+    for label, group_commit, window in runs:
+        seconds, stats = run(group_commit, client_count, writes, window)
+        print "  %-12s %8.0f writes/s" % (label, total / seconds),
+        if stats:
+            print " %.1f writes per commit" % (float(stats["jobs"]) / max(stats["groups"], 1)),
+        print
+
+if __name__ == "__main__":
+    main()
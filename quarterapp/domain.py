@@ -17,10 +17,13 @@
 
 import re
 import logging
+from array import array
 from datetime import date, timedelta, datetime
-from collections import Counter
 from utils import *
 
+# Number of quarters in a day
+QUARTERS_PER_DAY = 96
+
 
 class BaseError(Exception):
     """
@@ -244,6 +247,15 @@ class Activity(object):
         """
         return self.meta
 
+    def to_json(self):
+        """
+        Get this activity as a plain dictionary ready to be encoded as JSON
+
+        @return The dictionary
+        """
+        return { "id" : self.id, "category" : self.category_id, "title" : self.title,
+                 "color" : self.color.hex_value, "enabled" : self.state == Activity.Enabled }
+
 
 class ActivityDict(dict):
     """
@@ -272,6 +284,19 @@ class Category(object):
     def is_empty(self):
         return self.empty
 
+    def to_json(self):
+        """
+        Get this category as a plain dictionary ready to be encoded as JSON, including
+        its activities if it has been populated with any
+
+        @return The dictionary
+        """
+        activities = getattr(self, "activities", None)
+        if activities is None:
+            return { "id" : self.id, "title" : self.title }
+        return { "id" : self.id, "title" : self.title,
+                 "activities" : [activity.to_json() for activity in activities] }
+
 
 class TimeRange(object):
     """
@@ -357,52 +382,138 @@ class TimeSheet(object):
     Represents a day (24 hours) and contains any Quarters reported for that day.
 
     It can contain many or none quarters, but its total quarter count can never
-    exceed 96 quarters.
+    exceed 96 quarters. The quarters are kept as a fixed array of activity ids, one
+    per quarter, where -1 marks a quarter without activity.
     """
+    __slots__ = ("date", "weekday", "id", "activities", "comments", "summary", "_hours", "_total")
 
-    def __init__(self, date = None):
+    def __init__(self, date = None, activities = None, comments = None, id = -1):
         """
         Construct a TimeSheet
+
+        Args:
+            date: The date of this sheet
+            activities: The activity id for each of the 96 quarters of the day, -1 for none
+            comments: Dictionary with comment ids keyed on quarter offset
+            id: The sheet's storage id, -1 if not yet stored
         """
         self.date = date
-        self.weekday = date.weekday() # 0 based
-        self.quarters = []
+        self.weekday = date.weekday() if date else None # 0 based
+        self.id = id
+        if activities is None:
+            activities = [-1] * QUARTERS_PER_DAY
+        self.activities = array('i', activities)
+        self.comments = dict(comments or {})
         self.summary = [] # Summarized list of activities
+        self._hours = {}
+        self._total = 0
+
+    @property
+    def quarters(self):
+        """
+        The registered quarters of this day as Quarter objects, ordered by offset
+        """
+        quarters = []
+        for offset, activity_id in enumerate(self.activities):
+            if activity_id != -1:
+                quarters.append(Quarter(id = self.quarter_id(offset), offset = offset,
+                    activity_id = activity_id, comment_id = self.comments.get(offset, 0)))
+        return quarters
+
+    def quarter_id(self, offset):
+        """
+        Get the id for the quarter at the given offset. Quarters are stored per sheet,
+        so the id is derived from the sheet's id.
+
+        Args:
+            offset: The quarter offset (0-95)
+
+        Returns:
+            The quarter id, or -1 if this sheet is not yet stored
+        """
+        if self.id == -1:
+            return -1
+        return self.id * QUARTERS_PER_DAY + offset
+
+    @staticmethod
+    def split_quarter_id(quarter_id):
+        """
+        Split a quarter id into the id of its sheet and its offset
+
+        Returns:
+            A tuple of sheet id and quarter offset
+        """
+        return divmod(int(quarter_id), QUARTERS_PER_DAY)
+
+    def counts(self):
+        """
+        Count the quarters of this day per activity, quarters without activity are
+        counted on -1
+
+        Returns:
+            A dictionary with the number of quarters keyed on activity id
+        """
+        counts = {}
+        for activity_id in self.activities:
+            counts[activity_id] = counts.get(activity_id, 0) + 1
+        return counts
+
+    def runs(self):
+        """
+        Get the registered quarters of this day as runs of consecutive quarters with
+        the same activity
+
+        Returns:
+            A list of (start, length, activity id) tuples ordered by start
+        """
+        runs = []
+        start = 0
+        for offset in xrange(1, QUARTERS_PER_DAY + 1):
+            if offset == QUARTERS_PER_DAY or self.activities[offset] != self.activities[start]:
+                if self.activities[start] != -1:
+                    runs.append((start, offset - start, self.activities[start]))
+                start = offset
+        return runs
 
     def summarize(self):
         """
         Summarize the quarters and create activities for the sums
         """
-        quarter_values = map(lambda q: q.activity_id, self.quarters)
-        summary = Counter(quarter_values)
-        self.summary = []
-        for aid in summary:
-            if aid == "-1":
-                continue
-            self.summary.append(ActivitySummary(aid, float(summary[aid] / 4.0)))
-        self.summary.sort(key = lambda x: int(x.id))
+        self.summarize_counts(self.counts())
+
+    def summarize_counts(self, counts):
+        """
+        Create the activity sums from already counted quarters
+
+        Args:
+            counts: A dictionary with the number of quarters keyed on activity id
+        """
+        self._hours = {}
+        for aid, count in counts.iteritems():
+            if aid != -1 and count > 0:
+                self._hours[int(aid)] = count / 4.0
+        self.summary = [ActivitySummary(aid, self._hours[aid]) for aid in sorted(self._hours)]
+        self._total = sum(self._hours.itervalues())
 
     def total(self):
         """
         Get the total number of hours worth of activities for this day
         """
-        accumelator = 0
-        for act in self.summary:
-            accumelator += act.amount
-
-        return accumelator
+        return self._total
 
     def clear(self):
         """
         Clear this time sheet and remove any quarters registered.
         """
-        self.quarters = []
+        self.activities = array('i', [-1] * QUARTERS_PER_DAY)
+        self.comments = {}
+        self.summarize_counts({})
 
     def time(self, activity_id):
-        for act in self.summary:
-            if act.id == activity_id:
-                return act.amount
-        return 0
+        """
+        Get the number of hours spent on the given activity this day
+        """
+        return self._hours.get(activity_id, 0)
 
     def get_weekday(self):
         return self.date.weekday()
@@ -413,6 +524,22 @@ class TimeSheet(object):
         """
         return self.date.strftime("%Y-%m-%d")
 
+    def to_json(self):
+        """
+        Get this sheet as a plain dictionary ready to be encoded as JSON. The quarters
+        are built straight from the activity array, without creating Quarter objects.
+
+        Returns:
+            The dictionary
+        """
+        quarters = []
+        base_id = self.id * QUARTERS_PER_DAY if self.id != -1 else -1
+        for offset, activity_id in enumerate(self.activities):
+            if activity_id != -1:
+                quarters.append({ "id" : base_id + offset if base_id != -1 else -1,
+                                  "offset" : offset, "activity" : activity_id })
+        return { "date" : self.date_as_string(), "quarters" : quarters }
+
     def __str__(self):
         return "date = %s total = %d quarters = %s" % (self.date, self.total(), self.quarters)
 
@@ -437,15 +564,66 @@ class Quarter(object):
         self.color = "#fff"
         self.border_color = "#ccc"
 
+    def to_json(self):
+        """
+        Get this quarter as a plain dictionary ready to be encoded as JSON
+        """
+        return { "id" : self.id, "offset" : self.offset, "activity" : self.activity_id }
+
     def __str__(self):
         return "id=%d offset=%s comment_id=%s color=%s" % (self.id, self.offset, self.comment_id, self.color)
 
 
+class Change(object):
+    """
+    An entry in the change log, telling that an entity was changed or deleted. Only
+    the latest change of each entity is kept, clients read the entity itself to get
+    its current state.
+
+    The key is the date (YYYY-MM-DD) for a sheet, the quarter id for a comment and
+    the id for activities and categories.
+    """
+    Sheet = "sheet"
+    Comment = "comment"
+    Activity = "activity"
+    Category = "category"
+
+    def __init__(self, id = -1, entity = "", key = "", deleted = False):
+        self.id = id
+        self.entity = entity
+        self.key = key
+        self.deleted = deleted
+
+    def to_json(self):
+        return { "cursor" : self.id, "entity" : self.entity, "key" : self.key, "deleted" : self.deleted }
+
+    def __str__(self):
+        return "id = %d entity = %s key = %s deleted = %s" % (self.id, self.entity, self.key, self.deleted)
+
+
+class Mail(object):
+    """
+    An email waiting in the outbox to be sent. The message holds the complete mail,
+    headers included.
+    """
+    def __init__(self, id = -1, recipient = "", message = "", attempts = 0):
+        self.id = id
+        self.recipient = recipient
+        self.message = message
+        self.attempts = attempts
+
+    def __str__(self):
+        return "id = %d recipient = %s attempts = %d" % (self.id, self.recipient, self.attempts)
+
+
 class Comment(object):
     def __init__(self, id = -1, comment = ""):
         self.id = id
         self.comment = comment
 
+    def to_json(self):
+        return { "id" : self.id, "comment" : self.comment }
+
     def __str__(self):
         return "id = %d comment = '%s'" % (self.id, self.comment)
 
@@ -503,18 +681,24 @@ class Week(object):
         """
         return self.week
 
+    def activity_hours(self):
+        """
+        Get the number of hours spent per activity this week
+
+        Returns:
+            A dictionary with the hours keyed on activity id
+        """
+        hours = {}
+        for sheet in self.sheets:
+            _sum_activity_hours(sheet.summary, hours)
+        return hours
+
     def get_weeks_activities(self):
         """
         Get a sorted unique list of all the weeks activities where the
         activities amount is summed up
         """
-        all_activities = []
-        for sheet in self.sheets:
-            all_activities += sheet.summary
-
-        unique_activities = _merge_activity_summaries(all_activities)
-        unique_activities.sort(key=lambda x: int(x.id))
-        return unique_activities
+        return _activity_summaries(self.activity_hours())
 
     # Iteration support
     def __iter__(self):
@@ -536,7 +720,8 @@ class Week(object):
 class Report(object):
     def __init__(self):
         self.weeks = []
-        self.total_activities = []
+        self._hours = {}
+        self._total_activities = []
 
     def add_week(self, week):
         """
@@ -546,39 +731,59 @@ class Report(object):
             week: The Week object to add
         """
         self.weeks.append(week)
-        week_activities = week.get_weeks_activities()
-        activities = self.total_activities + week_activities
-        self.total_activities = _merge_activity_summaries(activities)
-        self.total_activities.sort(key=lambda x: int(x.id))
+        for activity_id, amount in week.activity_hours().iteritems():
+            self._hours[activity_id] = self._hours.get(activity_id, 0) + amount
+        self._total_activities = None
+
+    def add_totals(self, counts):
+        """
+        Add already aggregated quarters to the total summary, without adding any weeks.
+
+        Args:
+            counts: A dictionary with the number of quarters keyed on activity id
+        """
+        for activity_id, count in counts.iteritems():
+            self._hours[activity_id] = self._hours.get(activity_id, 0) + count / 4.0
+        self._total_activities = None
+
+    @property
+    def total_activities(self):
+        """
+        A sorted list with the summed up time spent per activity for the whole report
+        """
+        if self._total_activities is None:
+            self._total_activities = _activity_summaries(self._hours)
+        return self._total_activities
 
     def total_hours(self):
         """Calculate the total number of hours"""
-        acc = 0
-        for a in self.total_activities:
-            acc += a.amount
-        return acc
+        return sum(self._hours.itervalues())
+
+
+def _sum_activity_hours(activities, hours):
+    """
+    Add the amount of time spent of each activity summary to the given hours.
+
+    Args:
+        activities: A list of ActivitySummary objects
+        hours: A dictionary with hours keyed on activity id, updated in place
+
+    Returns:
+        The updated dictionary
+    """
+    for activity in activities:
+        hours[activity.id] = hours.get(activity.id, 0) + activity.amount
+    return hours
 
 
-def _merge_activity_summaries(activities):
+def _activity_summaries(hours):
     """
-    Filter any duplicate activities and merge the amount of time spent.
+    Create a list of ActivitySummary objects sorted on activity id
 
     Args:
-        A list of ActivitySummary objects
+        hours: A dictionary with hours keyed on activity id
 
     Returns:
         A list of unique ActivitySummary objects
     """
-    unique_activities = []
-    for aa in activities:
-        matches = list((ua for ua in unique_activities if ua.id == aa.id))
-        if len(matches) > 0:
-            # Item already exist in list of unique activities
-            # Mutable data, yay!
-            updated_activity = ActivitySummary(aa.id, aa.amount + matches[0].amount)
-
-            unique_activities.remove(matches[0])
-            unique_activities.append(updated_activity)
-        else:
-            unique_activities.append(aa)
-    return unique_activities
+    return [ActivitySummary(activity_id, hours[activity_id]) for activity_id in sorted(hours, key = int)]
@@ -15,11 +15,33 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import smtplib
+import socket
 import logging
-import sys
+import threading
+import time
 
 import tornado.template
 from tornado.options import options
+# Number of seconds between checks of the outbox when no mail has been queued
+MAIL_POLL_INTERVAL = 30
+
+# Number of seconds to wait before the first retry of a failed mail, doubled for each attempt
+MAIL_RETRY_DELAY = 60
+
+# Number of attempts to send a mail before giving up on it
+MAIL_MAX_ATTEMPTS = 8
+
+# Number of seconds a mail is reserved for the sender that is sending it
+MAIL_LEASE = 300
+
+# Number of mails read from the outbox at a time
+MAIL_BATCH_SIZE = 20
+
+# Number of seconds to wait for the SMTP server
+MAIL_TIMEOUT = 30
+
+# Port for SMTP over an implicit TLS connection (SMTPS)
+SMTPS_PORT = 465
 
 signup_email_template = tornado.template.Template("""From: Quarterapp <{{ email_from }}>
 To: {{ email_to }}
@@ -59,64 +81,186 @@ Cheers!
 """)
 
 
-def send_mail(username, message):
-    try:
-        server = smtplib.SMTP(options.mail_host)
+def signup_email(username, code):
+    """
+    Create the activation email to the given address with the given activation code.
 
-        if len(options.mail_user) > 0:
-            logging.info("Using email authentication ")
-            server.ehlo()
-            server.starttls()
-            server.ehlo()
-            server.login(options.mail_user, options.mail_password)
-            
-        server.sendmail(options.mail_sender, username, message)
-        return True
-    except Exception, e:
-        logging.warn("Could not send email")
-        logging.exception(e)
-        logging.warn(message)
-        return True
+    @param username The username to send the email to
+    @param code The activation code
+    @return The complete mail, headers included
+    """
+    return signup_email_template.generate(subject="Welcome to quarterapp",
+                                          email_from=options.mail_sender,
+                                          email_to=username,
+                                          code_link="http://" + options.base_url + "/activate/" + code,
+                                          link="http://" + options.base_url + "/activate",
+                                          code=code)
 
 
-def send_signup_email(username, code):
+def reset_email(username, code):
     """
-    Sends the activation email to the given address with the given activation code.
+    Create the password reset email to the given address with the given reset code.
 
     @param username The username to send the email to
-    @param code The activation code
-    @return True if mail could be sent, else False
+    @param code The reset code
+    @return The complete mail, headers included
     """
-    try:
-        message = signup_email_template.generate(subject="Welcome to quarterapp",
-                                                 email_from=options.mail_sender,
-                                                 email_to=username,
-                                                 code_link="http://" + options.base_url + "/activate/" + code,
-                                                 link="http://" + options.base_url + "/activate",
-                                                 code=code)
-        return send_mail(username, message)
-    except Exception, e:
-        logging.warn("Could not send signup email")
-        logging.exception(e)
-        return False
-
-
-def send_reset_email(username, code):
+    return reset_email_template.generate(subject="Reset your password",
+                                         email_from=options.mail_sender,
+                                         email_to=username,
+                                         code_link="http://" + options.base_url + "/reset/" + code,
+                                         link="http://" + options.base_url + "/reset",
+                                         code=code)
+
+
+class MailSender(object):
     """
-    Sends the password reset email to the given address with the given reset code.
-    @param username The username to send the email to
-    @param code The activation code
-    @return True if mail could be sent, else False
+    Sends the mails queued in the storage's outbox from a background thread, so that
+    request handlers never wait for the SMTP server. One SMTP connection is kept open,
+    and authenticated once, for as long as there are mails to send.
+
+    A mail that could not be sent is retried with an increasing delay, and given up
+    on after MAIL_MAX_ATTEMPTS attempts. The outbox is checked whenever the sender is
+    woken, and every poll interval for retries and mails queued by other processes.
     """
-    try:
-        message = reset_email_template.generate(subject="Reset your password",
-                                                email_from=options.mail_sender,
-                                                email_to=username,
-                                                code_link="http://" + options.base_url + "/reset/" + code,
-                                                link="http://" + options.base_url + "/reset",
-                                                code=code)
-        return send_mail(username, message)
-    except Exception, e:
-        logging.error("Could not send reset email!")
-        logging.exception(e)
-        return False
+
+    def __init__(self, storage, host, port = None, user = "", password = "", sender = "", ssl = None,
+            poll_interval = MAIL_POLL_INTERVAL, retry_delay = MAIL_RETRY_DELAY):
+        """
+        @param storage The storage holding the outbox
+        @param host The SMTP host name, optionally with the port as host:port
+        @param port The SMTP port number
+        @param user The SMTP authentication username, empty for no authentication
+        @param password The SMTP authentication password
+        @param sender The envelope sender address
+        @param ssl True to connect over TLS from the start, False to upgrade the connection
+                   with STARTTLS when authenticating, None to connect over TLS on port 465
+        @param poll_interval Number of seconds between checks of the outbox
+        @param retry_delay Number of seconds before the first retry of a failed mail
+        """
+        self.storage = storage
+        self.host = host or ""
+        self.port = port or 0
+        self.user = user or ""
+        self.password = password or ""
+        self.sender = sender or ""
+        self.ssl = self.port == SMTPS_PORT if ssl is None else ssl
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.sent = 0
+        self.failures = 0
+        self.connections = 0
+        self._server = None
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target = self._run, name = "mail")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def wake(self):
+        """
+        Tell the sender that mail has been queued
+        """
+        self._wake.set()
+
+    def stop(self):
+        """
+        Stop the sender thread, mails still in the outbox are sent on the next start
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _connect(self):
+        if self._server is None:
+            if self.ssl:
+                server = smtplib.SMTP_SSL(self.host, self.port, timeout = MAIL_TIMEOUT)
+            else:
+                server = smtplib.SMTP(self.host, self.port, timeout = MAIL_TIMEOUT)
+            if len(self.user) > 0:
+                server.ehlo()
+                if not self.ssl:
+                    server.starttls()
+                    server.ehlo()
+                server.login(self.user, self.password)
+            self._server = server
+            self.connections += 1
+        return self._server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self._server = None
+
+    def _drop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def _send(self, mail):
+        try:
+            self._connect().sendmail(self.sender, mail.recipient, mail.message)
+        except smtplib.SMTPServerDisconnected:
+            # The server may close a connection that has been idle, try again on a new one
+            self._drop()
+            self._connect().sendmail(self.sender, mail.recipient, mail.message)
+
+    def send_pending(self):
+        """
+        Send the mails that are due in the outbox
+
+        @return The number of mails that were due
+        """
+        count = 0
+        while not self._stopped:
+            mails = self.storage.claim_mail(time.time(), MAIL_LEASE, MAIL_BATCH_SIZE)
+            if not mails:
+                break
+            count += len(mails)
+            for mail in mails:
+                try:
+                    self._send(mail)
+                    self.sent += 1
+                    self.storage.mail_sent(mail.id)
+                except Exception, e:
+                    self.failures += 1
+                    if not isinstance(e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)):
+                        # The connection itself failed, reconnect for the next mail
+                        self._drop()
+                    self._retry_later(mail, e)
+        return count
+
+    def _retry_later(self, mail, error):
+        attempts = mail.attempts + 1
+        if attempts < MAIL_MAX_ATTEMPTS:
+            retry_at = time.time() + self.retry_delay * 2 ** mail.attempts
+            logging.warn("Could not send email to %s, attempt %d: %s", mail.recipient, attempts, error)
+        else:
+            retry_at = None
+            logging.error("Giving up on email to %s after %d attempts: %s", mail.recipient, attempts, error)
+        self.storage.mail_failed(mail.id, retry_at, str(error))
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.clear()
+            try:
+                self.send_pending()
+            except Exception, e:
+                logging.error("Could not send queued email")
+                logging.exception(e)
+            # Do not keep an idle connection open
+            self._disconnect()
+            self._wake.wait(self.poll_interval)
+
+    def stats(self):
+        """
+        Get the number of mails sent, failed attempts and SMTP connections made by this
+        sender, see the storage's mail_queue_stats for the state of the outbox
+        """
+        return {"sent": self.sent, "failures": self.failures, "connections": self.connections}
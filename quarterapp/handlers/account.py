@@ -16,6 +16,7 @@
 
 import tornado.web
 
+from tornado import gen
 from tornado.options import options
 from base import BaseHandler, AuthenticatedHandler, authenticated_user
 from ..utils import *
@@ -29,29 +30,30 @@ class LoginViewHandler(AuthenticatedHandler):
     def get(self):
         self.render(u"../resources/templates/account/login.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     error=False,
                     username=None,
                     allow_signups=False)
 
+    @gen.coroutine
     def post(self):
         username = self.get_argument("username", "")
         password = self.get_argument("password", "")
 
         hashed_password = hash_password(password, username)
-        user = self.application.storage.get_user_by_username(username)
+        user = yield self.application.async_storage.get_user_by_username(username)
 
         if user and user.password == hashed_password:
             # TODO This should check if active or not
             logging.info("User authenticated")
-            self.set_current_user(user)
+            yield self.set_current_user(user)
             self.redirect(u"/application/timesheet")
         else:
             logging.info("User not authenticated")
-            self.set_current_user(None)
+            yield self.set_current_user(None)
             self.render(u"../resources/templates/account/login.html",
                         options=options,
-                        current_user=self.get_current_user(),
+                        current_user=self.current_user,
                         error=True,
                         username=username,
                         allow_signups=False)
@@ -61,8 +63,9 @@ class LogoutViewHandler(BaseHandler):
     """
     The handler responsible for login
     """
+    @gen.coroutine
     def get(self):
-        self.clear_cookie("user")
+        yield self.set_current_user(None)
         self.redirect(u"/")  # TODO Make this configurable
 
 
@@ -71,11 +74,12 @@ class ChangePasswordHandler(AuthenticatedHandler):
     def get(self):
         self.render(u"../resources/templates/account/change_password.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     error=False,
                     done=False)
 
     @authenticated_user
+    @gen.coroutine
     def post(self):
         user = self.user()
 
@@ -91,24 +95,25 @@ class ChangePasswordHandler(AuthenticatedHandler):
             error = True
         else:
             hashed_password = hash_password(current_password, user.username)
-            user = self.application.storage.get_user(user.id)
+            user = yield self.application.async_storage.get_user(user.id)
             if not hashed_password == user.password:
                 error = True
 
         if not error:
             user.password = hash_password(new_password, user.username)
-            self.application.storage.save_user(user)
+            yield self.application.async_storage.save_user(user)
             done = True
         
         self.render(u"../resources/templates/account/change_password.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     error=error,
                     done=done)
 
 
 class DeleteAccountHandler(AuthenticatedHandler):
     @authenticated_user
+    @gen.coroutine
     def post(self):
         user = self.user()
         password = self.get_argument("password", None)
@@ -118,7 +123,7 @@ class DeleteAccountHandler(AuthenticatedHandler):
             error = True
         else:
             hashed_password = hash_password(password, user.username)
-            user = self.application.storage.get_user(user.id)
+            user = yield self.application.async_storage.get_user(user.id)
             if not hashed_password == user.password:
                 error = True
 
@@ -126,11 +131,11 @@ class DeleteAccountHandler(AuthenticatedHandler):
             logging.error("Could not delete account")
             self.render(u"../resources/templates/app/profile.html",
                         options=options,
-                        current_user=self.get_current_user(),
+                        current_user=self.current_user,
                         delete_account_error=True)
         else:
-            self.application.storage.delete_user(user)
-            self.set_current_user(None)
+            yield self.application.async_storage.delete_user(user)
+            yield self.set_current_user(None)
             self.redirect(u"/")
 
 
@@ -138,10 +143,11 @@ class ForgotPasswordHandler(BaseHandler):
     def get(self):
         self.render(u"../resources/templates/account/forgot.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     error=None,
                     username=None)
 
+    @gen.coroutine
     def post(self):
         username = self.get_argument("username", "")
         error = None
@@ -149,15 +155,23 @@ class ForgotPasswordHandler(BaseHandler):
             error = True
         else:
             reset_code = activation_code()
-            if self.application.storage.set_user_reset_code(username, reset_code):
-                send_reset_email(username, reset_code)
+            message = reset_email(username, reset_code)
+
+            def reset(storage):
+                if not storage.set_user_reset_code(username, reset_code):
+                    return False
+                storage.queue_mail(username, message)
+                return True
+
+            if (yield self.application.async_storage.run_in_transaction(reset)):
+                self.application.mail_sender.wake()
                 self.redirect(u"/reset")
             else:
                 error = True
         if error:
             self.render(u"../resources/templates/account/forgot.html",
                         options=options,
-                        current_user=self.get_current_user(),
+                        current_user=self.current_user,
                         error=True,
                         username=username)
 
@@ -170,10 +184,11 @@ class ResetPasswordHandler(BaseHandler):
 
         self.render(u"../resources/templates/account/reset.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     error=None,
                     code=code)
 
+    @gen.coroutine
     def post(self):
         code = self.get_argument("code", "")
         password = self.get_argument("password", "")
@@ -188,9 +203,8 @@ class ResetPasswordHandler(BaseHandler):
             error = True
 
         if not error:
-            salt = self.application.storage.username_for_reset_code(code)
-            salted_password = hash_password(password, salt)
-            if self.application.storage.reset_password(code, salted_password):
+            salt = yield self.application.async_storage.username_for_reset_code(code)
+            if salt and (yield self.application.async_storage.reset_password(code, hash_password(password, salt))):
                 self.redirect(u"/login")
             else:
                 error = True
@@ -198,7 +212,7 @@ class ResetPasswordHandler(BaseHandler):
         if error:
             self.render(u"../resources/templates/account/reset.html",
                         options=options,
-                        current_user=self.get_current_user(),
+                        current_user=self.current_user,
                         error=True,
                         code=code)
 
@@ -208,12 +222,13 @@ class SignupHandler(BaseHandler):
         if self.enabled("allow-signups"):
             self.render(u"../resources/templates/account/signup.html",
                         options=options,
-                        current_user=self.get_current_user(),
+                        current_user=self.current_user,
                         error=None,
                         username="")
         else:
             raise tornado.web.HTTPError(404)
 
+    @gen.coroutine
     def post(self):
         if not self.enabled("allow-signups"):
             raise tornado.web.HTTPError(500)
@@ -223,17 +238,24 @@ class SignupHandler(BaseHandler):
         error = False
         if len(username) == 0:
             error = "empty"
-        if not self.application.storage.unique_username(username):
+        if not (yield self.application.async_storage.unique_username(username)):
             error = "not_unique"
 
         if not error:
             try:
                 code = activation_code()
-                if send_signup_email(username, code):
-                    self.application.storage.signup_user(username, code, self.request.remote_ip)
+                message = signup_email(username, code)
+                ip = self.request.remote_ip
+
+                def signup(storage):
+                    storage.signup_user(username, code, ip)
+                    return storage.queue_mail(username, message)
+
+                if (yield self.application.async_storage.run_in_transaction(signup)):
+                    self.application.mail_sender.wake()
                     self.render(u"../resources/templates/account/signup_instructions.html",
                                 options=options,
-                                current_user=self.get_current_user())
+                                current_user=self.current_user)
                     return
                 else:
                     error = True
@@ -244,7 +266,7 @@ class SignupHandler(BaseHandler):
         
         self.render(u"../resources/templates/account/signup.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     error=error,
                     username=username)
 
@@ -258,12 +280,13 @@ class ActivationHandler(BaseHandler):
         if self.enabled("allow-activations"):
             self.render(u"../resources/templates/account/activate.html",
                         options=options,
-                        current_user=self.get_current_user(),
+                        current_user=self.current_user,
                         error=None,
                         code=code)
         else:
             raise tornado.web.HTTPError(404)
 
+    @gen.coroutine
     def post(self):
         if not self.enabled("allow-activations"):
             raise tornado.web.HTTPError(500)
@@ -279,14 +302,14 @@ class ActivationHandler(BaseHandler):
             error = "not_matching"
 
         if not error:
-            salt = self.application.storage.username_for_activation_code(code)
-            salted_password = hash_password(password, salt)
-            if self.application.storage.activate_user(code, salted_password, salt):
+            salt = yield self.application.async_storage.username_for_activation_code(code)
+            if salt and (yield self.application.async_storage.activate_user(code, hash_password(password, salt), salt)):
                 self.redirect(u"/login")
                 return
+            error = "not_valid"
 
         self.render(u"../resources/templates/account/activate.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     error=error,
                     code=code)
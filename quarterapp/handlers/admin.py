@@ -14,9 +14,11 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
 import tornado.web
 import logging
 
+from tornado import gen
 from tornado.options import options
 from base import AuthenticatedHandler, authenticated_admin
 from ..domain import BaseError, User, UserType, UserState
@@ -40,10 +42,12 @@ ERROR_INVALID_USERNAME              = ViewError(10002, "Not logged in")
 ERROR_PASSWORDS_NOT_MATCHING        = ViewError(10003, "Not implemented")
 ERROR_NOT_ALLOWED                   = ViewError(10004, "Not allowed")
 
-def verify_username(storage, username):
+@gen.coroutine
+def verify_username(async_storage, username):
     if len(username) == 0:
         raise ERROR_INVALID_USERNAME
-    if not storage.unique_username(username):
+    unique = yield async_storage.unique_username(username)
+    if not unique:
         raise ERROR_USERNAME_NOT_UNIQUE
 
 def verify_password(first, second):
@@ -61,7 +65,7 @@ class AdminDefaultHandler(AuthenticatedHandler):
 
         self.render(u"../resources/templates/admin/general.html",
             options = options,
-            current_user = self.get_current_user(),
+            current_user = self.current_user,
             allow_signups = allow_signups,
             allow_activations = allow_activations)
 
@@ -71,6 +75,7 @@ class AdminUsersHandler(AuthenticatedHandler):
     """
 
     @authenticated_admin
+    @gen.coroutine
     def get(self):
         start = self.get_argument("start", "")
         count = self.get_argument("count", "")
@@ -95,19 +100,19 @@ class AdminUsersHandler(AuthenticatedHandler):
         try:
             if query_filter:
                 logging.info("Getting filtered users %s" % (query_filter))
-                user_count = self.application.storage.get_filtered_user_count(query_filter)
+                user_count = yield self.application.async_storage.get_filtered_user_count(query_filter)
                 pagination_links = generate_pagination(user_count, start, count, DEFAULT_PAGINATION_PAGES, query_filter = query_filter)
-                users = self.application.storage.get_filtered_users(query_filter, start, count)
+                users = yield self.application.async_storage.get_filtered_users(query_filter, start, count)
             else:
-                user_count = self.application.storage.user_count()
+                user_count = yield self.application.async_storage.user_count()
                 pagination_links = generate_pagination(user_count, start, count, DEFAULT_PAGINATION_PAGES)
-                users = self.application.storage.get_users(start, count)
+                users = yield self.application.async_storage.get_users(start, count)
         except:
             error = True
 
         self.render(u"../resources/templates/admin/users.html",
             options = options,
-            current_user = self.get_current_user(),
+            current_user = self.current_user,
             users = users,
             pagination = pagination_links,
             error = error,
@@ -115,7 +120,7 @@ class AdminUsersHandler(AuthenticatedHandler):
 
     @authenticated_admin
     def post(self):
-        self.get()
+        return self.get()
 
 class AdminNewUserHandler(AuthenticatedHandler):
     """
@@ -126,11 +131,12 @@ class AdminNewUserHandler(AuthenticatedHandler):
     def get(self):
         self.render(u"../resources/templates/admin/new-user.html",
             options = options,
-            current_user = self.get_current_user(),
+            current_user = self.current_user,
             completed = False,
             error = False)
 
     @authenticated_admin
+    @gen.coroutine
     def post(self):
         username = self.get_argument("username", "")
         password = self.get_argument("password", "")
@@ -139,12 +145,13 @@ class AdminNewUserHandler(AuthenticatedHandler):
         error = None
 
         try:
-            verify_username(self.application.storage, username)
+            yield verify_username(self.application.async_storage, username)
             verify_password(password, repeat_password)
             hashed_password = hash_password(password, username)
 
             new_user = User(username = username, password = hashed_password, type = UserType.from_string(user_type), state= UserState.Active)
-            if not self.application.storage.save_user(new_user):
+            saved = yield self.application.async_storage.save_user(new_user)
+            if not saved:
                 error = ERROR_UNKNOWN
         except ViewError, e:
             logging.error("Could not create user:")
@@ -157,7 +164,7 @@ class AdminNewUserHandler(AuthenticatedHandler):
 
         self.render(u"../resources/templates/admin/new-user.html",
             options = options,
-            current_user = self.get_current_user(),
+            current_user = self.current_user,
             completed = not error,
             error = error)
 
@@ -167,16 +174,18 @@ class AdminEditUserHandler(AuthenticatedHandler):
     """
 
     @authenticated_admin
+    @gen.coroutine
     def get(self, user_id):
-        user = self.application.storage.get_user(user_id)
+        user = yield self.application.async_storage.get_user(user_id)
         self.render(u"../resources/templates/admin/edit-user.html",
             options = options,
-            current_user = self.get_current_user(),
+            current_user = self.current_user,
             user = user,
             completed = False,
             error = False)
 
     @authenticated_admin
+    @gen.coroutine
     def post(self, user_id):
         username = self.get_argument("username", "")
         password = self.get_argument("password", "")
@@ -187,7 +196,7 @@ class AdminEditUserHandler(AuthenticatedHandler):
         user = None
 
         try:
-            current_user = self.application.storage.get_user(user_id)
+            current_user = yield self.application.async_storage.get_user(user_id)
 
             # Trying to update username
             if not current_user.username == username: 
@@ -200,7 +209,8 @@ class AdminEditUserHandler(AuthenticatedHandler):
 
             user = User(id = user_id, username = username, password = password,
                 type = UserType.from_string(user_type), state= UserState.from_string(user_state))
-            if not self.application.storage.save_user(user):
+            saved = yield self.application.async_storage.save_user(user)
+            if not saved:
                 error = ERROR_UNKNOWN
         except ViewError, e:
             logging.error("Could not update user:")
@@ -213,30 +223,35 @@ class AdminEditUserHandler(AuthenticatedHandler):
 
         self.render(u"../resources/templates/admin/edit-user.html",
             options = options,
-            current_user = self.get_current_user(),
+            current_user = self.current_user,
             user = user,
             completed = not error,
             error = error)
 
 class AdminDeleteUserHandler(AuthenticatedHandler):
     @authenticated_admin
+    @gen.coroutine
     def get(self, user_id):
-        self.application.storage.delete_user(User("", user_id))
+        yield self.application.async_storage.delete_user(User("", user_id))
         self.redirect(u"/admin/users")
 
 class AdminMetricsHandler(AuthenticatedHandler):
     @authenticated_admin
+    @gen.coroutine
     def get(self):
-        user_count = self.application.storage.user_count()
-        signup_count = 0
-        quarter_count = 0
+        user_count = yield self.application.async_storage.user_count()
+        quarter_count = yield self.application.async_storage.quarter_count()
+        cache_stats = yield self.application.async_storage.cache_stats()
+        mail_stats = yield self.application.async_storage.mail_queue_stats(time.time())
+        mail_stats.update(self.application.mail_sender.stats())
 
         self.render(u"../resources/templates/admin/metrics.html",
             options = options,
-            current_user = self.get_current_user(),
+            current_user = self.current_user,
             user_count = user_count,
-            signup_count = signup_count,
-            quarter_count = quarter_count)
+            quarter_count = quarter_count,
+            cache_stats = cache_stats or {},
+            mail_stats = mail_stats)
 
 class AdminSettingsHandler(AuthenticatedHandler):
     """
@@ -14,43 +14,21 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
+import datetime
 import logging
 import tornado.web
 
-from tornado.escape import utf8
+from tornado import gen
+from tornado.escape import utf8, json_decode
 from tornado.options import options
 from base import BaseHandler, AuthenticatedHandler, authenticated_user
 from ..utils import *
-from ..domain import BaseError, NotLoggedInError, Category, Activity, Color, ActivityDict, TimeSheet, Quarter, Comment
-
-class QuarterEncoder(json.JSONEncoder):
-    """
-    JSON encoder for quarterapp specific objects
-    """
-    def default(self, obj):
-        if isinstance(obj, ApiError):
-            return { "code" : obj.code, "message" : obj.message }
-        if isinstance(obj, Category):
-            if hasattr(obj, "activities"):
-                return { "id" : obj.id, "title" : obj.title, "activities" : obj.activities}
-            else:    
-                return { "id" : obj.id, "title" : obj.title }
-        if isinstance(obj, Activity):
-            return { "id" : obj.id, "category" : obj.category_id, "title" : obj.title,
-                     "color" : obj.color.hex(), "enabled" : obj.enabled() }
-        if isinstance(obj, TimeSheet):
-            return { "date" : obj.date_as_string(), "quarters" : obj.quarters  }
-        if isinstance(obj, Quarter):
-            return { "id" : obj.id, "offset" : obj.offset, "activity" : obj.activity_id }
-        if isinstance(obj, Comment):
-            return { "id" : obj.id, "comment" : obj.comment }
+from ..json_utils import json_encode
+from ..domain import BaseError, NotLoggedInError, Category, Activity, Color, ActivityDict, TimeSheet, TimeRange, Quarter, Comment, QUARTERS_PER_DAY
 
 class JsonApiHandler(BaseHandler):
     def _send(self, structure):
-        structure = QuarterEncoder().encode(structure).replace("'", "\"")
-        structure = utf8(structure)
-        self._write_buffer.append(structure)
+        self._write_buffer.append(utf8(json_encode(structure)))
         self.set_header("Content-Type", "application/json; charset=UTF-8")
         self.finish()
 
@@ -82,6 +60,23 @@ class JsonApiHandler(BaseHandler):
             "message" :"Ok"})
         self.finish()
 
+    def push_sheet(self, user, date, quarters, summary, total):
+        """
+        Push the changed quarters and the new summary of a day to the user's other devices
+        """
+        self.application.push.publish(user, { "type" : "sheet", "date" : str(date),
+            "quarters" : quarters, "summary" : summary, "total" : total })
+
+    def push_comment(self, user, quarter_id, comment = None):
+        """
+        Push a changed comment to the user's other devices, None if it was deleted
+        """
+        if comment is None:
+            message = { "type" : "comment", "quarter" : int(quarter_id), "deleted" : True }
+        else:
+            message = { "type" : "comment", "quarter" : int(quarter_id), "comment" : comment }
+        self.application.push.publish(user, message)
+
     def parameter(self, argument, error):
         argument = self.get_argument(argument, None)
         if not argument or len(argument) == 0:
@@ -96,6 +91,20 @@ class ApiError(BaseError):
         self.code = code
         self.message = message
 
+    def to_json(self):
+        return { "code" : self.code, "message" : self.message }
+
+class BatchError(ApiError):
+    """
+    The error of a failed operation in a batch, tells which operation that failed.
+    """
+    def __init__(self, index, error):
+        ApiError.__init__(self, error.code, error.message)
+        self.index = index
+
+    def to_json(self):
+        return { "code" : self.code, "message" : self.message, "operation" : self.index }
+
 ERROR_GENERAL               = ApiError(100, "An unknown error occured")
 ERROR_NOT_IMPLEMENTED       = ApiError(101, "Not implemented")
 ERROR_NOT_AUTHENTICATED     = ApiError(400, "Not logged in")
@@ -108,6 +117,17 @@ ERROR_NO_QUARTERS           = ApiError(700, "No quarters given")
 ERROR_NOT_96_QUARTERS       = ApiError(701, "Expected 96 quarters")
 ERROR_INVALID_SHEET_DATE    = ApiError(702, "Expected date in YYYY-MM-DD format")
 ERROR_NO_INDEXES            = ApiError(703, "Missing value for indexes")
+ERROR_INVALID_SHEET_RANGE   = ApiError(704, "Expected from date before to date")
+ERROR_INVALID_SHEET_CURSOR  = ApiError(705, "Expected cursor within the date range")
+ERROR_NO_RUNS               = ApiError(706, "Missing value for runs")
+ERROR_INVALID_RUN           = ApiError(707, "Expected runs as date:start:length:activity")
+ERROR_TOO_MANY_DAYS         = ApiError(708, "Too many days in one request")
+ERROR_INVALID_CURSOR        = ApiError(900, "Expected cursor as a number")
+ERROR_NO_OPERATIONS         = ApiError(1000, "Missing value for operations")
+ERROR_INVALID_OPERATIONS    = ApiError(1001, "Expected operations as a JSON list")
+ERROR_UNKNOWN_OPERATION     = ApiError(1002, "Unknown operation")
+ERROR_TOO_MANY_OPERATIONS   = ApiError(1003, "Too many operations in one request")
+ERROR_NO_QUARTER_ID         = ApiError(1004, "Missing value for quarter")
 ERROR_NO_COMMENT            = ApiError(800, "Missing value for comment")
 
 class CategoriesApiHandler(JsonApiHandler, AuthenticatedHandler):
@@ -116,10 +136,11 @@ class CategoriesApiHandler(JsonApiHandler, AuthenticatedHandler):
     """
 
     @authenticated_user
+    @gen.coroutine
     def get(self):
         try:
             user = self.user()
-            categories = self.application.storage.get_categories(user)
+            categories = yield self.application.async_storage.get_categories(user)
 
             if not categories:
                 categories = []
@@ -137,13 +158,15 @@ class CategoryApiHandler(JsonApiHandler, AuthenticatedHandler):
     """
     
     @authenticated_user
+    @gen.coroutine
     def post(self):
         try:
             user = self.user()
             title = self.parameter("title", ERROR_NO_CATEGORY_TITLE)
             category = Category(title)
 
-            if self.application.storage.save_category(category, user):
+            saved = yield self.application.async_storage.save_category(category, user)
+            if saved:
                 self.send_json(category)
             else:
                 self.send_json_error(ERROR_GENERAL)
@@ -153,11 +176,12 @@ class CategoryApiHandler(JsonApiHandler, AuthenticatedHandler):
             self.send_json_error(error)
 
     @authenticated_user
+    @gen.coroutine
     def get(self, category_id):
         try:
             user = self.user()
             
-            category = self.application.storage.get_category(category_id, user)
+            category = yield self.application.async_storage.get_category(category_id, user)
             if category:
                 self.send_json(category)
             else:
@@ -168,13 +192,15 @@ class CategoryApiHandler(JsonApiHandler, AuthenticatedHandler):
             self.send_json_error(error)
 
     @authenticated_user
+    @gen.coroutine
     def put(self, category_id):
         try:
             user = self.user()
             title = self.parameter("title", ERROR_NO_CATEGORY_TITLE)
             category = Category(id = int(category_id), title = title)
 
-            if self.application.storage.save_category(category, user):
+            saved = yield self.application.async_storage.save_category(category, user)
+            if saved:
                 self.send_json(category)
             else:
                 self.send_json_error(ERROR_GENERAL)
@@ -184,11 +210,14 @@ class CategoryApiHandler(JsonApiHandler, AuthenticatedHandler):
             self.send_json_error(error)
 
     @authenticated_user
+    @gen.coroutine
     def delete(self, category_id):
         try:
             user = self.user()
-            if self.application.storage.get_category(category_id, user).is_empty():
-                if self.application.storage.delete_category(Category(id=category_id), user):
+            category = yield self.application.async_storage.get_category(category_id, user)
+            if category and category.is_empty():
+                deleted = yield self.application.async_storage.delete_category(Category(id=category_id), user)
+                if deleted:
                     self.send_success()
                 else:
                     self.send_json_error(ERROR_GENERAL)
@@ -205,16 +234,19 @@ class ActivitiesApiHandler(JsonApiHandler, AuthenticatedHandler):
     """
 
     @authenticated_user
+    @gen.coroutine
     def get(self, category_id):
         try:
             user = self.user()
+            if (yield self.not_modified(user)):
+                return
             activities = []
 
             if category_id == "all":
-                activities = self.application.storage.get_activities(user)
+                activities = yield self.application.async_storage.get_activities(user)
             else:
                 category = Category(id = category_id)
-                activities = self.application.storage.get_activities_for_category(category, user)
+                activities = yield self.application.async_storage.get_activities_for_category(category, user)
 
             self.send_json( { "activities" : activities } )
 
@@ -230,10 +262,13 @@ class CategoryAndActivitiesHandler(JsonApiHandler, AuthenticatedHandler):
     """
 
     @authenticated_user
+    @gen.coroutine
     def get(self):
         try:
             user = self.user()
-            categories = self.application.storage.get_categories_and_activities(user)
+            if (yield self.not_modified(user)):
+                return
+            categories = yield self.application.async_storage.get_categories_and_activities(user)
             self.send_json( { "categories" : categories } )
 
         except NotLoggedInError:
@@ -241,12 +276,25 @@ class CategoryAndActivitiesHandler(JsonApiHandler, AuthenticatedHandler):
         except  ApiError, error:
             self.send_json_error(error)
 
+def _activity_id(activity_id):
+    """
+    Get the activity id given in a URL or parameter as an integer
+
+    @param activity_id The activity id as a string
+    @return The activity id
+    """
+    try:
+        return int(activity_id)
+    except (TypeError, ValueError):
+        raise ERROR_NO_ACTIVITY_ID
+
 class ActivityApiHandler(JsonApiHandler, AuthenticatedHandler):
     """
     HTTP API for CRUD operations of Activity
     """
     
     @authenticated_user
+    @gen.coroutine
     def post(self):
         try:
             user = self.user()
@@ -263,7 +311,8 @@ class ActivityApiHandler(JsonApiHandler, AuthenticatedHandler):
             category = Category(id = category_id)
             activity = Activity(title = title, category_id = int(category_id), color = Color(color), state = state)
 
-            if self.application.storage.save_activity(activity, category, user):
+            saved = yield self.application.async_storage.save_activity(activity, category, user)
+            if saved:
                 self.send_json(activity)
             else:
                 self.send_json_error(ERROR_GENERAL)
@@ -273,11 +322,12 @@ class ActivityApiHandler(JsonApiHandler, AuthenticatedHandler):
             self.send_json_error(error)
 
     @authenticated_user
+    @gen.coroutine
     def get(self, activity_id):
         try:
             user = self.user()
             
-            activity = self.application.storage.get_activity(activity_id, user)
+            activity = yield self.application.async_storage.get_activity(activity_id, user)
             
             if activity:
                 self.send_json(activity)
@@ -289,6 +339,7 @@ class ActivityApiHandler(JsonApiHandler, AuthenticatedHandler):
             self.send_json_error(error)
 
     @authenticated_user
+    @gen.coroutine
     def put(self, activity_id):
         try:
             user = self.user()
@@ -303,9 +354,11 @@ class ActivityApiHandler(JsonApiHandler, AuthenticatedHandler):
                 state = Activity.Enabled
 
             category = Category(id = category_id)
-            activity = Activity(id = activity_id, title = title, category_id = int(category_id), color = Color(color), state = state)
+            activity = Activity(id = _activity_id(activity_id), title = title, category_id = int(category_id),
+                color = Color(color), state = state)
 
-            if self.application.storage.save_activity(activity, category, user):
+            saved = yield self.application.async_storage.save_activity(activity, category, user)
+            if saved:
                 self.send_json(activity)
             else:
                 self.send_json_error(ERROR_GENERAL)
@@ -315,11 +368,13 @@ class ActivityApiHandler(JsonApiHandler, AuthenticatedHandler):
             self.send_json_error(error)
 
     @authenticated_user
+    @gen.coroutine
     def delete(self, activity_id):
         try:
             user = self.user()
             
-            if self.application.storage.delete_activity(Activity(id=activity_id), user):
+            deleted = yield self.application.async_storage.delete_activity(Activity(id = _activity_id(activity_id)), user)
+            if deleted:
                 self.send_success()
             else:
                 self.send_json_error(ERROR_GENERAL)
@@ -328,12 +383,43 @@ class ActivityApiHandler(JsonApiHandler, AuthenticatedHandler):
         except  ApiError, error:
             self.send_json_error(error)
 
+def _quarters(indexes, activity_id):
+    """
+    Create the quarters to register the given activity at each of the given indexes
+
+    @param indexes The quarter offsets of the day, 0 to 95
+    @param activity_id The activity id, -1 to erase the quarters
+    @return A list of Quarter objects
+    """
+    try:
+        quarters = [Quarter(offset = index, activity_id = activity_id) for index in indexes]
+    except (TypeError, ValueError):
+        raise ERROR_NO_INDEXES
+    if any(quarter.offset < 0 or quarter.offset >= QUARTERS_PER_DAY for quarter in quarters):
+        raise ERROR_NO_INDEXES
+    return quarters
+
+def _check_activities(activity_ids, activities):
+    """
+    Make sure the quarters are only registered on the user's own activities
+
+    @param activity_ids The activity ids to register, -1 to erase
+    @param activities The user's activities
+    """
+    known = set(activity.id for activity in activities)
+    known.add(-1)
+    if any(activity_id not in known for activity_id in activity_ids):
+        raise ERROR_NO_ACTIVITY_ID
+
 class SheetApiHandler(JsonApiHandler, AuthenticatedHandler):
     @authenticated_user
+    @gen.coroutine
     def get(self, date):
         try:
             user = self.user()
-            sheet = self.application.storage.get_timesheet(extract_date(date), user)
+            if (yield self.not_modified(user)):
+                return
+            sheet = yield self.application.async_storage.get_timesheet(extract_date(date), user)
             self.send_json(sheet)
         except NotLoggedInError:
             self.send_json_error(ERROR_NOT_AUTHENTICATED)
@@ -341,22 +427,21 @@ class SheetApiHandler(JsonApiHandler, AuthenticatedHandler):
             self.send_json_error(error)
 
     @authenticated_user
+    @gen.coroutine
     def put(self, date):
         try:
             user = self.user()
+            if not valid_date(date):
+                raise ERROR_INVALID_SHEET_DATE
             indexes = self.parameter("indexes", ERROR_NO_INDEXES)
-            activity_id = self.parameter("activity", ERROR_NO_ACTIVITY_ID)
+            activity_id = _activity_id(self.parameter("activity", ERROR_NO_ACTIVITY_ID))
 
-            quarters = []
-            indexes_array = indexes.split(',')
-            for index in indexes_array:
-                quarters.append(Quarter(offset = index, activity_id = int(activity_id)))
+            quarters = _quarters(indexes.split(","), activity_id)
+            _check_activities([activity_id], (yield self.application.async_storage.get_activities(user)))
 
-            updated_quarters = self.application.storage.add_quarters_to_sheet(extract_date(date), quarters, user)
-            
-            time_sheet = self.application.storage.get_timesheet(extract_date(date), user)
-            activity_dict = ActivityDict(self.application.storage.get_activities(user))
-            summary, total = summarize_quarters(time_sheet.quarters, activity_dict)
+            updated_quarters, summary, total = yield self.application.async_storage.update_sheet(
+                extract_date(date), quarters, user)
+            self.push_sheet(user, date, updated_quarters, summary, total)
             self.send_json({ "summary" : summary, "total" : total , "quarters" : updated_quarters})
 
         except NotLoggedInError:
@@ -364,12 +449,310 @@ class SheetApiHandler(JsonApiHandler, AuthenticatedHandler):
         except ApiError, error:
             self.send_json_error(error)
 
+# Maximum number of days returned by one request for a range of sheets
+SHEETS_PAGE_DAYS = 31
+
+class SheetsApiHandler(JsonApiHandler, AuthenticatedHandler):
+    """
+    HTTP API for reading the sheets of a range of days in one request
+
+    Each day with registered quarters is encoded as its sheet id and the runs of
+    quarters with the same activity as [start, length, activity] (the quarter id is
+    sheet id * 96 + offset). At most SHEETS_PAGE_DAYS days are returned at a time,
+    if the range is longer the response contains a cursor for the next page.
+
+    Quarters on many days are written by posting runs, each given as
+    date:start:length:activity and separated by commas. Activity -1 erases.
+    """
+
+    def _date_argument(self, name):
+        value = self.get_argument(name, "")
+        if not valid_date(value):
+            raise ERROR_INVALID_SHEET_DATE
+        return extract_date(value)
+
+    @authenticated_user
+    @gen.coroutine
+    def get(self):
+        try:
+            user = self.user()
+            from_date = self._date_argument("from")
+            to_date = self._date_argument("to")
+            if from_date > to_date:
+                raise ERROR_INVALID_SHEET_RANGE
+
+            page_start = from_date
+            if self.get_argument("cursor", None):
+                page_start = self._date_argument("cursor")
+                if page_start < from_date or page_start > to_date:
+                    raise ERROR_INVALID_SHEET_CURSOR
+            page_end = min(to_date, page_start + datetime.timedelta(days = SHEETS_PAGE_DAYS - 1))
+
+            if (yield self.not_modified(user, page_start, page_end)):
+                return
+
+            sheets = yield self.application.async_storage.get_timesheets(page_start, page_end, user)
+            days = []
+            for date in sorted(sheets):
+                days.append({ "date" : sheets[date].date_as_string(), "id" : sheets[date].id,
+                              "runs" : sheets[date].runs() })
+
+            next_cursor = None
+            if page_end < to_date:
+                next_cursor = str(page_end + datetime.timedelta(days = 1))
+            self.send_json({ "from" : str(page_start), "to" : str(page_end),
+                             "sheets" : days, "next" : next_cursor })
+        except NotLoggedInError:
+            self.send_json_error(ERROR_NOT_AUTHENTICATED)
+        except ApiError, error:
+            self.send_json_error(error)
+
+    @staticmethod
+    def _parse_runs(runs):
+        """
+        Parse the comma separated runs into time ranges
+
+        @param runs The runs, each given as date:start:length:activity
+        @return A list of (date, TimeRange) tuples
+        """
+        ranges = []
+        for run in runs.split(","):
+            parts = run.strip().split(":")
+            if len(parts) != 4 or not valid_date(parts[0]):
+                raise ERROR_INVALID_RUN
+            try:
+                time_range = TimeRange(start = int(parts[1]), length = int(parts[2]),
+                    activity_id = int(parts[3]))
+            except (ValueError, BaseError):
+                raise ERROR_INVALID_RUN
+            ranges.append((extract_date(parts[0]), time_range))
+        return ranges
+
+    @authenticated_user
+    @gen.coroutine
+    def post(self):
+        try:
+            user = self.user()
+            ranges = SheetsApiHandler._parse_runs(self.parameter("runs", ERROR_NO_RUNS))
+            if len(set(date for date, time_range in ranges)) > SHEETS_PAGE_DAYS:
+                raise ERROR_TOO_MANY_DAYS
+            _check_activities([time_range.activity_id for date, time_range in ranges],
+                (yield self.application.async_storage.get_activities(user)))
+
+            summaries = yield self.application.async_storage.update_sheets(ranges, user)
+            days = []
+            for date in sorted(summaries):
+                quarters, summary, total = summaries[date]
+                days.append({ "date" : str(date), "summary" : summary, "total" : total })
+                # Overlapping runs write the same quarter more than once, the last one is kept
+                quarters = dict((quarter.offset, quarter) for quarter in quarters)
+                self.push_sheet(user, date, [quarters[offset] for offset in sorted(quarters)], summary, total)
+            self.send_json({ "sheets" : days })
+        except NotLoggedInError:
+            self.send_json_error(ERROR_NOT_AUTHENTICATED)
+        except ApiError, error:
+            self.send_json_error(error)
+
+# Maximum number of changes returned by one request
+CHANGES_PAGE_SIZE = 500
+
+class ChangesApiHandler(JsonApiHandler, AuthenticatedHandler):
+    """
+    HTTP API for synchronizing clients with what changed since their last sync
+
+    Without since only the current cursor is returned, a client reads all data once
+    and then keeps asking for the changes since the last cursor it got. Each change
+    tells the entity type, its key and if it was deleted. The client reads changed
+    entities through the other APIs, sheets in one request through /api/sheets.
+
+    Deletions are only kept for a while. If the cursor is older than the deletions
+    kept, the response has full set and only the current cursor, the client must
+    then read all data again as if it had not synchronized before.
+    """
+
+    @authenticated_user
+    @gen.coroutine
+    def get(self):
+        try:
+            user = self.user()
+            since = self.get_argument("since", None)
+            if since is None:
+                cursor = yield self.application.async_storage.get_change_cursor(user)
+                self.send_json({ "changes" : [], "cursor" : cursor, "more" : False, "full" : True })
+                return
+
+            try:
+                since = int(since)
+            except ValueError:
+                raise ERROR_INVALID_CURSOR
+
+            changes = yield self.application.async_storage.get_changes(since, CHANGES_PAGE_SIZE, user)
+            # Read after the changes, deletions removed in between move the horizon past since
+            horizon = yield self.application.async_storage.get_change_horizon(user)
+            if since < horizon:
+                cursor = yield self.application.async_storage.get_change_cursor(user)
+                self.send_json({ "changes" : [], "cursor" : cursor, "more" : False, "full" : True })
+                return
+
+            cursor = changes[-1].id if changes else since
+            self.send_json({ "changes" : changes, "cursor" : cursor,
+                             "more" : len(changes) == CHANGES_PAGE_SIZE, "full" : False })
+        except NotLoggedInError:
+            self.send_json_error(ERROR_NOT_AUTHENTICATED)
+        except ApiError, error:
+            self.send_json_error(error)
+
+# Maximum number of operations in one batch
+BATCH_MAX_OPERATIONS = 500
+
+SUCCESS = { "error" : 0, "message" : "Ok" }
+
+def _value(operation, name, error):
+    value = operation.get(name)
+    if value is None or value == "":
+        raise error
+    return value
+
+def _batch_save_category(storage, operation, user):
+    category = Category(_value(operation, "title", ERROR_NO_CATEGORY_TITLE), id = int(operation.get("id", -1)))
+    if not storage.save_category(category, user):
+        raise ERROR_GENERAL
+    return category
+
+def _batch_delete_category(storage, operation, user):
+    category = storage.get_category(_value(operation, "id", ERROR_NO_CATEGORY_ID), user)
+    if not category or not category.is_empty() or not storage.delete_category(category, user):
+        raise ERROR_GENERAL
+    return SUCCESS
+
+def _batch_save_activity(storage, operation, user):
+    category_id = int(_value(operation, "category", ERROR_NO_CATEGORY_ID))
+    title = _value(operation, "title", ERROR_NO_CATEGORY_TITLE)
+    color = _value(operation, "color", ERROR_NO_ACTIVITY_COLOR)
+    enabled = _value(operation, "enabled", ERROR_NO_ACTIVITY_ENABLED)
+    state = Activity.Disabled if str(enabled).lower() == "false" else Activity.Enabled
+
+    activity = Activity(id = int(operation.get("id", -1)), title = title, category_id = category_id,
+        color = Color(color), state = state)
+    if not storage.save_activity(activity, Category(id = category_id), user):
+        raise ERROR_GENERAL
+    return activity
+
+def _batch_delete_activity(storage, operation, user):
+    if not storage.delete_activity(Activity(id = int(_value(operation, "id", ERROR_NO_ACTIVITY_ID))), user):
+        raise ERROR_GENERAL
+    return SUCCESS
+
+def _batch_update_sheet(storage, operation, user):
+    date = _value(operation, "date", ERROR_INVALID_SHEET_DATE)
+    if not valid_date(date):
+        raise ERROR_INVALID_SHEET_DATE
+    indexes = _value(operation, "indexes", ERROR_NO_INDEXES)
+    if not isinstance(indexes, list):
+        indexes = str(indexes).split(",")
+    activity_id = _activity_id(_value(operation, "activity", ERROR_NO_ACTIVITY_ID))
+
+    quarters = _quarters(indexes, activity_id)
+    _check_activities([activity_id], storage.get_activities(user))
+    quarters, summary, total = storage.update_sheet(extract_date(date), quarters, user)
+    return { "summary" : summary, "total" : total , "quarters" : quarters }
+
+def _batch_save_comment(storage, operation, user):
+    quarter_id = _value(operation, "quarter", ERROR_NO_QUARTER_ID)
+    comment = Comment(comment = _value(operation, "comment", ERROR_NO_COMMENT))
+    if not storage.save_comment(quarter_id, comment, user):
+        raise ERROR_GENERAL
+    return SUCCESS
+
+def _batch_delete_comment(storage, operation, user):
+    storage.delete_comment(_value(operation, "quarter", ERROR_NO_QUARTER_ID), user)
+    return SUCCESS
+
+BATCH_OPERATIONS = {
+    "category.save" : _batch_save_category,
+    "category.delete" : _batch_delete_category,
+    "activity.save" : _batch_save_activity,
+    "activity.delete" : _batch_delete_activity,
+    "sheet.update" : _batch_update_sheet,
+    "comment.save" : _batch_save_comment,
+    "comment.delete" : _batch_delete_comment,
+}
+
+class BatchApiHandler(JsonApiHandler, AuthenticatedHandler):
+    """
+    HTTP API for running many operations in one request
+
+    The operations are given as a JSON list, each an object with the name of the
+    operation in "op" and the same values as the single operation API takes, e.g.
+
+        [{"op": "category.save", "title": "Work"},
+         {"op": "sheet.update", "date": "2013-02-04", "indexes": [32, 33], "activity": 4}]
+
+    All operations are run in order within one storage transaction. The response
+    holds the result of each operation, the same as the single operation API would
+    send. If one operation fails the batch is aborted, nothing is stored and the
+    error tells which operation that failed.
+    """
+
+    @staticmethod
+    def _run_operations(operations, user):
+        def run(storage):
+            results = []
+            for index, operation in enumerate(operations):
+                try:
+                    if not isinstance(operation, dict) or operation.get("op") not in BATCH_OPERATIONS:
+                        raise ERROR_UNKNOWN_OPERATION
+                    results.append(BATCH_OPERATIONS[operation["op"]](storage, operation, user))
+                except ApiError, error:
+                    raise BatchError(index, error)
+                except Exception, e:
+                    logging.exception(e)
+                    raise BatchError(index, ERROR_GENERAL)
+            return results
+        return run
+
+    def _push(self, user, operations, results):
+        """
+        Push the committed sheet and comment changes to the user's other devices
+        """
+        for operation, result in zip(operations, results):
+            if operation["op"] == "sheet.update":
+                self.push_sheet(user, operation["date"], result["quarters"], result["summary"], result["total"])
+            elif operation["op"] == "comment.save":
+                self.push_comment(user, operation["quarter"], operation["comment"])
+            elif operation["op"] == "comment.delete":
+                self.push_comment(user, operation["quarter"])
+
+    @authenticated_user
+    @gen.coroutine
+    def post(self):
+        try:
+            user = self.user()
+            try:
+                operations = json_decode(self.parameter("operations", ERROR_NO_OPERATIONS))
+            except ValueError:
+                raise ERROR_INVALID_OPERATIONS
+            if not isinstance(operations, list):
+                raise ERROR_INVALID_OPERATIONS
+            if len(operations) > BATCH_MAX_OPERATIONS:
+                raise ERROR_TOO_MANY_OPERATIONS
+
+            results = yield self.application.async_storage.run_in_transaction(
+                BatchApiHandler._run_operations(operations, user))
+            self._push(user, operations, results)
+            self.send_json({ "results" : results })
+        except NotLoggedInError:
+            self.send_json_error(ERROR_NOT_AUTHENTICATED)
+        except ApiError, error:
+            self.send_json_error(error)
+
 class CommentHandler(JsonApiHandler, AuthenticatedHandler):
     @authenticated_user
+    @gen.coroutine
     def get(self, quarter_id):
         try:
             user = self.user()
-            comment = self.application.storage.get_comment_for_quarter(quarter_id, user)
+            comment = yield self.application.async_storage.get_comment_for_quarter(quarter_id, user)
             self.send_json(comment)
         except NotLoggedInError:
             self.send_json_error(ERROR_NOT_AUTHENTICATED)
@@ -377,22 +760,27 @@ class CommentHandler(JsonApiHandler, AuthenticatedHandler):
             self.send_json_error(error)
 
     @authenticated_user
+    @gen.coroutine
     def put(self, quarter_id):
         try:
             user = self.user()
             message = self.parameter("comment", ERROR_NO_COMMENT)
             comment = Comment(comment = message)
-            self.application.storage.save_comment(quarter_id, comment, user)
+            saved = yield self.application.async_storage.save_comment(quarter_id, comment, user)
+            if saved:
+                self.push_comment(user, quarter_id, message)
         except NotLoggedInError:
             self.send_json_error(ERROR_NOT_AUTHENTICATED)
         except ApiError, error:
             self.send_json_error(error)
 
     @authenticated_user
+    @gen.coroutine
     def delete(self, quarter_id):
         try:
             user = self.user()
-            self.application.storage.delete_comment(quarter_id, user)
+            yield self.application.async_storage.delete_comment(quarter_id, user)
+            self.push_comment(user, quarter_id)
         except NotLoggedInError:
             self.send_json_error(ERROR_NOT_AUTHENTICATED)
         except ApiError, error:
@@ -15,6 +15,8 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import itertools
+from tornado import gen
 from tornado.options import options
 from base import BaseHandler, AuthenticatedHandler, NoCacheHandler, authenticated_user
 from ..domain import Color, ActivityDict, Quarter, Week, Report
@@ -27,13 +29,14 @@ class ActivityViewHandler(AuthenticatedHandler, NoCacheHandler):
     categories are managed).
     """
     @authenticated_user
+    @gen.coroutine
     def get(self):
-        user = self.get_current_user()
-        categories = self.application.storage.get_categories_and_activities_with_usage(user)
+        user = self.current_user
+        categories = yield self.application.async_storage.get_categories_and_activities_with_usage(user)
         
         self.render(u"../resources/templates/app/activities.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     categories=categories)
 
 
@@ -50,19 +53,21 @@ class TimesheetViewHandler(AuthenticatedHandler, NoCacheHandler):
             quarters.append(Quarter())
         return quarters
 
+    @gen.coroutine
     def _get_list_of_quarters(self, date, activity_dict, user):
         quarters = TimesheetViewHandler._default_sheet()
-        time_sheet = self.application.storage.get_timesheet(date, user)
+        time_sheet = yield self.application.async_storage.get_timesheet(date, user)
         for quarter in time_sheet.quarters:
             quarter.color = Color(activity_dict[int(quarter.activity_id)].color.hex())
             quarter.border_color = Color(activity_dict[int(quarter.activity_id)].color.luminance_color(-0.2).hex())
             quarters[quarter.offset] = quarter
 
-        return quarters
+        raise gen.Return(quarters)
 
     @authenticated_user
+    @gen.coroutine
     def get(self, sheet_date=None):
-        user = self.get_current_user()
+        user = self.current_user
 
         date_obj = None
         today = datetime.date.today()
@@ -74,20 +79,24 @@ class TimesheetViewHandler(AuthenticatedHandler, NoCacheHandler):
             date_obj = today
             sheet_date = today 
 
+        # The page marks today's date
+        if (yield self.not_modified(user, today)):
+            return
+
         yesterday = date_obj - datetime.timedelta(days=1)
         tomorrow = date_obj + datetime.timedelta(days=1)
         weekday = date_obj.strftime("%A")
 
-        categories_and_activities = self.application.storage.get_categories_and_activities(user)
-        activities = self.application.storage.get_activities(user)
+        categories_and_activities = yield self.application.async_storage.get_categories_and_activities(user)
+        activities = yield self.application.async_storage.get_activities(user)
         activity_dict = ActivityDict(activities)
-        quarters = self._get_list_of_quarters(date_obj, activity_dict, user)
+        quarters = yield self._get_list_of_quarters(date_obj, activity_dict, user)
 
         summary, summary_total = summarize_quarters(quarters, activity_dict)
 
         self.render(u"../resources/templates/app/timesheet.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     date=date_obj,
                     weekday=weekday,
                     today=today,
@@ -99,54 +108,102 @@ class TimesheetViewHandler(AuthenticatedHandler, NoCacheHandler):
                     quarters=quarters)
 
 
+# Number of weeks read from storage at a time when streaming a report
+REPORT_WEEKS_PER_READ = 4
+
+# Placeholder in the rendered report page where the weeks are streamed
+REPORT_WEEKS_MARKER = "<!-- report-weeks -->"
+
+
 class ReportViewHandler(BaseHandler, NoCacheHandler):
     """
     Responsible for showing the different reports
+
+    Reports are streamed. The page and the summary, read from the pre-aggregated
+    daily totals, are sent first. Each week is then rendered and flushed as soon
+    as it is read, so only a few weeks are kept in memory regardless of the range.
     """
-    def _generate_report(self, from_date, to_date, user):
-        logging.info("Generating report between dates %s and %s" % (from_date, to_date))
+
+    @staticmethod
+    def _week_starts(from_date, to_date):
+        """
+        Generate the first day of each week covering the given range, reports always
+        cover whole weeks, Monday to Sunday
+        """
+        week_start = from_date - datetime.timedelta(days=from_date.weekday())
+        while week_start <= to_date:
+            yield week_start
+            week_start += datetime.timedelta(days=7)
+
+    @gen.coroutine
+    def _generate_summary(self, from_date, to_date, user):
+        first_day = from_date - datetime.timedelta(days=from_date.weekday())
+        last_day = to_date + datetime.timedelta(days=6 - to_date.weekday())
+        totals = yield self.application.async_storage.get_activity_totals(first_day, last_day, user)
 
         report = Report()
-        from_week = from_date.isocalendar()[1]
-        to_week = to_date.isocalendar()[1]
-        for i in range(from_week, to_week + 1):
-            year = from_date.year
+        report.add_totals(totals)
+        raise gen.Return(report)
 
-            if to_week < from_week:  # Report from dec -> jan
-                year = to_date.year
+    @gen.coroutine
+    def _stream_weeks(self, from_date, to_date, user, activity_dict):
+        logging.info("Generating report between dates %s and %s" % (from_date, to_date))
 
-            week = Week(year, i)
-            for day_time_sheet in week:
-                real_time_sheet = self.application.storage.get_timesheet(day_time_sheet.date, user)
-                week.update_sheet(real_time_sheet)
-            report.add_week(week)
-        return report
+        week_starts = ReportViewHandler._week_starts(from_date, to_date)
+        while True:
+            chunk = list(itertools.islice(week_starts, REPORT_WEEKS_PER_READ))
+            if not chunk:
+                break
+            totals = yield self.application.async_storage.get_daily_totals(chunk[0],
+                chunk[-1] + datetime.timedelta(days=6), user)
+
+            for week_start in chunk:
+                year, week_of_year, weekday = week_start.isocalendar()
+                week = Week(year, week_of_year)
+                for day_time_sheet in week:
+                    if day_time_sheet.date in totals:
+                        day_time_sheet.summarize_counts(totals[day_time_sheet.date])
+                self.write(self.render_string(u"../resources/templates/app/report_week.html",
+                    week=week,
+                    activities=activity_dict))
+                yield gen.maybe_future(self.flush())
 
     @authenticated_user
+    @gen.coroutine
     def get(self):
-        user = self.get_current_user()
+        user = self.current_user
         from_date = self.get_argument("from-date", "")
         to_date = self.get_argument("to-date", "")
         report = None
         error = None
 
-        activities = self.application.storage.get_activities(user)
+        activities = yield self.application.async_storage.get_activities(user)
         activity_dict = ActivityDict(activities)
 
         if from_date or to_date:
             if valid_date(from_date) and valid_date(to_date):
-                report = self._generate_report(extract_date(from_date), extract_date(to_date), user)
+                report = yield self._generate_summary(extract_date(from_date), extract_date(to_date), user)
             else:
                 error = True
-                
-        self.render(u"../resources/templates/app/reports.html",
+
+        page = self.render_string(u"../resources/templates/app/reports.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     from_date=from_date,
                     to_date=to_date,
                     activities=activity_dict,
                     error=error,
-                    report=report)
+                    report=report,
+                    weeks_marker=REPORT_WEEKS_MARKER if report else "")
+        if not report:
+            self.finish(page)
+            return
+
+        head, tail = page.split(REPORT_WEEKS_MARKER, 1)
+        self.write(head)
+        yield gen.maybe_future(self.flush())
+        yield self._stream_weeks(extract_date(from_date), extract_date(to_date), user, activity_dict)
+        self.finish(tail)
 
 
 class ProfileViewHandler(BaseHandler):
@@ -158,5 +215,5 @@ class ProfileViewHandler(BaseHandler):
     def get(self):
         self.render(u"../resources/templates/app/profile.html",
                     options=options,
-                    current_user=self.get_current_user(),
+                    current_user=self.current_user,
                     delete_account_error=None)
@@ -14,81 +14,101 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
+import time
 import functools
 import tornado.web
+from tornado import gen
 from tornado.options import options
-from ..domain import NotLoggedInError, User
+from ..domain import NotLoggedInError
+from ..utils import session_id
+
+# Name of the cookie holding the session id
+SESSION_COOKIE = "session"
 
 
 def authenticated_user(method):
     """
     Decorate methods with this to require that the user be logged in.
+
+    The decorated method may be a coroutine, the user is authenticated without
+    blocking the IOLoop.
     """
     @functools.wraps(method)
+    @gen.coroutine
     def wrapper(self, *args, **kwargs):
-        user = self.get_current_user()
-        if not user or not user.active() or not self.application.storage.authenticate_user(user.id):
+        user = self.current_user
+        authenticated = False
+        if user and user.active():
+            authenticated = yield self.application.async_storage.authenticate_user(user.id)
+        if not authenticated:
             if self.request.method in ("GET", "HEAD"):
                 url = self.get_login_url()
                 self.redirect(url)
                 return
             raise tornado.web.HTTPError(403)
-        return method(self, *args, **kwargs)
+        yield gen.maybe_future(method(self, *args, **kwargs))
     return wrapper
 
 
 def authenticated_admin(method):
     """
     Decorate methods with this to require that user is admin.
+
+    The decorated method may be a coroutine, the user is authenticated without
+    blocking the IOLoop.
     """
     @functools.wraps(method)
+    @gen.coroutine
     def wrapper(self, *args, **kwargs):
-        user = self.get_current_user()
-        if not user or not self.application.storage.authenticate_admin(user.id):
+        user = self.current_user
+        if not user or not user.is_admin():
             raise tornado.web.HTTPError(403)
-        elif not user.is_admin():
+        authenticated = yield self.application.async_storage.authenticate_admin(user.id)
+        if not authenticated:
             raise tornado.web.HTTPError(403)
-        return method(self, *args, **kwargs)
+        yield gen.maybe_future(method(self, *args, **kwargs))
     return wrapper
 
 
-class QuarterUserEncoder(json.JSONEncoder):
-    """
-    JSON encoder for quarterapp's User object
-    """
-    def default(self, obj):
-        if isinstance(obj, User):
-            return {"id": obj.id, "username": obj.username, "password": obj.password, "last_login": obj.last_login, "type": obj.type, "state": obj.state}
-
-
-class QuarterUserDecoder(json.JSONDecoder):
-    """
-    JSON decoder for quarterapp's User object
-    """
-    def decode(self, user_string):
-        user_json = json.loads(user_string)
-        user = User(id=user_json["id"], username=user_json["username"], password=user_json["password"],
-                    last_login=user_json["last_login"], type=user_json["type"], state=user_json["state"])
-        return user
-
-
 class BaseHandler(tornado.web.RequestHandler):
     """
     All handlers in quarterapp should be derived from this handler. Contains utility
     functions regarding logging in and reading options.
     """
+    @gen.coroutine
+    def prepare(self):
+        """
+        Resolve the user of the session once per request, without blocking the IOLoop.
+        Use self.current_user to get the user.
+        """
+        user = None
+        session = self.get_cookie(SESSION_COOKIE)
+        if session:
+            user = yield self.application.async_storage.get_session_user(session)
+        self.current_user = user
+
     def get_current_user(self):
-        user_json = self.get_secure_cookie("user")
-        if not user_json:
-            return None
-        return QuarterUserDecoder().decode(user_json)
+        # Only used if prepare was never run, e.g. for errors raised before it
+        return None
 
+    @gen.coroutine
     def set_current_user(self, user):
+        """
+        Log in the given user by starting a new session, any current session is ended.
+
+        @param user The user to log in, or None to log out
+        """
+        session = self.get_cookie(SESSION_COOKIE)
+        if session:
+            yield self.application.async_storage.delete_session(session)
         if user:
-            self.set_secure_cookie("user", QuarterUserEncoder().encode(user))
+            session = session_id()
+            expires = time.time() + options.session_days * 24 * 60 * 60
+            yield self.application.async_storage.save_session(session, user, int(expires))
+            self.set_cookie(SESSION_COOKIE, session, expires = expires, httponly = True)
         else:
-            self.clear_cookie("user")
+            self.clear_cookie(SESSION_COOKIE)
+        self.current_user = user
     
     def logged_in(self):
         """
@@ -96,12 +116,38 @@ class BaseHandler(tornado.web.RequestHandler):
 
         @return True if logged in, else False
         """
-        user = self.get_secure_cookie("user")
-        if user:
+        if self.current_user:
             return True
         else:
             return False
 
+    @gen.coroutine
+    def not_modified(self, user, *parts):
+        """
+        Tag the response with a strong ETag built from the user's data version and
+        the given parts, and answer with 304 Not Modified if the client already has
+        that version. Only the data version is read, not the data, and it is read
+        from memory unless several processes share the database.
+
+        Args:
+            user - The current user
+            parts - Anything else the response depends on
+
+        Returns:
+            A Future resolving to True if a 304 response was sent, else False
+        """
+        version = yield self.application.async_storage.get_data_version(user)
+        etag = '"%s"' % "-".join(str(part) for part in (user.id, version) + parts)
+        self.set_header("Etag", etag)
+        self.set_header("Cache-Control", "private, no-cache")
+
+        if_none_match = self.request.headers.get("If-None-Match", "")
+        if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+            self.set_status(304)
+            self.finish()
+            raise gen.Return(True)
+        raise gen.Return(False)
+
     def enabled(self, setting):
         """
         Check if the given setting is enabled
@@ -124,7 +170,7 @@ class AuthenticatedHandler(BaseHandler):
         """
         Get the current user as a User object, or raises a NotLoggedInError
         """
-        user = self.get_current_user()
+        user = self.current_user
         if not user:
             raise NotLoggedInError("Unauthorized")
         return user
@@ -0,0 +1,97 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import tornado.web
+import tornado.websocket
+
+from tornado import gen
+from base import BaseHandler
+from ..json_utils import json_encode
+
+class PushChannels(object):
+    """
+    Keeps the open push connections of each user, and sends messages to all of a
+    user's connections. Only to be used from the IOLoop thread.
+    """
+
+    def __init__(self):
+        self._channels = {}
+
+    def subscribe(self, user_id, connection):
+        self._channels.setdefault(user_id, set()).add(connection)
+
+    def unsubscribe(self, user_id, connection):
+        connections = self._channels.get(user_id)
+        if connections:
+            connections.discard(connection)
+            if not connections:
+                del self._channels[user_id]
+
+    def publish(self, user, message):
+        """
+        Send the given message to all of the user's open connections. The message is
+        encoded once, nothing is done if the user has no connections.
+
+        @param user The user whose data changed
+        @param message The message structure, encoded as JSON
+        """
+        connections = self._channels.get(user.id)
+        if not connections:
+            return
+        data = json_encode(message)
+        for connection in list(connections):
+            try:
+                connection.write_message(data)
+            except tornado.websocket.WebSocketClosedError:
+                self.unsubscribe(user.id, connection)
+
+    def connection_count(self):
+        return sum(len(connections) for connections in self._channels.itervalues())
+
+
+class PushHandler(BaseHandler, tornado.websocket.WebSocketHandler):
+    """
+    WebSocket channel pushing changes of the user's timesheets to every device the
+    user has open, so clients do not have to poll for them. Messages are only sent
+    from the server, each a JSON object with a type:
+
+        {"type": "sheet", "date": ..., "quarters": [...], "summary": [...], "total": ...}
+        {"type": "comment", "quarter": ..., "comment": ...}
+        {"type": "comment", "quarter": ..., "deleted": true}
+    """
+
+    @gen.coroutine
+    def prepare(self):
+        yield super(PushHandler, self).prepare()
+        user = self.current_user
+        authenticated = False
+        if user and user.active():
+            authenticated = yield self.application.async_storage.authenticate_user(user.id)
+        if not authenticated:
+            raise tornado.web.HTTPError(403)
+        self.user_id = user.id
+
+    def open(self):
+        logging.info("Push channel opened for user %s", self.user_id)
+        self.application.push.subscribe(self.user_id, self)
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        self.application.push.unsubscribe(self.user_id, self)
@@ -0,0 +1,57 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+JSON encoding of quarterapp objects.
+
+Domain objects provide their own plain dictionary views through a to_json method,
+so structures are encoded in a single pass by the underlying (C accelerated)
+encoder. simplejson is used when installed, otherwise the standard library json.
+"""
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Name of the encoder backend in use, reported by the JSON micro-benchmark
+JSON_BACKEND = json.__name__
+
+def _to_json(obj):
+    """
+    Encoder fallback for objects that are not plain Python structures
+
+    @param obj The object to convert
+    @return The object's plain dictionary view
+    """
+    try:
+        to_json = obj.to_json
+    except AttributeError:
+        raise TypeError("%r is not JSON serializable" % (obj,))
+    return to_json()
+
+_encoder = json.JSONEncoder(separators=(",", ":"), default=_to_json)
+
+def json_encode(structure):
+    """
+    Encode the given structure as JSON. The structure can contain lists, dictionaries,
+    plain values and any object with a to_json method.
+
+    @param structure The structure to encode
+    @return The JSON encoded string
+    """
+    return _encoder.encode(structure)
@@ -16,11 +16,17 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import time
+import atexit
 import logging
 import tornado.ioloop
 import tornado.web
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import pkg_resources
 
+from tornado import gen
 from tornado.options import options, define
 from settings import QuarterSettings
 from handlers import Http404Handler
@@ -28,6 +34,8 @@ from handlers.app import *
 from handlers.admin import *
 from handlers.api import *
 from handlers.account import *
+from handlers.push import PushChannels, PushHandler
+from email_utils import MailSender
 
 HANDLERS_END_POINT = "quarterapp.handlers"
 STORAGE_END_POINT = "quarterapp.storages"
@@ -35,15 +43,32 @@ VIEWS_END_POINT = "quarterapp.views"
 
 DATABASE_FILE_NAME = "quarterapp.db"
 
+# Number of seconds between removals of expired sessions and old deletions
+SESSION_SWEEP_INTERVAL = 60 * 60
+
+# Number of seconds deletions are kept in the change log, clients that have not
+# synchronized for longer must read all data again
+CHANGE_RETENTION = 30 * 24 * 60 * 60
+
 
 def configure():
     define("base_url", help="Application base URL (including port but not schema")
     define("port", help="Port to listen on", type=int)
+    define("processes", default=1, type=int, help="Number of worker processes sharing the port, 0 for one per CPU. "
+        "With more than one process all caches except the authentication cache are disabled, and pushed changes "
+        "only reach clients connected to the same process")
+    define("debug", default=False, type=bool, help="Run in debug mode, only used with a single process")
     define("cookie_secret", help="Random long hexvalue to secure cookies")
     define("storage", help="Choice of storage (default is SQLite)")
+    define("storage_workers", default=4, type=int, help="Number of threads used for storage calls")
+    define("catalog_cache_size", default=1000, type=int, help="Number of users to cache activities and categories for")
+    define("auth_cache_ttl", default=30, type=int, help="Seconds a user's state is cached when authenticating, 0 disables")
+    define("timesheet_cache_mb", default=8, type=int, help="Memory used to cache timesheets, in megabytes")
+    define("session_days", default=30, type=int, help="Number of days a login session lasts")
     define("compressed_resources", type=bool, help="Use compressed JavaScript and CSS")
     define("mail_host", help="SMTP host name")
     define("mail_port", type=int, help="SMTP port number")
+    define("mail_ssl", type=bool, help="Connect to the SMTP host over TLS, the default for port 465")
     define("mail_user", help="SMTP Authentication username")
     define("mail_password", help="SMTP Authentication password")
     define("mail_sender", help="Email sender address")
@@ -79,21 +104,51 @@ def setup_handlers(application):
 
 
 def setup_storage(application):
+    from storage.executor import AsyncStorage
     if not options.storage:
         logging.info("Using built in SQLite storage")
         from storage.default import DefaultStorage
-        application.storage = DefaultStorage(DATABASE_FILE_NAME)
+        application.storage = DefaultStorage(DATABASE_FILE_NAME, options.catalog_cache_size, options.auth_cache_ttl,
+            options.timesheet_cache_mb, single_process = options.processes == 1)
     else:
         for storage in find_storages():
             logging.info("Looking at %s", storage.name)
             application.storage = storage.plugin
+    application.async_storage = AsyncStorage(application.storage, options.storage_workers)
+
+
+def setup_session_sweep(application):
+    @gen.coroutine
+    def sweep():
+        removed = yield application.async_storage.delete_expired_sessions()
+        logging.info("Removed %d expired sessions", removed or 0)
+        removed = yield application.async_storage.prune_changes(time.time() - CHANGE_RETENTION)
+        logging.info("Removed %d old deletions from the change log", removed or 0)
+
+    tornado.ioloop.PeriodicCallback(sweep, SESSION_SWEEP_INTERVAL * 1000).start()
+
+
+def setup_push(application):
+    application.push = PushChannels()
+
+
+def setup_mail(application):
+    application.mail_sender = MailSender(application.storage, options.mail_host, options.mail_port,
+        options.mail_user, options.mail_password, options.mail_sender, options.mail_ssl)
+    application.mail_sender.start()
+    # Stop the sender before the interpreter tears down the modules it uses
+    atexit.register(application.mail_sender.stop)
 
 
 def setup_settings(application):
     application.quarter_settings = QuarterSettings(application.storage)
 
 
-def quarterapp_main():
+def create_application():
+    """
+    Create the application with its storage, ready to be served. In multi-process mode
+    this is done by each worker process, after it has been forked.
+    """
     application = tornado.web.Application(
         [
             # Account views
@@ -132,7 +187,11 @@ def quarterapp_main():
             (r"/api/activity/([^\/]+)", ActivityApiHandler),
             (r"/api/categories-and-activities/", CategoryAndActivitiesHandler),
             (r"/api/sheet/([^\/]+)", SheetApiHandler),
+            (r"/api/sheets", SheetsApiHandler),
+            (r"/api/changes", ChangesApiHandler),
+            (r"/api/batch", BatchApiHandler),
             (r"/api/comment/([^\/]+)", CommentHandler),
+            (r"/api/push", PushHandler),
 
             (r".*", Http404Handler)
         ],
@@ -141,18 +200,41 @@ def quarterapp_main():
         template_path=None, # Files will be relative to calling file
         cookie_secret=options.cookie_secret,
         gzip=True,
-        debug=True)
+        debug=options.debug and options.processes == 1)
 
     setup_storage(application)
     setup_handlers(application)
     setup_settings(application)
+    setup_session_sweep(application)
+    setup_push(application)
+    setup_mail(application)
+    return application
 
-    logging.info("Starting quarterapp")
-    main_loop = tornado.ioloop.IOLoop.instance()
 
+def migrate_storage():
+    """
+    Bring the built in database up to date before any worker process is forked, so
+    that the workers do not race to migrate it.
+    """
+    if not options.storage:
+        from storage.default import DefaultStorage
+        DefaultStorage(DATABASE_FILE_NAME).close()
+
+
+def quarterapp_main():
     try:
-        application.listen(options.port)
-        main_loop.start()
+        if options.processes == 1:
+            application = create_application()
+            application.listen(options.port)
+        else:
+            migrate_storage()
+            sockets = tornado.netutil.bind_sockets(options.port)
+            tornado.process.fork_processes(options.processes)
+            server = tornado.httpserver.HTTPServer(create_application())
+            server.add_sockets(sockets)
+
+        logging.info("Starting quarterapp")
+        tornado.ioloop.IOLoop.instance().start()
     except KeyboardInterrupt:
         logging.info("Quitting quarterapp")
     except Exception, e:
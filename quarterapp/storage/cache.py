@@ -0,0 +1,188 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A size bounded, least recently used, in-process cache that is safe to use
+    from several threads. Values can optionally expire after a fixed time.
+
+    The cache is bounded either on the number of entries, on the total size of
+    the values, or both.
+
+    Loading a value and storing it in the cache is not atomic. To never store a
+    value that was read before an invalidation, take the cache's generation
+    before reading and give it to put:
+
+        generation = cache.generation
+        value = load()
+        cache.put(key, value, generation)
+
+    A value known to be newer than any value being loaded, e.g. one just
+    written, is stored with update instead.
+    """
+
+    def __init__(self, max_entries = None, ttl = None, max_size = None, sizeof = None):
+        """
+        Args:
+            max_entries: The maximum number of entries kept, 0 disables the cache
+            ttl: The number of seconds a value is kept, or None to keep it until evicted
+            max_size: The maximum total size of the values kept, 0 disables the cache
+            sizeof: Function returning the size of a value, required with max_size
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _full(self):
+        return ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                (self.max_size is not None and self.size > self.max_size))
+
+    def _remove(self, key):
+        expires, value, size = self._entries.pop(key)
+        self.size -= size
+        return expires, value
+
+    def get(self, key, default = None):
+        """
+        Get a cached value and mark it as the most recently used
+
+        Args:
+            key: The key of the value
+
+        Returns:
+            The cached value or the given default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value, size = entry
+            if expires is not None and expires <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+            # Move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def _store(self, key, value):
+        if self.max_entries == 0 or self.max_size == 0:
+            return False
+        if key in self._entries:
+            self._remove(key)
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        size = self.sizeof(value) if self.sizeof else 0
+        self._entries[key] = (expires, value, size)
+        self.size += size
+        while self._entries and self._full():
+            self._remove(next(iter(self._entries)))
+        return key in self._entries
+
+    def put(self, key, value, generation = None):
+        """
+        Store a value, evicting the least recently used values if the cache is full
+
+        Args:
+            key: The key of the value
+            value: The value to store
+            generation: The cache generation from before the value was read
+
+        Returns:
+            True if stored, False if the cache was invalidated since the value was read
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            return self._store(key, value)
+
+    def update(self, key, value):
+        """
+        Store a value that replaces any value currently being loaded, any load
+        started before the update will not be stored.
+
+        Args:
+            key: The key of the value
+            value: The value to store
+        """
+        with self._lock:
+            self.generation += 1
+            self._store(key, value)
+
+    def invalidate(self, key):
+        """
+        Remove the value with the given key, if cached
+        """
+        with self._lock:
+            self.generation += 1
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_if(self, predicate):
+        """
+        Remove all cached values for which the given predicate returns True
+
+        Args:
+            predicate: A function called with the key and value of each cached value
+        """
+        with self._lock:
+            self.generation += 1
+            keys = [key for key, (expires, value, size) in self._entries.iteritems() if predicate(key, value)]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        """
+        Remove all cached values
+        """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Get the cache statistics
+
+        Returns:
+            A dictionary with the number of entries, the max number of entries,
+            the total size and max size of the values, the number of hits and
+            misses and the number of cached values that were invalidated
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "size": self.size, "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations}
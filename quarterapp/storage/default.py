@@ -14,94 +14,70 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
 import sys
 import sqlite3
 import logging
+import copy
+import time
+import threading
+import contextlib
+import functools
 
 from exceptions import NotImplementedError
-from ..domain import User, Color, TimeSheet, Quarter, Comment, UserState, UserType
+from ..domain import User, Color, ActivityDict, TimeSheet, Quarter, Comment, Change, Mail, UserState, UserType, QUARTERS_PER_DAY
+from ..utils import extract_date, summarize_activity_counts
 from storage import *
+from migrations import migrate
+from encoding import pack_activities, unpack_activities, pack_comments, unpack_comments
+from cache import LRUCache
+from writer import GroupCommitWriter
 
-initializing_sql = """
-    PRAGMA foreign_keys = ON;
-
-    CREATE TABLE `users` (
-        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-        `username` VARCHAR(256) NOT NULL DEFAULT '',
-        `password` VARCHAR(90) NOT NULL DEFAULT '',
-        `salt` VARCHAR(256) NOT NULL DEFAULT '',
-        `type` TINYINT NOT NULL DEFAULT '0',
-        `state`  TINYINT NOT NULL DEFAULT '0',
-        `last_login` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        `reset_code` VARCHAR(64),
-        UNIQUE(`username`)
-        );
-
-    CREATE TABLE `signups` (
-        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-        `username` VARCHAR(256) NOT NULL DEFAULT '',
-        `activation_code` VARCHAR(64) NOT NULL DEFAULT '',
-        `ip` VARCHAR(39) NOT NULL DEFAULT '',
-        `signup_time` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(`username`)
-        );
-
-    CREATE TABLE `settings` (
-        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-        `name` TEXT NOT NULL,
-        `value` TEXT NOT NULL,
-        UNIQUE(`name`)
-        );
-
-    CREATE TABLE `categories` (
-        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-        `user` INTEGER NOT NULL,
-        `title` TEXT NOT NULL DEFAULT '',
-        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE
-        );
-
-    CREATE TABLE `activities` (
-        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-        `category` INTEGER NOT NULL,
-        `user` INTEGER NOT NULL,
-        `title` TEXT NOT NULL DEFAULT '',
-        `color` VARCHAR(32) NOT NULL DEFAULT '',
-        `state` TINYINT(1) NOT NULL DEFAULT '0',
-        `meta` TEXT NOT NULL DEFAULT '',
-        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE,
-        FOREIGN KEY(category) REFERENCES categories(id) ON DELETE CASCADE
-        );
-
-    CREATE TABLE `quarters` (
-        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-        `user` INTEGER NOT NULL,
-        `date` DATE NOT NULL,
-        `offset` INTEGER NOT NULL,
-        `activity` INTEGER NOT NULL,
-        `comment` INTEGER NOT NULL DEFAULT '0',
-        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE,
-        FOREIGN KEY(activity) REFERENCES activities(id) ON DELETE CASCADE
-        );
-
-    CREATE TABLE `comments` (
-        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-        `user` INTEGER NOT NULL,
-        `comment` TEXT NOT NULL,
-        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE
-        );
-
-    /* Insert default settings */
-    INSERT INTO settings (`name`, `value`) VALUES("allow-signups", "1");
-    INSERT INTO settings (`name`, `value`) VALUES("allow-activations", "1");
-
-    /*
-        Insert default administrator account
-        Username: one@example.com
-        Password: 123qweASD
-    */
-    INSERT INTO users (`username`, `password`, `salt`, `type`, `state`) VALUES("one@example.com", "MYlkZO_QWaMjtCTJd76FJg--87ixaKBIoq7iKxjrOlLf358FqGuny4jbVUn5PeGmQoci4MOc_e5sBuLL2QN4UA==", "one@example.com", 1, 1);
-"""
+# Number of users whose activities and categories are kept in memory
+DEFAULT_CATALOG_CACHE_SIZE = 1000
+
+# Number of seconds a user's state is trusted before it is read again when authenticating
+DEFAULT_AUTH_CACHE_TTL = 30
+
+# Number of users whose state is kept in memory for authentication
+AUTH_CACHE_SIZE = 10000
+
+# Number of sessions kept in memory
+SESSION_CACHE_SIZE = 10000
+
+# Number of users whose data version is kept in memory
+DATA_VERSION_CACHE_SIZE = 10000
+
+# Memory used to cache timesheets, in megabytes
+DEFAULT_TIMESHEET_CACHE_MB = 8
+
+# Estimated memory used by a cached timesheet, besides its packed quarters and comments
+TIMESHEET_CACHE_ENTRY_OVERHEAD = 250
+
+# Number of seconds to wait for another connection's write lock before giving up
+BUSY_TIMEOUT = 10
+
+# Number of times a statement that timed out waiting for a lock is retried, and the
+# delay in seconds before the first retry (doubled for each retry)
+BUSY_RETRIES = 3
+BUSY_RETRY_DELAY = 0.05
+
+# Number of seconds the writer waits for more writes to commit together. Writes
+# queued while the previous group is committed are always run together, waiting
+# longer only adds latency when few clients write (see benchmarks/write_benchmark.py).
+GROUP_COMMIT_WINDOW = 0
+
+def mutation(method):
+    """
+    Decorate storage methods that write with this, to run them on the writer thread.
+    A method called by another write, or within a transaction, runs right away.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._writer is None or self._writer.on_writer_thread() or self._in_transaction:
+            return method(self, *args, **kwargs)
+        return self._writer.submit(method, self, *args, **kwargs)
+    wrapper.mutation = True
+    return wrapper
 
 class Data(dict):
     def __getattr__(self, name):
@@ -113,21 +89,213 @@ class Data(dict):
 class DefaultStorage(Storage):
     """
     The default storage for quarterapp is a SQLite database.
+
+    The storage can be used from several threads at once, each thread gets a
+    connection of its own. An in-memory database cannot be shared between
+    connections, so it uses one connection for all threads.
+
+    Each user's activities and categories (the catalog) are cached in memory,
+    the cache is invalidated whenever an activity or category is changed. The
+    state and type of authenticated users are cached for a short time, a change
+    of user state or type takes effect at once within the process making it, and
+    within the cache's time to live in other processes. Sessions are stored in the
+    database and the most recently used are kept in memory, and so are the most
+    recently used timesheets. Cached timesheets are updated as they are written.
+
+    A database file is used in WAL mode, so that readers never wait for writers,
+    and write transactions take the write lock at once. A connection waits for
+    a lock held by another connection, and statements that still find the database
+    locked are retried. This way several processes can share the database, but
+    each process's caches would then miss the other processes' writes. Such caches
+    are disabled unless the storage is used by a single process, except for the
+    short lived authentication cache.
+
+    All writes to a database file are run by a single writer thread. Writes queued
+    by concurrent callers are committed together, each within a savepoint of its
+    own so that a failing write is rolled back without affecting the others.
     """
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, catalog_cache_size = DEFAULT_CATALOG_CACHE_SIZE, auth_cache_ttl = DEFAULT_AUTH_CACHE_TTL,
+            timesheet_cache_mb = DEFAULT_TIMESHEET_CACHE_MB, single_process = True, group_commit = True):
         """
         Construct the default storage and initialize the SQLite database
 
         @param file_name The path and file name for the database file
+        @param catalog_cache_size The number of users to cache activities and categories for
+        @param auth_cache_ttl The number of seconds to cache a user's state for, 0 disables the cache
+        @param timesheet_cache_mb The memory used to cache timesheets in megabytes, 0 disables the cache
+        @param single_process False if other processes write to the same database file
+        @param group_commit False to let each thread commit its own writes
         """
-        
-        # If the database file does not exist, create tables as well
-        existing_db = os.path.isfile(file_name)
-        self.conn = sqlite3.connect(file_name)
-        
-        if not existing_db:
-            self.execute_sql(initializing_sql)
+        self.file_name = file_name
+        if not single_process:
+            catalog_cache_size = timesheet_cache_mb = 0
+        self._catalog_cache = LRUCache(catalog_cache_size)
+        self._auth_cache = LRUCache(AUTH_CACHE_SIZE if auth_cache_ttl > 0 else 0, ttl = auth_cache_ttl)
+        self._session_cache = LRUCache(SESSION_CACHE_SIZE if single_process else 0)
+        self._sheet_cache = LRUCache(max_size = int(timesheet_cache_mb * 1024 * 1024),
+            sizeof = lambda entry: TIMESHEET_CACHE_ENTRY_OVERHEAD + len(entry[2] or "") + len(entry[3]))
+        self._data_versions = LRUCache(DATA_VERSION_CACHE_SIZE if single_process else 0)
+        self._commit_lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._shared_conn = None
+
+        if file_name == ":memory:":
+            self._shared_conn = self._connect()
+        migrate(self.conn)
+
+        # An in-memory database has a single connection, that cannot be given to a writer
+        self._writer = None
+        if group_commit and not self._shared_conn:
+            self._writer = GroupCommitWriter(self._run_group, GROUP_COMMIT_WINDOW)
+
+    def _connect(self):
+        # Connections are only used by the thread opening them, but closed by any thread.
+        # Transactions begin with the write lock, a transaction that first read and then
+        # tries to write could otherwise fail at once if another connection is writing.
+        conn = sqlite3.connect(self.file_name, timeout = BUSY_TIMEOUT, check_same_thread = False,
+            isolation_level = "IMMEDIATE")
+        if self.file_name != ":memory:":
+            conn.execute("PRAGMA journal_mode = WAL;")
+        # Enforced on every connection, whoever created the database file
+        conn.execute("PRAGMA foreign_keys = ON;")
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    @property
+    def conn(self):
+        """
+        The database connection for the calling thread
+        """
+        if self._shared_conn:
+            return self._shared_conn
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @property
+    def _transaction_depth(self):
+        return getattr(self._local, "transaction_depth", 0)
+
+    @_transaction_depth.setter
+    def _transaction_depth(self, depth):
+        self._local.transaction_depth = depth
+
+    @property
+    def _in_group(self):
+        return getattr(self._local, "group", False)
+
+    @property
+    def _in_transaction(self):
+        """
+        True if statements of the calling thread are not committed at once
+        """
+        return self._transaction_depth > 0 or self._in_group
+
+    def _run_group(self, jobs):
+        """
+        Run the given writes on the writer thread as a single transaction. Each write
+        runs within a savepoint, a write that raises is rolled back alone. Nothing is
+        committed unless the commit succeeds for all.
+        """
+        conn = self.conn
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None  # Transactions are handled explicitly
+        try:
+            # Another process may hold the write lock
+            self._retry_when_busy(lambda: conn.execute("BEGIN IMMEDIATE;"))
+            self._local.group = True
+            self._local.on_commit = []
+            try:
+                for job in jobs:
+                    with self._savepoint(swallow = True):
+                        job.run()
+                        if job.error:
+                            raise job.error[0], job.error[1], job.error[2]
+                with self._commit_lock:
+                    conn.execute("COMMIT;")
+                    self._run_on_commit()
+            except:
+                error = sys.exc_info()
+                try:
+                    conn.execute("ROLLBACK;")
+                except sqlite3.Error:
+                    # SQLite may already have rolled back, keep the original error
+                    logging.error("Could not roll back group of writes: %s", sys.exc_info()[1])
+                raise error[0], error[1], error[2]
+        finally:
+            self._local.group = False
+            self._local.on_commit = []
+            conn.isolation_level = isolation_level
+
+    def submit_write(self, method, *args, **kwargs):
+        """
+        Queue a call to a method marked with @mutation on the writer, without waiting
+        for it
+
+        @param method The bound method to call
+        @return A Future resolved with the method's result once committed, or None if
+                writes are not queued, in which case the caller has to call the method
+        """
+        if self._writer is None:
+            return None
+        return self._writer.submit_async(method, *args, **kwargs)
+
+    @contextlib.contextmanager
+    def _savepoint(self, swallow = False):
+        """
+        Run the block within a savepoint of the writer's transaction, the savepoint is
+        rolled back together with its commit callbacks if the block raises
+
+        @param swallow True to not raise the exception again
+        """
+        callbacks = len(self._local.on_commit)
+        self.conn.execute("SAVEPOINT write;")
+        try:
+            yield
+        except:
+            self.conn.execute("ROLLBACK TO write;")
+            self.conn.execute("RELEASE write;")
+            del self._local.on_commit[callbacks:]
+            if not swallow:
+                raise
+        else:
+            self.conn.execute("RELEASE write;")
+
+    def _run_on_commit(self):
+        callbacks = getattr(self._local, "on_commit", [])
+        self._local.on_commit = []
+        for callback in callbacks:
+            callback()
+
+    @staticmethod
+    def _busy(error):
+        return isinstance(error, sqlite3.OperationalError) and "locked" in str(error)
+
+    def _retry_when_busy(self, function):
+        """
+        Call the given function, and call it again if the database was locked by another
+        connection for longer than the busy timeout. Statements within a transaction are
+        never retried, the whole transaction has to be.
+
+        @param function The function to call
+        @return The value returned by the function
+        """
+        attempt = 0
+        while True:
+            try:
+                return function()
+            except sqlite3.OperationalError, e:
+                if self._in_transaction or not self._busy(e) or attempt == BUSY_RETRIES:
+                    raise
+                self.conn.rollback()
+                logging.warning("Database is locked, retrying")
+                time.sleep(BUSY_RETRY_DELAY * 2 ** attempt)
+                attempt += 1
 
     def execute_sql(self, sql):
         """
@@ -145,24 +313,94 @@ class DefaultStorage(Storage):
                 logging.error("Could not execute SQL statement %s", stmt)
                 raise
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group all statements executed within the block into a single transaction
+        that is committed when the (outermost) block exits, or rolled back if an
+        exception is raised. Blocks can be nested. On the writer thread the block is
+        a savepoint within the writer's transaction.
+        """
+        if self._in_group and self._transaction_depth == 0:
+            with self._savepoint():
+                self._transaction_depth += 1
+                try:
+                    yield
+                finally:
+                    self._transaction_depth -= 1
+            return
+
+        self._transaction_depth += 1
+        try:
+            yield
+        except:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.conn.rollback()
+                self._local.on_commit = []
+            raise
+        self._transaction_depth -= 1
+        if self._transaction_depth == 0:
+            # Callbacks update caches, run them in the order of the commits
+            with self._commit_lock:
+                self.conn.commit()
+                self._run_on_commit()
+
+    def _on_commit(self, callback):
+        """
+        Run the given callback once the current transaction is committed, or at once
+        if there is no transaction. The callback is dropped if the transaction is
+        rolled back.
+        """
+        if not self._in_transaction:
+            callback()
+        else:
+            self._local.on_commit = getattr(self._local, "on_commit", []) + [callback]
+
     def execute(self, query, *params):
         """
         Executes a SQL query and return the row id for the affected row.
 
+        If called within a transaction the statement is not committed, and any
+        error is raised to let the transaction roll back.
+
         @param query The SQL to execute
         @param params Any parameters needed to execute the query
         @return The row id for the affected row
         """
-        try:
+        def run():
             cursor = self.conn.cursor()
             cursor.execute(query, params)
-            self.conn.commit()
+            if not self._in_transaction:
+                self.conn.commit()
             return cursor.lastrowid
+
+        try:
+            return self._retry_when_busy(run)
         except:
             logging.error("Could not execute SQL: %s", sys.exc_info())
-            self.conn.rollback()
+            if self._transaction_depth > 0:
+                raise
+            # A failed statement is undone by itself within the writer's transaction
+            if not self._in_group:
+                self.conn.rollback()
         return -1
 
+    def execute_many(self, query, params_list):
+        """
+        Executes the same SQL query once for every set of parameters given.
+
+        @param query The SQL to execute
+        @param params_list A list of parameter tuples
+        """
+        if not params_list:
+            return
+
+        def run():
+            with self.transaction():
+                self.conn.cursor().executemany(query, params_list)
+        self._retry_when_busy(run)
+
     def query(self, query, *params):
         """
         Execute a SQL query and return an array of dict's representing each row
@@ -172,21 +410,43 @@ class DefaultStorage(Storage):
         @param params Any parameters needed to execute the query
         @return An array with the result set
         """
-        cursor = self.conn.cursor()
-        cursor.execute(query, params)
-        cols = [c[0] for c in cursor.description]
-        return [Data(zip(cols, row)) for row in cursor.fetchall()]
+        def run():
+            cursor = self.conn.cursor()
+            cursor.execute(query, params)
+            cols = [c[0] for c in cursor.description]
+            return [Data(zip(cols, row)) for row in cursor.fetchall()]
+        return self._retry_when_busy(run)
 
     def query_rowcount(self, sql, *params):
-        cursor = self.conn.cursor()
-        cursor.execute(sql, params)
-        return cursor.rowcount
+        def run():
+            cursor = self.conn.cursor()
+            cursor.execute(sql, params)
+            return cursor.rowcount
+        return self._retry_when_busy(run)
 
     def close(self):
         """
-        Close connection to database
+        Stop the writer and close all connections to database
         """
-        self.conn.close()
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    @mutation
+    def run_in_transaction(self, function):
+        def run():
+            with self.transaction():
+                return function(self)
+        return self._retry_when_busy(run)
+
+    def cache_stats(self):
+        return {"catalog": self._catalog_cache.stats(), "authentication": self._auth_cache.stats(),
+                "session": self._session_cache.stats(), "timesheet": self._sheet_cache.stats()}
 
     ## Implementation of storage contract
 
@@ -199,6 +459,7 @@ class DefaultStorage(Storage):
             return getattr(result[0], "value")
         return None
 
+    @mutation
     def put_setting(self, name, value):
         return self.execute("UPDATE settings SET value=? WHERE name=? ;", value, name) == 1
 
@@ -206,6 +467,7 @@ class DefaultStorage(Storage):
         users = self.query("SELECT username FROM users WHERE username=?;", username)
         return len(users) < 1
 
+    @mutation
     def save_user(self, user):
         try:
             if user.id == -1:
@@ -217,6 +479,11 @@ class DefaultStorage(Storage):
         except:
             logging.error("Could not save user")
             return False
+        finally:
+            self._invalidate_auth(user.id)
+            self._invalidate_sessions(user.id)
+        if int(user.state) != UserState.Active:
+            self.execute("DELETE FROM sessions WHERE user=?;", user.id)
         return True
 
     def get_user(self, id):
@@ -231,13 +498,30 @@ class DefaultStorage(Storage):
             return User(users[0].username, users[0].id, users[0].password, users[0].type, users[0].state, users[0].last_login)
         return None
 
+    @mutation
     def delete_user(self, user):
-        removed_id = self.execute("DELETE FROM comments WHERE user=?;", user.id)
-        removed_id = self.execute("DELETE FROM quarters WHERE user=?;", user.id)
-        removed_id = self.execute("DELETE FROM activities WHERE user=?;", user.id)
-        removed_id = self.execute("DELETE FROM categories WHERE user=?;", user.id)
-        removed_id = self.execute("DELETE FROM users WHERE id=?;", user.id)
-        return removed_id == user.id
+        # Everything referring to the user goes first, the user row last
+        with self.transaction():
+            self.execute("DELETE FROM outbox WHERE recipient IN (SELECT username FROM users WHERE id=?);", user.id)
+            self.execute("DELETE FROM sessions WHERE user=?;", user.id)
+            self.execute("DELETE FROM changes WHERE user=?;", user.id)
+            self.execute("DELETE FROM change_horizons WHERE user=?;", user.id)
+            self.execute("DELETE FROM data_versions WHERE user=?;", user.id)
+            self.execute("DELETE FROM comments WHERE user=?;", user.id)
+            self.execute("DELETE FROM daily_activity_totals WHERE user=?;", user.id)
+            self.execute("DELETE FROM sheets WHERE user=?;", user.id)
+            self.execute("DELETE FROM activities WHERE user=?;", user.id)
+            self.execute("DELETE FROM categories WHERE user=?;", user.id)
+            removed = self.query_rowcount("DELETE FROM users WHERE id=?;", user.id)
+            self._invalidate_catalog(user)
+            self._invalidate_auth(user.id)
+            self._invalidate_sessions(user.id)
+            belongs_to_user = lambda key, entry: key[0] == int(user.id)
+            self._sheet_cache.invalidate_if(belongs_to_user)
+            self._on_commit(lambda: self._sheet_cache.invalidate_if(belongs_to_user))
+            self._data_versions.invalidate(int(user.id))
+            self._on_commit(lambda: self._data_versions.invalidate(int(user.id)))
+        return removed == 1
 
     def user_count(self):
         users = self.query("SELECT COUNT(*) FROM users;")
@@ -269,16 +553,42 @@ class DefaultStorage(Storage):
             users.append(User(row.username, row.id, row.password, row.type, row.state))
         return users
 
+    def _user_state_and_type(self, user_id):
+        """
+        Get the state and type of the given user, from the cache if possible
+
+        @return A tuple of the user's state and type, or None if there is no such user
+        """
+        user_id = int(user_id)
+        state_and_type = self._auth_cache.get(user_id)
+        if state_and_type is None:
+            generation = self._auth_cache.generation
+            users = self.query("SELECT state, type FROM users WHERE id=?", user_id)
+            if len(users) != 1:
+                return None
+            state_and_type = (users[0].state, users[0].type)
+            if not self._in_transaction:
+                self._auth_cache.put(user_id, state_and_type, generation)
+        return state_and_type
+
+    def _invalidate_auth(self, user_id):
+        """
+        Drop the cached state of the given user, now and once the current transaction has ended
+        """
+        user_id = int(user_id)
+        self._auth_cache.invalidate(user_id)
+        self._on_commit(lambda: self._auth_cache.invalidate(user_id))
+
     def authenticate_user(self, user_id):
-        users = self.query("SELECT state FROM users WHERE id=?", user_id)
-        if len(users) == 1:
-            return users[0].state == UserState.Active
+        state_and_type = self._user_state_and_type(user_id)
+        if state_and_type:
+            return state_and_type[0] == UserState.Active
         return False
         
     def authenticate_admin(self, user_id):
-        users = self.query("SELECT state, type FROM users WHERE id=?", user_id)
-        if len(users) == 1:
-            return users[0].state == UserState.Active and users[0].type == UserType.Administrator
+        state_and_type = self._user_state_and_type(user_id)
+        if state_and_type:
+            return state_and_type[0] == UserState.Active and state_and_type[1] == UserType.Administrator
         return False
 
     def username_for_reset_code(self, code):
@@ -288,6 +598,7 @@ class DefaultStorage(Storage):
             return users[0].username
         return None
 
+    @mutation
     def set_user_reset_code(self, username, reset_code):
         try:
             self.execute("UPDATE users SET reset_code=? WHERE username=?;", reset_code, username)
@@ -295,6 +606,7 @@ class DefaultStorage(Storage):
         except:
             return False
 
+    @mutation
     def reset_password(self, reset_code, new_password):
         try:
             users = self.query("SELECT username FROM users WHERE reset_code=?;", reset_code)
@@ -307,6 +619,7 @@ class DefaultStorage(Storage):
         except:
             return False
 
+    @mutation
     def signup_user(self, email, code, ip):
         result = self.query_rowcount("UPDATE signups SET activation_code=? WHERE username=?;", code, email)
         if result == 0:
@@ -319,14 +632,16 @@ class DefaultStorage(Storage):
             return signups[0].username
         return None
 
+    @mutation
     def activate_user(self, code, password, salt):
         try:
             signups = self.query("SELECT username, activation_code FROM signups WHERE activation_code=?;", code)
             if signups[0].activation_code == code:
                 logging.info("Activating user")
                 self.execute("DELETE FROM signups WHERE activation_code=?;", code)
-                self.execute("INSERT INTO users (username, password, salt, type, state) VALUES(?, ?, ?, ?, ?);",
+                user_id = self.execute("INSERT INTO users (username, password, salt, type, state) VALUES(?, ?, ?, ?, ?);",
                     signups[0].username, password, salt, UserType.Normal, UserState.Active)
+                self._invalidate_auth(user_id)
                 return True
         except Exception, e:
             logging.error("Could not activate user")
@@ -334,8 +649,193 @@ class DefaultStorage(Storage):
             return False
 
 
+    ## Sessions
+
+    def _invalidate_sessions(self, user_id):
+        """
+        Drop the cached sessions of the given user, now and once the current transaction has ended
+        """
+        user_id = int(user_id)
+        belongs_to_user = lambda session_id, session: session[0].id == user_id
+        self._session_cache.invalidate_if(belongs_to_user)
+        self._on_commit(lambda: self._session_cache.invalidate_if(belongs_to_user))
+
+    @mutation
+    def save_session(self, session_id, user, expires):
+        return self.execute("INSERT INTO sessions (id, user, expires) VALUES (?, ?, ?);", session_id, user.id, expires) != -1
+
+    def get_session_user(self, session_id):
+        session = self._session_cache.get(session_id)
+        if session is None:
+            generation = self._session_cache.generation
+            result = self.query("""SELECT users.*, sessions.expires FROM sessions JOIN users ON users.id = sessions.user
+                WHERE sessions.id=?;""", session_id)
+            if len(result) != 1:
+                return None
+            row = result[0]
+            session = (User(row.username, row.id, row.password, row.type, row.state, row.last_login), row.expires)
+            if not self._in_transaction:
+                self._session_cache.put(session_id, session, generation)
+        user, expires = session
+        if expires <= time.time():
+            return None
+        return user
+
+    @mutation
+    def delete_session(self, session_id):
+        self.execute("DELETE FROM sessions WHERE id=?;", session_id)
+        self._session_cache.invalidate(session_id)
+
+    @mutation
+    def delete_expired_sessions(self):
+        now = time.time()
+        with self.transaction():
+            removed = self.query_rowcount("DELETE FROM sessions WHERE expires <= ?;", now)
+        self._session_cache.invalidate_if(lambda session_id, session: session[1] <= now)
+        return removed
+
+
+    ## Data version
+
+    def get_data_version(self, user):
+        version = self._data_versions.get(user.id)
+        if version is None:
+            generation = self._data_versions.generation
+            result = self.query("SELECT version FROM data_versions WHERE user=?;", user.id)
+            version = result[0].version if len(result) == 1 else 0
+            if not self._in_transaction:
+                self._data_versions.put(user.id, version, generation)
+        return version
+
+    def _bump_data_version(self, user):
+        """
+        Change the user's data version, as part of the current transaction
+        """
+        with self.transaction():
+            self.execute("INSERT OR IGNORE INTO data_versions (user, version) VALUES (?, 0);", user.id)
+            self.execute("UPDATE data_versions SET version = version + 1 WHERE user=?;", user.id)
+        self._data_versions.invalidate(user.id)
+        self._on_commit(lambda: self._data_versions.invalidate(user.id))
+
+
+    ## Change log
+
+    def _log_changes(self, user, entity, keys, deleted = False):
+        """
+        Record that the given entities were changed, as part of the current transaction.
+        Any earlier entry for the same entity is replaced, so the log never holds more
+        than the latest change of each entity.
+
+        @param entity The type of entity, one of the Change constants
+        @param keys The keys of the changed entities
+        @param deleted True if the entities were deleted
+        """
+        now = time.time()
+        self.execute_many("INSERT OR REPLACE INTO changes (user, entity, key, deleted, changed) VALUES (?, ?, ?, ?, ?);",
+            [(user.id, entity, str(key), 1 if deleted else 0, now) for key in keys])
+
+    def get_changes(self, since, limit, user):
+        result = self.query("SELECT * FROM changes WHERE user=? AND id>? ORDER BY id LIMIT ?;", user.id, since, limit)
+        return [Change(id = row.id, entity = row.entity, key = row.key, deleted = row.deleted == 1)
+                for row in result]
+
+    def get_change_cursor(self, user):
+        result = self.query("SELECT MAX(id) AS cursor FROM changes WHERE user=?;", user.id)
+        if len(result) == 1 and result[0].cursor is not None:
+            return max(result[0].cursor, self.get_change_horizon(user))
+        return self.get_change_horizon(user)
+
+    def get_change_horizon(self, user):
+        result = self.query("SELECT horizon FROM change_horizons WHERE user=?;", user.id)
+        if len(result) == 1:
+            return result[0].horizon
+        return 0
+
+    @mutation
+    def prune_changes(self, before):
+        with self.transaction():
+            horizons = self.query("SELECT user, MAX(id) AS horizon FROM changes WHERE deleted=1 AND changed<? GROUP BY user;",
+                before)
+            self.execute_many("INSERT OR IGNORE INTO change_horizons (user, horizon) VALUES (?, 0);",
+                [(row.user,) for row in horizons])
+            self.execute_many("UPDATE change_horizons SET horizon = MAX(horizon, ?) WHERE user=?;",
+                [(row.horizon, row.user) for row in horizons])
+            return self.query_rowcount("DELETE FROM changes WHERE deleted=1 AND changed<?;", before)
+
+
+    ## Outbox
+
+    @mutation
+    def queue_mail(self, recipient, message):
+        return self.execute("INSERT INTO outbox (recipient, message, next_attempt, created) VALUES (?, ?, ?, ?);",
+            recipient, message, 0, time.time())
+
+    @mutation
+    def claim_mail(self, now, lease, limit):
+        with self.transaction():
+            result = self.query("SELECT id, recipient, message, attempts FROM outbox WHERE next_attempt <= ? "
+                "ORDER BY id LIMIT ?;", now, limit)
+            self.execute_many("UPDATE outbox SET next_attempt=? WHERE id=?;", [(now + lease, row.id) for row in result])
+        return [Mail(row.id, row.recipient, row.message, row.attempts) for row in result]
+
+    @mutation
+    def mail_sent(self, id):
+        self.execute("DELETE FROM outbox WHERE id=?;", id)
+
+    @mutation
+    def mail_failed(self, id, retry_at, error):
+        self.execute("UPDATE outbox SET attempts=attempts + 1, next_attempt=?, last_error=? WHERE id=?;",
+            retry_at, error, id)
+
+    def mail_queue_stats(self, now):
+        result = self.query("""SELECT COUNT(next_attempt) AS queued,
+            SUM(CASE WHEN next_attempt IS NOT NULL AND attempts > 0 THEN 1 ELSE 0 END) AS retrying,
+            SUM(CASE WHEN next_attempt IS NULL THEN 1 ELSE 0 END) AS failed,
+            MIN(CASE WHEN next_attempt IS NOT NULL THEN created END) AS oldest FROM outbox;""")[0]
+        return {"queued": result.queued, "retrying": result.retrying or 0, "failed": result.failed or 0,
+                "oldest": now - result.oldest if result.oldest is not None else 0}
+
+
     ## Categories
 
+    def _catalog(self, user):
+        """
+        Get the user's categories and activities, from the cache if possible.
+        The cached objects must not be given to callers, return copies.
+
+        @return A tuple of a list with (id, title) per category, a list of Activity objects
+                and a dictionary with the same Activity objects keyed on id
+        """
+        catalog = self._catalog_cache.get(user.id)
+        if catalog is None:
+            generation = self._catalog_cache.generation
+            categories = [(row.id, row.title) for row in
+                self.query("SELECT id, title FROM categories WHERE user=? ORDER BY id;", user.id)]
+            activities = [self._activity_from_row(row) for row in
+                self.query("SELECT * FROM activities WHERE user=? ORDER BY id;", user.id)]
+            catalog = (categories, activities, ActivityDict(activities))
+            # Never cache what might be rolled back
+            if not self._in_transaction:
+                self._catalog_cache.put(user.id, catalog, generation)
+        return catalog
+
+    def _invalidate_catalog(self, user):
+        """
+        Drop the user's cached catalog. It is dropped again once the current transaction
+        has ended, so that a catalog read by another thread before the change was committed
+        is not kept either.
+        """
+        self._catalog_cache.invalidate(user.id)
+        self._on_commit(lambda: self._catalog_cache.invalidate(user.id))
+
+    @staticmethod
+    def _catalog_id(id):
+        try:
+            return int(id)
+        except (TypeError, ValueError):
+            return None
+
+    @mutation
     def save_category(self, category, user):
         try:
             if category.id == -1:
@@ -345,59 +845,64 @@ class DefaultStorage(Storage):
         except:
             logging.error("Could not save category")
             return False
+        finally:
+            self._invalidate_catalog(user)
+        self._bump_data_version(user)
+        self._log_changes(user, Change.Category, [category.id])
         return True
 
     def get_category(self, id, user):
-        categories = self.query("SELECT * FROM categories WHERE id=? AND user=?;", id, user.id)
-        if len(categories) == 1:
-            return Category(categories[0].title, id = categories[0].id, empty = self.is_category_empty(user, id))
+        category_id = self._catalog_id(id)
+        categories, activities, activity_dict = self._catalog(user)
+        for cid, title in categories:
+            if cid == category_id:
+                empty = not any(activity.category_id == cid for activity in activities)
+                return Category(title, id = cid, empty = empty)
         return None
 
+    @mutation
     def delete_category(self, category, user):
         self.execute("DELETE FROM categories WHERE id=? AND user=?;", category.id, user.id)
+        self._invalidate_catalog(user)
+        self._bump_data_version(user)
+        self._log_changes(user, Change.Category, [category.id], deleted = True)
         return True
         
     def category_count(self, user):
-        categories = self.query("SELECT COUNT(*) FROM categories WHERE user=?;", user.id)
-        if len(categories) > 0:
-            return getattr(categories[0], "COUNT(*)")
-        else:
-            return 0
+        categories, activities, activity_dict = self._catalog(user)
+        return len(categories)
 
     def get_categories(self, user):
-        categories = []
-        result = self.query("SELECT * FROM categories WHERE user=?;", user.id)
-        for row in result:
-            categories.append(Category(row.title, id = row.id, empty = self.is_category_empty(user, row.id)))
-        return categories
+        categories, activities, activity_dict = self._catalog(user)
+        used = set(activity.category_id for activity in activities)
+        return [Category(title, id = cid, empty = cid not in used) for cid, title in categories]
 
     def get_categories_and_activities(self, user):
         categories = self.get_categories(user)
+        activities_by_category = {}
+        for activity in self.get_activities(user):
+            activities_by_category.setdefault(activity.category_id, []).append(activity)
         for cat in categories:
-            activities = self.get_activities_for_category(cat, user)
-            setattr(cat, 'activities', activities)
+            setattr(cat, 'activities', activities_by_category.get(cat.id, []))
         return categories
 
     def get_categories_and_activities_with_usage(self, user):
-        categories = self.get_categories(user)
+        categories = self.get_categories_and_activities(user)
+        usage = self._quarter_counts(user)
         for cat in categories:
-            activities = self.get_activities_for_category(cat, user)
-            setattr(cat, 'activities', activities)
-            for act in activities:
-                act.usage = self._quarter_count(act.id, user)
-
+            for act in cat.activities:
+                act.usage = usage.get(act.id, 0)
         return categories
 
-    def is_category_empty(self, user, category_id):
-        activities = self.query("SELECT COUNT(*) FROM activities WHERE category=?;", category_id)
-        if len(activities) >0:
-            return getattr(activities[0], "COUNT(*)") == 0
-        else:
-            return True
-
 
     ## Activities
 
+    @staticmethod
+    def _activity_from_row(row):
+        return Activity(id = row.id, color = Color(row.color), title = row.title,
+            state = row.state, meta = row.meta, category_id = row.category)
+
+    @mutation
     def save_activity(self, activity, category, user):
         try:
             if activity.id == -1:
@@ -409,118 +914,319 @@ class DefaultStorage(Storage):
         except:
             logging.error("Could not save activity: %s", sys.exc_info())
             return False
+        finally:
+            self._invalidate_catalog(user)
+        self._bump_data_version(user)
+        self._log_changes(user, Change.Activity, [activity.id])
         return True
 
     def get_activity(self, id, user):
-        activities = self.query("SELECT * FROM activities WHERE id=? AND user=?;", id, user.id)
-        if len(activities) == 1:
-            return Activity(id = activities[0].id, color = Color(activities[0].color), title = activities[0].title,
-                state =activities[0].state, meta = activities[0].meta, category_id = activities[0].category)
+        categories, activities, activity_dict = self._catalog(user)
+        activity = activity_dict.get(self._catalog_id(id))
+        if activity:
+            return copy.copy(activity)
         return None
 
     def activity_count(self, user):
-        activities = self.query("SELECT COUNT(*) FROM activities WHERE user=?;", user.id)
-        if len(activities) > 0:
-            return getattr(activities[0], "COUNT(*)")
-        else:
-            return 0
+        categories, activities, activity_dict = self._catalog(user)
+        return len(activities)
 
     def activity_count_for_category(self, category, user):
-        activities = self.query("SELECT COUNT(*) FROM activities WHERE user=? AND category=?;", user.id, category.id)
-        if len(activities) > 0:
-            return getattr(activities[0], "COUNT(*)")
-        else:
-            return 0
+        return len(self.get_activities_for_category(category, user))
 
+    @mutation
     def delete_activity(self, activity, user):
-        self.execute("DELETE FROM activities WHERE id=? AND user=?;", activity.id, user.id)
+        # Sheets hold activity ids as integers, an id given as a string would match none
+        activity_id = self._catalog_id(activity.id)
+        if activity_id is None:
+            return False
+        try:
+            with self.transaction():
+                self._erase_activity_from_sheets(activity_id, user)
+                self.execute("DELETE FROM daily_activity_totals WHERE activity=? AND user=?;", activity_id, user.id)
+                self.execute("DELETE FROM activities WHERE id=? AND user=?;", activity_id, user.id)
+                self._invalidate_catalog(user)
+                self._bump_data_version(user)
+                self._log_changes(user, Change.Activity, [activity_id], deleted = True)
+        except:
+            logging.error("Could not delete activity")
+            return False
         return True
 
     def get_activities(self, user):
-        activities = []
-        result = self.query("SELECT * FROM activities WHERE user=?;", user.id)
-        for row in result:
-            activities.append(Activity(id = row.id, color = Color(row.color),
-                title = row.title, state = row.state, meta = row.meta, category_id = row.category))
-        return activities
+        categories, activities, activity_dict = self._catalog(user)
+        return [copy.copy(activity) for activity in activities]
 
     def get_activities_for_category(self, category, user):
-        activities = []
-        result = self.query("SELECT * FROM activities WHERE category=? AND user=?;", category.id, user.id)
-        for row in result:
-            activities.append(Activity(id = row.id, color = Color(row.color),
-                title = row.title, state = row.state, meta = row.meta, category_id = row.category))
-        return activities
+        category_id = self._catalog_id(category.id)
+        categories, activities, activity_dict = self._catalog(user)
+        return [copy.copy(activity) for activity in activities if activity.category_id == category_id]
 
 
     ## Time sheet
 
-    def _quarter_count(self, activity_id, user):
-        quarters = self.query("SELECT COUNT(*) FROM quarters WHERE activity=? AND user=?;", activity_id, user.id)
-        if len(quarters) > 0:
-            return getattr(quarters[0], "COUNT(*)")
-        else:
-            return 0
+    def _quarter_counts(self, user):
+        """
+        Get the number of quarters registered per activity for the given user
 
-    def _add_quarter(self, date, quarter, user):
-        try:
-            if quarter.id == -1:
-                quarter.id = self.execute("INSERT INTO quarters (offset, activity, date, user) VALUES (?, ?, ?, ?);",
-                    quarter.offset, quarter.activity_id, date, user.id)
+        @return A dictionary with the quarter count keyed on activity id
+        """
+        result = self.query("SELECT activity, SUM(quarters) AS usage FROM daily_activity_totals WHERE user=? GROUP BY activity;", user.id)
+        return dict((row.activity, row.usage) for row in result)
+
+    def _get_sheet(self, date, user):
+        """
+        Get the stored sheet for the given date
+
+        @return A TimeSheet, or None if nothing is registered for the date
+        """
+        key = (user.id, str(date))
+        entry = self._sheet_cache.get(key)
+        if entry is None:
+            generation = self._sheet_cache.generation
+            result = self.query("SELECT * FROM sheets WHERE date=? AND user=?;", date, user.id)
+            if len(result) == 1:
+                entry = self._sheet_entry(result[0])
             else:
-                self.execute("UPDATE quarters SET activity=? WHERE id=? AND user=?;",
-                    quarter.activity_id, quarter.id, user.id)
-        except Exception, e:
-            logging.error("Could not save quarter")
-            logging.exception(e)
-        return quarter.id
+                entry = (-1, str(date), None, "")
+            if not self._in_transaction:
+                self._sheet_cache.put(key, entry, generation)
+        return self._sheet_from_entry(entry)
 
-    def _get_quarter(self, date, offset, user):
-        quarter = None
-        result = self.query("SELECT * FROM quarters WHERE date=? AND offset=? AND user=?;", date, offset, user.id)
-        if len(result) > 0:
-            row = result[0]
-            quarter = Quarter(id = row.id, offset = row.offset, activity_id = row.activity, comment_id = row.comment)
-        return quarter
+    @staticmethod
+    def _sheet_entry(row):
+        """
+        The cached form of a sheet, a tuple of id, date, packed activities and packed comments
+        """
+        return (row.id, row.date, str(row.activities), row.comments)
+
+    @staticmethod
+    def _sheet_from_entry(entry):
+        id, date, activities, comments = entry
+        if id == -1:
+            return None
+        return TimeSheet(date = extract_date(date), activities = unpack_activities(activities),
+            comments = unpack_comments(comments), id = id)
+
+    def _sheet_from_row(self, row):
+        return self._sheet_from_entry(self._sheet_entry(row))
+
+    def _get_sheet_from_quarter_id(self, quarter_id, user):
+        """
+        Get the stored sheet holding the quarter with the given id
+
+        @return A tuple of the TimeSheet and the quarter offset, the sheet is None if not found
+        """
+        sheet_id, offset = TimeSheet.split_quarter_id(quarter_id)
+        result = self.query("SELECT * FROM sheets WHERE id=? AND user=?;", sheet_id, user.id)
+        if len(result) == 1 and result[0].id > 0:
+            return self._sheet_from_row(result[0]), offset
+        return None, offset
 
     def _get_quarter_from_id(self, id, user):
-        quarter = None
-        result = self.query("SELECT * FROM quarters WHERE id=? AND user=?;", id, user.id)
-        if len(result) == 1:
-            row = result[0]
-            quarter = Quarter(id = row.id, offset = row.offset, activity_id = row.activity, comment_id = row.comment)
-        return quarter
+        sheet, offset = self._get_sheet_from_quarter_id(id, user)
+        if sheet is None or sheet.activities[offset] == -1:
+            return None
+        return Quarter(id = sheet.quarter_id(offset), offset = offset,
+            activity_id = sheet.activities[offset], comment_id = sheet.comments.get(offset, 0))
+
+    def _save_sheet_comments(self, sheet, user):
+        self.execute("UPDATE sheets SET comments=? WHERE id=? AND user=?;", pack_comments(sheet.comments), sheet.id, user.id)
+        self._update_cached_sheet(sheet, user)
+        self._bump_data_version(user)
+
+    def _update_cached_sheet(self, sheet, user):
+        """
+        Update the cached sheet once the current transaction is committed. It is dropped
+        at once so no stale sheet is read within the transaction.
+        """
+        date = str(sheet.date)
+        key = (user.id, date)
+        if sheet.id == -1:
+            entry = (-1, date, None, "")
+        else:
+            entry = (sheet.id, date, str(pack_activities(sheet.activities)), pack_comments(sheet.comments))
+        self._sheet_cache.invalidate(key)
+        self._on_commit(lambda: self._sheet_cache.update(key, entry))
 
-    def _delete_quarter_by_offset(self, date, offset, user):
-        self.execute("DELETE FROM quarters WHERE date=? AND offset=? AND user=?;", date, offset, user.id)
+    def _erase_activity_from_sheets(self, activity_id, user):
+        """
+        Erase all quarters registered on the given activity, including their comments
 
-    def get_timesheet(self, date, user):
-        sheet = TimeSheet(date = date)
-        result = self.query("SELECT * FROM quarters WHERE date=? AND user=?;", date, user.id)
+        @param activity_id The id of the activity, as an integer
+        """
+        dates = self.query("SELECT date FROM daily_activity_totals WHERE activity=? AND user=?;", activity_id, user.id)
+        for row in dates:
+            sheet = self._get_sheet(row.date, user)
+            if sheet is None:
+                continue
+            comment_deletes = []
+            for offset, sheet_activity_id in enumerate(sheet.activities):
+                if sheet_activity_id == activity_id:
+                    sheet.activities[offset] = -1
+                    if sheet.comments.get(offset):
+                        comment_deletes.append((sheet.comments.pop(offset), user.id))
+                        self._log_changes(user, Change.Comment, [sheet.quarter_id(offset)], deleted = True)
+            self.execute_many("DELETE FROM comments WHERE id=? AND user=?;", comment_deletes)
+            self._write_sheet(sheet, user)
+
+    def _write_sheet(self, sheet, user, empty = None):
+        """
+        Write the given sheet as a single row, a sheet without any quarters is removed.
+        The sheet is given an id on first write.
+
+        @param empty True if the sheet is known to be without quarters, None to check it
+        """
+        if empty is None:
+            empty = all(activity_id == -1 for activity_id in sheet.activities)
+        if empty:
+            if sheet.id != -1:
+                self.execute("DELETE FROM sheets WHERE id=? AND user=?;", sheet.id, user.id)
+                self._log_changes(user, Change.Sheet, [sheet.date], deleted = True)
+                sheet.id = -1
+        elif sheet.id == -1:
+            sheet.id = self.execute("INSERT INTO sheets (user, date, activities, comments) VALUES (?, ?, ?, ?);",
+                user.id, sheet.date, pack_activities(sheet.activities), pack_comments(sheet.comments))
+        else:
+            self.execute("UPDATE sheets SET activities=?, comments=? WHERE id=? AND user=?;",
+                pack_activities(sheet.activities), pack_comments(sheet.comments), sheet.id, user.id)
+        if sheet.id != -1:
+            self._log_changes(user, Change.Sheet, [sheet.date])
+        self._update_cached_sheet(sheet, user)
+        self._bump_data_version(user)
+
+    def _update_daily_totals(self, date, totals, user):
+        """
+        Apply the change of quarter count per activity to the day's activity totals
+
+        @param date The date of the changed sheet
+        @param totals Dictionary with the change in quarters keyed on activity id
+        @param user The current user
+        """
+        deltas = [(user.id, date, activity_id, delta) for activity_id, delta in totals.iteritems() if delta != 0]
+        if not deltas:
+            return
+        with self.transaction():
+            self.execute_many("""INSERT OR IGNORE INTO daily_activity_totals (user, date, activity, quarters)
+                VALUES (?, ?, ?, 0);""", [delta[:3] for delta in deltas])
+            self.execute_many("""UPDATE daily_activity_totals SET quarters = quarters + ?
+                WHERE user=? AND date=? AND activity=?;""", [(delta[3],) + delta[:3] for delta in deltas])
+            self.execute("DELETE FROM daily_activity_totals WHERE user=? AND date=? AND quarters <= 0;", user.id, date)
+
+    def get_daily_totals(self, from_date, to_date, user):
+        totals = {}
+        result = self.query("""SELECT date, activity, quarters FROM daily_activity_totals
+            WHERE user=? AND date BETWEEN ? AND ?;""", user.id, from_date, to_date)
         for row in result:
-            sheet.quarters.append(Quarter(id = row.id, offset = row.offset, activity_id = row.activity, comment_id = row.comment))
+            totals.setdefault(extract_date(row.date), {})[row.activity] = row.quarters
+        return totals
+
+    def get_activity_totals(self, from_date, to_date, user):
+        result = self.query("""SELECT activity, SUM(quarters) AS quarters FROM daily_activity_totals
+            WHERE user=? AND date BETWEEN ? AND ? GROUP BY activity;""", user.id, from_date, to_date)
+        return dict((row.activity, row.quarters) for row in result)
+
+    def quarter_count(self):
+        quarters = self.query("SELECT SUM(quarters) AS quarters FROM daily_activity_totals;")
+        if len(quarters) > 0 and quarters[0].quarters:
+            return quarters[0].quarters
+        return 0
+
+    def get_timesheet(self, date, user):
+        sheet = self._get_sheet(date, user)
+        if sheet is None:
+            sheet = TimeSheet(date = date)
         sheet.summarize()
         return sheet
 
-    def add_quarters_to_sheet(self, date, quarters, user):
+    def get_timesheets(self, from_date, to_date, user):
+        sheets = {}
+        result = self.query("SELECT * FROM sheets WHERE user=? AND date BETWEEN ? AND ? ORDER BY date;",
+            user.id, from_date, to_date)
+        for row in result:
+            sheet = self._sheet_from_row(row)
+            sheet.summarize()
+            sheets[sheet.date] = sheet
+        return sheets
+
+    def _add_quarters(self, date, quarters, user):
+        """
+        Write the given quarters to the sheet with the given date
+
+        @return The number of quarters per activity of the day after the write
+        """
+        with self.transaction():
+            sheet = self._get_sheet(date, user)
+            if sheet is None:
+                sheet = TimeSheet(date = extract_date(str(date)))
+            counts = sheet.counts()
+            # Sheets hold activity ids without a foreign key, check them against the catalog
+            categories, activities, activity_dict = self._catalog(user)
+
+            comment_deletes = []
+            totals = {}  # Change of quarter count per activity
+            for quarter in quarters:
+                offset = quarter.offset
+                if offset < 0 or offset >= QUARTERS_PER_DAY:
+                    raise ValueError("Quarter offset out of range: %d" % offset)
+                if quarter.activity_id != -1 and quarter.activity_id not in activity_dict:
+                    raise ValueError("Unknown activity: %s" % quarter.activity_id)
+                current = sheet.activities[offset]
+                if current == quarter.activity_id:
+                    continue
+                totals[current] = totals.get(current, 0) - 1
+                totals[quarter.activity_id] = totals.get(quarter.activity_id, 0) + 1
+                # A new activity will not keep the old quarter's comment
+                if sheet.comments.get(offset):
+                    comment_deletes.append((sheet.comments.pop(offset), user.id))
+                    self._log_changes(user, Change.Comment, [sheet.quarter_id(offset)], deleted = True)
+                sheet.activities[offset] = quarter.activity_id
+
+            for activity_id, change in totals.iteritems():
+                counts[activity_id] = counts.get(activity_id, 0) + change
+
+            if totals:
+                self.execute_many("DELETE FROM comments WHERE id=? AND user=?;", comment_deletes)
+                self._write_sheet(sheet, user, empty = counts.get(-1, 0) == QUARTERS_PER_DAY)
+                totals.pop(-1, None)
+                self._update_daily_totals(date, totals, user)
+
         for quarter in quarters:
-            existing_quarter = self._get_quarter(date, quarter.offset, user)
-            
-            if existing_quarter == None and quarter.activity_id != -1:
-                self._add_quarter(date, quarter, user)
-            elif quarter.activity_id == -1:
-                self._delete_quarter_by_offset(date, quarter.offset, user)
-                if existing_quarter != None:
-                    self._delete_comment_with_id(existing_quarter.comment_id, user)
-            elif existing_quarter.activity_id != quarter.activity_id:
-                self._delete_quarter_by_offset(date, quarter.offset, user)
-                if existing_quarter != None:
-                    self._delete_comment_with_id(existing_quarter.comment_id, user)
-                self._add_quarter(date, quarter, user)
-            elif existing_quarter.offset != quarter.offset:
-                self._add_quarter(date, quarter, user)
+            if quarter.activity_id == -1:
+                quarter.id = -1
+            else:
+                quarter.id = sheet.quarter_id(quarter.offset)
+        return counts
+
+    @mutation
+    def add_quarters_to_sheet(self, date, quarters, user):
+        self._add_quarters(date, quarters, user)
         return quarters
 
+    @mutation
+    def update_sheet(self, date, quarters, user):
+        counts = self._add_quarters(date, quarters, user)
+        categories, activities, activity_dict = self._catalog(user)
+        summary, total = summarize_activity_counts(counts, activity_dict)
+        return quarters, summary, total
+
+    @mutation
+    def update_sheets(self, ranges, user):
+        quarters_by_date = {}
+        for date, time_range in ranges:
+            quarters = quarters_by_date.setdefault(date, [])
+            for offset in xrange(time_range.start, time_range.ends()):
+                quarters.append(Quarter(offset = offset, activity_id = time_range.activity_id))
+
+        counts = {}
+        with self.transaction():
+            for date, quarters in quarters_by_date.iteritems():
+                counts[date] = self._add_quarters(date, quarters, user)
+
+        categories, activities, activity_dict = self._catalog(user)
+        return dict((date, (quarters_by_date[date],) + summarize_activity_counts(day_counts, activity_dict))
+                    for date, day_counts in counts.iteritems())
+
 
     # Comments
 
@@ -535,25 +1241,33 @@ class DefaultStorage(Storage):
             logging.exception(e)
         return None
 
+    @mutation
     def save_comment(self, quarter_id, comment, user):
         try:
-            quarter = self._get_quarter_from_id(quarter_id, user)
-            if quarter.comment_id == 0:
-                comment.id = self.execute("INSERT INTO comments (comment, user) VALUES (?, ?);", comment.comment, user.id)
-                self.execute("UPDATE quarters SET comment=? WHERE id=? AND user=?;", comment.id, quarter_id, user.id)
-            else:
-                self.execute("UPDATE comments SET comment=? WHERE id=? AND user=?;", comment.comment, quarter.comment_id, user.id)
+            with self.transaction():
+                sheet, offset = self._get_sheet_from_quarter_id(quarter_id, user)
+                if sheet is None or sheet.activities[offset] == -1:
+                    return False
+                comment_id = sheet.comments.get(offset, 0)
+                if comment_id == 0:
+                    comment.id = self.execute("INSERT INTO comments (comment, user) VALUES (?, ?);", comment.comment, user.id)
+                    sheet.comments[offset] = comment.id
+                    self._save_sheet_comments(sheet, user)
+                else:
+                    self.execute("UPDATE comments SET comment=? WHERE id=? AND user=?;", comment.comment, comment_id, user.id)
+                    self._bump_data_version(user)
+                self._log_changes(user, Change.Comment, [sheet.quarter_id(offset)])
         except Exception, e:
             logging.error("Could not save comment")
             logging.exception(e)
             return False
         return True
 
+    @mutation
     def delete_comment(self, quarter_id, user):
-        quarter = self._get_quarter_from_id(quarter_id, user)
-        self.execute("DELETE FROM comments WHERE id=? AND user=?;", quarter.comment_id, user.id)
-
-    def _delete_comment_with_id(self, comment_id, user):
-        logging.info("Erasing comment with id: %d" % comment_id)
-        self.execute("DELETE FROM comments WHERE id=? AND user=?;", comment_id, user.id)
-
+        with self.transaction():
+            sheet, offset = self._get_sheet_from_quarter_id(quarter_id, user)
+            comment_id = sheet.comments.pop(offset, 0)
+            self.execute("DELETE FROM comments WHERE id=? AND user=?;", comment_id, user.id)
+            self._save_sheet_comments(sheet, user)
+            self._log_changes(user, Change.Comment, [sheet.quarter_id(offset)], deleted = True)
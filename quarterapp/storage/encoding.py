@@ -0,0 +1,82 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compact encoding of a day's quarters as stored in the sheets table.
+
+The activities of a day are packed as 96 little endian 32-bit integers, one
+per quarter, where -1 marks a quarter without activity. Comments are sparse
+and stored as a text of offset:comment_id pairs, e.g. "12:4,13:9".
+"""
+
+import sys
+from array import array
+
+from ..domain import QUARTERS_PER_DAY
+
+
+def pack_activities(activities):
+    """
+    Pack the activity ids of a day
+
+    @param activities A sequence of 96 activity ids
+    @return The packed activities as a buffer suitable for a BLOB column
+    """
+    packed = array('i', activities)
+    if len(packed) != QUARTERS_PER_DAY:
+        raise ValueError("Expected %d quarters, got %d" % (QUARTERS_PER_DAY, len(packed)))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return buffer(packed.tostring())
+
+
+def unpack_activities(blob):
+    """
+    Unpack the activity ids of a day
+
+    @param blob The packed activities as read from the database
+    @return An array with 96 activity ids
+    """
+    activities = array('i')
+    activities.fromstring(str(blob))
+    if sys.byteorder == "big":
+        activities.byteswap()
+    return activities
+
+
+def pack_comments(comments):
+    """
+    Pack the comment ids of a day
+
+    @param comments Dictionary with comment ids keyed on quarter offset
+    @return The packed comments as string
+    """
+    return ",".join("%d:%d" % (offset, comments[offset]) for offset in sorted(comments) if comments[offset])
+
+
+def unpack_comments(text):
+    """
+    Unpack the comment ids of a day
+
+    @param text The packed comments as read from the database
+    @return Dictionary with comment ids keyed on quarter offset
+    """
+    comments = {}
+    if text:
+        for pair in text.split(","):
+            offset, comment_id = pair.split(":")
+            comments[int(offset)] = int(comment_id)
+    return comments
@@ -0,0 +1,80 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 4
+
+
+class AsyncStorage(object):
+    """
+    Non-blocking facade for any implementation of the Storage contract.
+
+    Every method of the contract is available with the same arguments, but
+    instead of the result a Future is returned. The call itself is made on a
+    bounded pool of worker threads, so a slow query never stalls the IOLoop.
+    Use it from a coroutine:
+
+        sheet = yield self.application.async_storage.get_timesheet(date, user)
+
+    The wrapped storage must be safe to use from several threads, or the pool
+    has to be limited to a single worker.
+
+    A storage that queues its writes itself can take them directly, without a
+    worker thread waiting for each of them. It marks the methods that write with
+    a true "mutation" attribute and implements submit_write(method, *args, **kwargs),
+    returning a Future, or None to have the call made on the pool after all.
+    """
+
+    def __init__(self, storage, max_workers = DEFAULT_WORKERS):
+        """
+        Args:
+            storage: The storage implementation to call
+            max_workers: The maximum number of concurrent storage calls
+        """
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+        if not callable(method):
+            return method
+
+        if getattr(method, "mutation", False) and hasattr(self.storage, "submit_write"):
+            @functools.wraps(method)
+            def submit(*args, **kwargs):
+                future = self.storage.submit_write(method, *args, **kwargs)
+                if future is None:
+                    future = self.executor.submit(method, *args, **kwargs)
+                return future
+        else:
+            @functools.wraps(method)
+            def submit(*args, **kwargs):
+                return self.executor.submit(method, *args, **kwargs)
+
+        # Only look up each method once
+        setattr(self, name, submit)
+        return submit
+
+    def shutdown(self, wait = True):
+        """
+        Stop accepting calls and release the worker threads
+
+        Args:
+            wait: Wait for pending calls to finish
+        """
+        self.executor.shutdown(wait)
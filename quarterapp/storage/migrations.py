@@ -0,0 +1,323 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from encoding import pack_activities, pack_comments
+from ..domain import QUARTERS_PER_DAY
+
+initializing_sql = """
+    CREATE TABLE `users` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `username` VARCHAR(256) NOT NULL DEFAULT '',
+        `password` VARCHAR(90) NOT NULL DEFAULT '',
+        `salt` VARCHAR(256) NOT NULL DEFAULT '',
+        `type` TINYINT NOT NULL DEFAULT '0',
+        `state`  TINYINT NOT NULL DEFAULT '0',
+        `last_login` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        `reset_code` VARCHAR(64),
+        UNIQUE(`username`)
+        );
+
+    CREATE TABLE `signups` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `username` VARCHAR(256) NOT NULL DEFAULT '',
+        `activation_code` VARCHAR(64) NOT NULL DEFAULT '',
+        `ip` VARCHAR(39) NOT NULL DEFAULT '',
+        `signup_time` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(`username`)
+        );
+
+    CREATE TABLE `settings` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `name` TEXT NOT NULL,
+        `value` TEXT NOT NULL,
+        UNIQUE(`name`)
+        );
+
+    CREATE TABLE `categories` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `user` INTEGER NOT NULL,
+        `title` TEXT NOT NULL DEFAULT '',
+        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE
+        );
+
+    CREATE TABLE `activities` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `category` INTEGER NOT NULL,
+        `user` INTEGER NOT NULL,
+        `title` TEXT NOT NULL DEFAULT '',
+        `color` VARCHAR(32) NOT NULL DEFAULT '',
+        `state` TINYINT(1) NOT NULL DEFAULT '0',
+        `meta` TEXT NOT NULL DEFAULT '',
+        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY(category) REFERENCES categories(id) ON DELETE CASCADE
+        );
+
+    CREATE TABLE `quarters` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `user` INTEGER NOT NULL,
+        `date` DATE NOT NULL,
+        `offset` INTEGER NOT NULL,
+        `activity` INTEGER NOT NULL,
+        `comment` INTEGER NOT NULL DEFAULT '0',
+        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY(activity) REFERENCES activities(id) ON DELETE CASCADE
+        );
+
+    CREATE TABLE `comments` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `user` INTEGER NOT NULL,
+        `comment` TEXT NOT NULL,
+        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE
+        );
+
+    /* Insert default settings */
+    INSERT INTO settings (`name`, `value`) VALUES("allow-signups", "1");
+    INSERT INTO settings (`name`, `value`) VALUES("allow-activations", "1");
+
+    /*
+        Insert default administrator account
+        Username: one@example.com
+        Password: 123qweASD
+    */
+    INSERT INTO users (`username`, `password`, `salt`, `type`, `state`) VALUES("one@example.com", "MYlkZO_QWaMjtCTJd76FJg--87ixaKBIoq7iKxjrOlLf358FqGuny4jbVUn5PeGmQoci4MOc_e5sBuLL2QN4UA==", "one@example.com", 1, 1);
+"""
+
+hot_path_indexes_sql = """
+    CREATE INDEX `quarters_user_date_offset` ON `quarters` (`user`, `date`, `offset`);
+    CREATE INDEX `quarters_user_activity` ON `quarters` (`user`, `activity`);
+"""
+
+account_code_indexes_sql = """
+    CREATE INDEX `users_reset_code` ON `users` (`reset_code`);
+    CREATE INDEX `signups_activation_code` ON `signups` (`activation_code`);
+"""
+
+daily_activity_totals_sql = """
+    CREATE TABLE `daily_activity_totals` (
+        `user` INTEGER NOT NULL,
+        `date` DATE NOT NULL,
+        `activity` INTEGER NOT NULL,
+        `quarters` INTEGER NOT NULL DEFAULT '0',
+        PRIMARY KEY(`user`, `date`, `activity`)
+        );
+
+    INSERT INTO daily_activity_totals (`user`, `date`, `activity`, `quarters`)
+        SELECT `user`, `date`, `activity`, COUNT(*) FROM quarters GROUP BY `user`, `date`, `activity`;
+"""
+
+sheets_sql = """
+    CREATE TABLE `sheets` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `user` INTEGER NOT NULL,
+        `date` DATE NOT NULL,
+        `activities` BLOB NOT NULL,
+        `comments` TEXT NOT NULL DEFAULT '',
+        UNIQUE(`user`, `date`),
+        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE
+        );
+"""
+
+sessions_sql = """
+    CREATE TABLE `sessions` (
+        `id` VARCHAR(64) PRIMARY KEY,
+        `user` INTEGER NOT NULL,
+        `expires` INTEGER NOT NULL,
+        FOREIGN KEY(user) REFERENCES users(id) ON DELETE CASCADE
+        );
+
+    CREATE INDEX `sessions_user` ON `sessions` (`user`);
+    CREATE INDEX `sessions_expires` ON `sessions` (`expires`);
+"""
+
+data_versions_sql = """
+    CREATE TABLE `data_versions` (
+        `user` INTEGER PRIMARY KEY,
+        `version` INTEGER NOT NULL DEFAULT '0'
+        );
+"""
+
+changes_sql = """
+    CREATE TABLE `changes` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `user` INTEGER NOT NULL,
+        `entity` VARCHAR(16) NOT NULL,
+        `key` VARCHAR(32) NOT NULL,
+        `deleted` INTEGER NOT NULL DEFAULT '0'
+        );
+
+    CREATE UNIQUE INDEX `changes_entity` ON `changes` (`user`, `entity`, `key`);
+    CREATE INDEX `changes_user` ON `changes` (`user`, `id`);
+"""
+
+outbox_sql = """
+    CREATE TABLE `outbox` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `recipient` VARCHAR(256) NOT NULL,
+        `message` TEXT NOT NULL,
+        `attempts` INTEGER NOT NULL DEFAULT '0',
+        `next_attempt` REAL,
+        `last_error` TEXT,
+        `created` REAL NOT NULL
+        );
+
+    CREATE INDEX `outbox_next_attempt` ON `outbox` (`next_attempt`);
+"""
+
+change_horizons_sql = """
+    ALTER TABLE `changes` ADD COLUMN `changed` REAL NOT NULL DEFAULT '0';
+
+    CREATE INDEX `changes_deleted` ON `changes` (`deleted`, `changed`);
+
+    CREATE TABLE `change_horizons` (
+        `user` INTEGER PRIMARY KEY,
+        `horizon` INTEGER NOT NULL DEFAULT '0'
+        );
+"""
+
+
+def convert_quarters_to_sheets(cursor):
+    """
+    Move all quarters, one row per quarter, into sheets with one row per day
+    """
+    cursor.execute(sheets_sql)
+    cursor.execute("SELECT `user`, `date`, `offset`, `activity`, `comment` FROM quarters ORDER BY `user`, `date`;")
+
+    sheets = []
+    key = None
+    for user, date, offset, activity, comment in cursor.fetchall():
+        if (user, date) != key:
+            key = (user, date)
+            activities = [-1] * QUARTERS_PER_DAY
+            comments = {}
+            sheets.append((user, date, activities, comments))
+        if 0 <= offset < QUARTERS_PER_DAY:
+            activities[offset] = activity
+            if comment:
+                comments[offset] = comment
+
+    cursor.executemany("INSERT INTO sheets (`user`, `date`, `activities`, `comments`) VALUES (?, ?, ?, ?);",
+        [(user, date, pack_activities(activities), pack_comments(comments)) for user, date, activities, comments in sheets])
+    cursor.execute("DROP TABLE quarters;")
+
+
+class Migration(object):
+    """
+    A single versioned change of the database schema. A migration is either
+    a string of SQL statements separated by ';' or a function that is given
+    a cursor to perform the change with.
+    """
+
+    def __init__(self, version, description, sql = None, function = None):
+        self.version = version
+        self.description = description
+        self.sql = sql
+        self.function = function
+
+    def apply(self, cursor):
+        """
+        Apply this migration using the given cursor, no commit is made.
+
+        @param cursor The cursor to execute statements with
+        """
+        if self.sql:
+            for stmt in self.sql.split(';'):
+                if stmt.strip():
+                    cursor.execute(stmt)
+        if self.function:
+            self.function(cursor)
+
+
+# Ordered list of all migrations, never change a released migration - add a new one
+migrations = [
+    Migration(1, "Initial schema", sql = initializing_sql),
+    Migration(2, "Index quarters on timesheet and activity usage lookups", sql = hot_path_indexes_sql),
+    Migration(3, "Index reset and activation codes", sql = account_code_indexes_sql),
+    Migration(4, "Add per day activity totals", sql = daily_activity_totals_sql),
+    Migration(5, "Store quarters as one packed row per day", function = convert_quarters_to_sheets),
+    Migration(6, "Add server side sessions", sql = sessions_sql),
+    Migration(7, "Add per user data versions", sql = data_versions_sql),
+    Migration(8, "Add change log for delta sync", sql = changes_sql),
+    Migration(9, "Add outbox for outgoing mail", sql = outbox_sql),
+    Migration(10, "Add change times and horizons for pruning deletions", sql = change_horizons_sql),
+]
+
+
+def schema_version(conn):
+    """
+    Get the current schema version of the given database. A database created
+    before versioning was introduced is reported as version 1.
+
+    @param conn The database connection
+    @return The schema version, 0 for an empty database
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('schema_version', 'users');")
+    tables = [row[0] for row in cursor.fetchall()]
+    if "schema_version" in tables:
+        cursor.execute("SELECT MAX(version) FROM schema_version;")
+        return cursor.fetchone()[0] or 0
+    elif "users" in tables:
+        return 1
+    return 0
+
+
+def migrate(conn, available = None):
+    """
+    Apply all pending migrations to the database. All pending migrations are
+    applied in one transaction, if any of them fails the database is left
+    untouched and the error is raised.
+
+    @param conn The database connection
+    @param available The list of migrations to consider, defaults to all migrations
+    @return The schema version after migrating
+    """
+    if available is None:
+        available = migrations
+
+    current = schema_version(conn)
+    pending = sorted((m for m in available if m.version > current), key = lambda m: m.version)
+    if not pending:
+        return current
+
+    # Take control of the transaction, the sqlite3 module would otherwise commit
+    # implicitly before every schema change
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE;")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS `schema_version` (
+            `version` INTEGER PRIMARY KEY,
+            `description` TEXT NOT NULL DEFAULT '',
+            `applied` TIMESTAMP DEFAULT CURRENT_TIMESTAMP);""")
+        if current > 0:
+            cursor.execute("INSERT OR IGNORE INTO schema_version (version, description) VALUES (?, ?);",
+                (current, "Existing schema"))
+        for migration in pending:
+            logging.info("Migrating database to version %d: %s", migration.version, migration.description)
+            migration.apply(cursor)
+            cursor.execute("INSERT INTO schema_version (version, description) VALUES (?, ?);",
+                (migration.version, migration.description))
+        cursor.execute("COMMIT;")
+    except:
+        logging.error("Could not migrate database, rolling back")
+        cursor.execute("ROLLBACK;")
+        raise
+    finally:
+        conn.isolation_level = isolation_level
+    return pending[-1].version
@@ -24,6 +24,34 @@ class Storage(object):
     Empty implementation of the Storage contract
     """
 
+    ## Transactions
+
+    def run_in_transaction(self, function):
+        """
+        Call the given function with this storage as its only argument, and make all
+        storage calls it does a single transaction. If the function raises an exception
+        nothing it did is stored and the exception is passed on.
+
+        Args:
+            function: The function to call
+
+        Returns:
+            The value returned by the function
+        """
+        pass
+
+    ## Statistics
+
+    def cache_stats(self):
+        """
+        Get statistics for any in-memory caches used by the storage
+
+        Returns:
+            A dictionary keyed on cache name, each value a dictionary with the
+            number of entries, max entries, hits and misses
+        """
+        pass
+
     ## Settings
 
     def get_all_settings(self):
@@ -290,6 +318,195 @@ class Storage(object):
         pass
 
 
+    ## Sessions
+
+    def save_session(self, session_id, user, expires):
+        """
+        Store a new session for a logged in user
+
+        Args:
+            session_id: The session's unique id
+            user: The user the session belongs to
+            expires: The time the session expires, in seconds since the epoch
+
+        Returns:
+            True on success, else False
+        """
+        pass
+
+    def get_session_user(self, session_id):
+        """
+        Get the user of a session. This is called on every request, so it should not
+        need to read the database for a known session.
+
+        Args:
+            session_id: The session's unique id
+
+        Returns:
+            The User of the session, or None if the session is unknown or has expired
+        """
+        pass
+
+    def delete_session(self, session_id):
+        """
+        Delete a session, the user is logged out at once
+
+        Args:
+            session_id: The session's unique id
+        """
+        pass
+
+    def delete_expired_sessions(self):
+        """
+        Delete all sessions that have expired
+
+        Returns:
+            The number of deleted sessions
+        """
+        pass
+
+
+    ## Data version
+
+    def get_data_version(self, user):
+        """
+        Get the version of the user's data. The version changes whenever the user's
+        timesheets, activities or categories change, and can be used to tell if data
+        sent to a client is still current. This is called often and must be cheap.
+
+        Args:
+            user: The current user
+
+        Returns:
+            The data version as an integer
+        """
+        pass
+
+
+    ## Change log
+
+    def get_changes(self, since, limit, user):
+        """
+        Get the changes made to the user's sheets, comments, activities and categories
+        after the given cursor. Only the latest change of each entity is kept.
+
+        Args:
+            since: The cursor of the last change already seen, 0 for all
+            limit: The maximum number of changes to return
+            user: The current user
+
+        Returns:
+            A list of Change objects ordered by their cursor
+        """
+        pass
+
+    def get_change_cursor(self, user):
+        """
+        Get the cursor of the user's latest change, never before the change horizon
+
+        Args:
+            user: The current user
+
+        Returns:
+            The cursor as an integer, 0 if nothing has changed
+        """
+        pass
+
+    def get_change_horizon(self, user):
+        """
+        Get the cursor of the user's latest deletion that is no longer kept. A client
+        that last synchronized before it has missed deletions and must read all data.
+
+        Args:
+            user: The current user
+
+        Returns:
+            The cursor as an integer, 0 if no deletion has been removed
+        """
+        pass
+
+    def prune_changes(self, before):
+        """
+        Remove the changes telling that entities were deleted, for all users, if the
+        entities were deleted before the given time. The users' change horizons are
+        moved past the removed changes.
+
+        Args:
+            before: The time, in seconds since the epoch, to keep deletions after
+
+        Returns:
+            The number of removed changes
+        """
+        pass
+
+
+    ## Outbox
+
+    def queue_mail(self, recipient, message):
+        """
+        Add a mail to the outbox, to be sent as soon as possible
+
+        Args:
+            recipient: The address to send the mail to
+            message: The complete mail, headers included
+
+        Returns:
+            The id of the queued mail
+        """
+        pass
+
+    def claim_mail(self, now, lease, limit):
+        """
+        Get mails in the outbox that are due to be sent. The returned mails are not
+        returned again by another call until the lease has passed, so that several
+        senders can share the outbox without sending a mail twice.
+
+        Args:
+            now: The current time, in seconds since the epoch
+            lease: Number of seconds the mails are reserved for the caller
+            limit: The maximum number of mails to return
+
+        Returns:
+            A list of Mail objects, oldest first
+        """
+        pass
+
+    def mail_sent(self, id):
+        """
+        Remove a mail that has been sent from the outbox
+
+        Args:
+            id: The id of the sent mail
+        """
+        pass
+
+    def mail_failed(self, id, retry_at, error):
+        """
+        Record a failed attempt to send a mail
+
+        Args:
+            id: The id of the mail
+            retry_at: The time to try again, in seconds since the epoch, or None to give up
+            error: Description of the error
+        """
+        pass
+
+    def mail_queue_stats(self, now):
+        """
+        Get the state of the outbox
+
+        Args:
+            now: The current time, in seconds since the epoch
+
+        Returns:
+            A dictionary with the number of mails waiting to be sent ("queued"), the
+            number of those that have failed at least once ("retrying"), the number of
+            mails given up on ("failed") and the age in seconds of the oldest waiting
+            mail ("oldest")
+        """
+        pass
+
+
     ## Categories
     
     def save_category(self, category, user):
@@ -495,10 +712,68 @@ class Storage(object):
         """
         pass
 
+    def get_timesheets(self, from_date, to_date, user):
+        """
+        Get the TimeSheet objects for all days between the two dates (inclusive) using
+        as few reads as possible. Days without any registered quarters are left out.
+
+        Args:
+            from_date: The first date of the range (a date object)
+            to_date: The last date of the range (a date object)
+            user: The current user
+
+        Returns:
+            A dictionary with TimeSheet objects keyed on their date
+        """
+        pass
+
+    def get_daily_totals(self, from_date, to_date, user):
+        """
+        Get the number of quarters registered per activity and day for all days between
+        the two dates (inclusive). Days without any registered quarters are left out.
+
+        Args:
+            from_date: The first date of the range (a date object)
+            to_date: The last date of the range (a date object)
+            user: The current user
+
+        Returns:
+            A dictionary keyed on date, each value a dictionary with the number of
+            quarters keyed on activity id
+        """
+        pass
+
+    def get_activity_totals(self, from_date, to_date, user):
+        """
+        Get the number of quarters registered per activity for all days between the
+        two dates (inclusive).
+
+        Args:
+            from_date: The first date of the range (a date object)
+            to_date: The last date of the range (a date object)
+            user: The current user
+
+        Returns:
+            A dictionary with the number of quarters keyed on activity id
+        """
+        pass
+
+    def quarter_count(self):
+        """
+        Get the total number of quarters registered by all users
+
+        Returns:
+            The number of quarters
+        """
+        pass
+
     def add_quarters_to_sheet(self, date, quarters, user):
         """
         Adds the given list of quarter objects to the sheet with the given date. Any
-        existing quarters with different id will be replaced.
+        existing quarters with different id will be replaced. A quarter with activity
+        id -1 erases the quarter at that offset.
+
+        All quarters are written as a single unit, either all are stored or none.
 
         Args:
             date: The time sheets date, must be in the format YYYY-MM-DD (or a datetime object)
@@ -507,6 +782,48 @@ class Storage(object):
 
         Returns:
             The list of quarters added/removed/updated with the correct id and index
+
+        Raises:
+            ValueError: If an offset is outside the day (0-95), or an activity is not
+                one of the user's
+        """
+        pass
+
+    def update_sheet(self, date, quarters, user):
+        """
+        Adds the given list of quarter objects to the sheet with the given date, just
+        as add_quarters_to_sheet, and summarizes the resulting day. The summary is
+        computed from the day as it was before the write and the applied changes, the
+        day is not read again.
+
+        Args:
+            date: The time sheets date, must be in the format YYYY-MM-DD (or a datetime object)
+            quarters: A list of quarters to add
+            user: The current user
+
+        Returns:
+            A tuple of the list of quarters added/removed/updated with the correct id and
+            index, the list of summarized activities and the total hours, see
+            utils.summarize_activity_counts
+        """
+        pass
+
+    def update_sheets(self, ranges, user):
+        """
+        Register the given time ranges, possibly on many different days, and summarize
+        each changed day. A range with activity id -1 erases its quarters. Ranges are
+        applied in the given order, so a later range wins where two overlap.
+
+        All ranges are written as a single unit, either all are stored or none.
+
+        Args:
+            ranges: A list of (date, TimeRange) tuples
+            user: The current user
+
+        Returns:
+            A dictionary keyed on date with a tuple of the day's quarters written, with
+            the correct id, the list of summarized activities and the total hours for
+            that day, see utils.summarize_activity_counts
         """
         pass
 
@@ -0,0 +1,157 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import sys
+import time
+import threading
+import Queue
+from concurrent.futures import Future, TimeoutError
+
+
+class WriteJob(object):
+    """
+    A call queued for the writer, holding its result or error once it has been run.
+    The future is resolved once the group the call was run in is committed.
+    """
+    __slots__ = ("function", "args", "kwargs", "result", "error", "future")
+
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.future = Future()
+
+    def run(self):
+        """
+        Call the function, keeping its result or the raised exception
+        """
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+        except:
+            self.error = sys.exc_info()
+
+
+class GroupCommitWriter(object):
+    """
+    Runs all writes on a single thread, in the order they were submitted. Writes
+    submitted while the writer is busy, or within a short window, are run as one
+    group so that they can share a single commit.
+
+    Callers either block until their own write has been run and the group committed,
+    see submit, or get a Future for it, see submit_async. Waiting on futures lets a
+    single thread, like the IOLoop, have any number of writes queued at once.
+    """
+
+    def __init__(self, run_group, window = 0, max_group_size = 256, name = "writer"):
+        """
+        Args:
+            run_group: Function running a list of WriteJob as one group, see WriteJob.run
+            window: Seconds to wait for more writes before a group is run
+            max_group_size: The maximum number of writes in one group
+            name: Name of the writer thread
+        """
+        self.run_group = run_group
+        self.window = window
+        self.max_group_size = max_group_size
+        self.groups = 0
+        self.jobs = 0
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target = self._run, name = name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def on_writer_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit_async(self, function, *args, **kwargs):
+        """
+        Queue the function to be run on the writer thread
+
+        Returns:
+            A Future resolved with the value returned by the function, or with the
+            exception it raised, once its group has been committed
+        """
+        job = WriteJob(function, args, kwargs)
+        self._queue.put(job)
+        return job.future
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Run the function on the writer thread and wait for it
+
+        Returns:
+            The value returned by the function, any exception it raised is raised again
+        """
+        future = self.submit_async(function, *args, **kwargs)
+        while True:
+            try:
+                # Waiting without a timeout cannot be interrupted in Python 2
+                return future.result(60)
+            except TimeoutError:
+                pass
+
+    def _next_group(self):
+        jobs = [self._queue.get()]
+        if jobs[0] is None:
+            return None
+        deadline = time.time() + self.window
+        while len(jobs) < self.max_group_size:
+            try:
+                remaining = deadline - time.time()
+                job = self._queue.get(remaining > 0, max(remaining, 0))
+            except Queue.Empty:
+                break
+            if job is None:
+                # Stop once this group is done
+                self._queue.put(None)
+                break
+            jobs.append(job)
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._next_group()
+            if jobs is None:
+                return
+            try:
+                self.run_group(jobs)
+            except:
+                error = sys.exc_info()
+                for job in jobs:
+                    job.error = error
+            self.groups += 1
+            self.jobs += len(jobs)
+            for job in jobs:
+                if job.error:
+                    job.future.set_exception_info(job.error[1], job.error[2])
+                else:
+                    job.future.set_result(job.result)
+
+    def stats(self):
+        """
+        Get the number of groups and writes run so far
+        """
+        return {"groups": self.groups, "jobs": self.jobs}
+
+    def close(self):
+        """
+        Run any writes already submitted and stop the writer thread
+        """
+        self._queue.put(None)
+        self._thread.join()
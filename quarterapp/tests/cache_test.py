@@ -0,0 +1,89 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+
+from quarterapp.storage.cache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_counts_hits_and_misses(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual({"entries": 1, "max_entries": 2, "size": 0, "max_size": None,
+            "hits": 1, "misses": 1, "invalidations": 0}, cache.stats())
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+
+    def test_stale_value_is_not_stored(self):
+        cache = LRUCache(2)
+        generation = cache.generation
+        cache.invalidate("a")
+
+        self.assertFalse(cache.put("a", 1, generation))
+        self.assertEqual(None, cache.get("a"))
+
+    def test_zero_size_disables_cache(self):
+        cache = LRUCache(0)
+
+        self.assertFalse(cache.put("a", 1))
+        self.assertEqual(0, len(cache))
+
+    def test_values_expire(self):
+        cache = LRUCache(2, ttl = 0.01)
+        cache.put("a", 1)
+        time.sleep(0.02)
+
+        self.assertEqual(None, cache.get("a"))
+        self.assertEqual(1, cache.stats()["misses"])
+
+    def test_counts_invalidated_values(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.invalidate("a")
+        cache.invalidate("a")
+
+        self.assertEqual(1, cache.stats()["invalidations"])
+
+    def test_evicts_to_stay_within_max_size(self):
+        cache = LRUCache(max_size = 10, sizeof = len)
+        cache.put("a", "12345")
+        cache.put("b", "1234")
+        cache.put("c", "123")
+
+        self.assertEqual(None, cache.get("a"))
+        self.assertEqual(7, cache.stats()["size"])
+
+    def test_update_wins_over_load(self):
+        cache = LRUCache(2)
+        generation = cache.generation
+        cache.update("a", 2)
+
+        self.assertFalse(cache.put("a", 1, generation))
+        self.assertEqual(2, cache.get("a"))
@@ -111,4 +111,70 @@ class TestTimeSheet(unittest.TestCase):
         
         self.assertIsNotNone(time_sheet)
 
-    
\ No newline at end of file
+    
+    def test_summarize_counts_quarters_per_activity(self):
+        activities = [-1] * 96
+        activities[0:4] = [3, 3, 3, 3]
+        activities[10:12] = [5, 5]
+        time_sheet = TimeSheet(date(2013, 2, 4), activities)
+
+        time_sheet.summarize()
+
+        self.assertEqual([3, 5], [summary.id for summary in time_sheet.summary])
+        self.assertEqual(1.0, time_sheet.time(3))
+        self.assertEqual(0.5, time_sheet.time(5))
+        self.assertEqual(0, time_sheet.time(-1))
+        self.assertEqual(1.5, time_sheet.total())
+
+    def test_quarters_follow_activities(self):
+        activities = [-1] * 96
+        activities[95] = 7
+        time_sheet = TimeSheet(date(2013, 2, 4), activities, comments = {95: 2}, id = 3)
+
+        quarters = time_sheet.quarters
+
+        self.assertEqual(1, len(quarters))
+        self.assertEqual(3 * 96 + 95, quarters[0].id)
+        self.assertEqual(2, quarters[0].comment_id)
+        self.assertEqual((3, 95), TimeSheet.split_quarter_id(quarters[0].id))
+
+
+    def test_runs_group_consecutive_quarters(self):
+        activities = [-1] * 96
+        activities[0:4] = [5, 5, 6, 6]
+        activities[94:96] = [5, 5]
+
+        self.assertEqual([(0, 2, 5), (2, 2, 6), (94, 2, 5)], TimeSheet(activities = activities).runs())
+        self.assertEqual([(0, 96, 1)], TimeSheet(activities = [1] * 96).runs())
+        self.assertEqual([], TimeSheet().runs())
+
+class TestReport(unittest.TestCase):
+    def _week(self, year, week_of_year, counts):
+        week = Week(year, week_of_year)
+        for sheet, day_counts in zip(week, counts):
+            sheet.summarize_counts(day_counts)
+        return week
+
+    def test_week_sums_activities(self):
+        week = self._week(2013, 6, [{1: 4, 2: 2}, {1: 8}, {}, {}, {}, {}, {3: 1}])
+
+        self.assertEqual([(1, 3.0), (2, 0.5), (3, 0.25)],
+            [(a.id, a.amount) for a in week.get_weeks_activities()])
+        self.assertEqual(3.75, week.total())
+
+    def test_report_sums_weeks(self):
+        report = Report()
+        report.add_week(self._week(2013, 6, [{2: 4}, {1: 4}]))
+        report.add_week(self._week(2013, 7, [{1: 2}]))
+
+        self.assertEqual(2, len(report.weeks))
+        self.assertEqual([(1, 1.5), (2, 1.0)], [(a.id, a.amount) for a in report.total_activities])
+        self.assertEqual(2.5, report.total_hours())
+
+    def test_report_can_use_aggregated_totals(self):
+        report = Report()
+        report.add_totals({1: 10, 2: 2})
+
+        self.assertEqual([], report.weeks)
+        self.assertEqual([(1, 2.5), (2, 0.5)], [(a.id, a.amount) for a in report.total_activities])
+        self.assertEqual(3.0, report.total_hours())
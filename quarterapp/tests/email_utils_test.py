@@ -0,0 +1,136 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncore
+import smtpd
+import smtplib
+import socket
+import threading
+import time
+import unittest
+
+from quarterapp.email_utils import MailSender
+from quarterapp.storage.default import DefaultStorage
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """
+    Stand-in for an SMTP server, keeping the received mails and the port of the
+    connection each arrived on
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = []
+        self._thread = threading.Thread(target = asyncore.loop, kwargs = { "timeout" : 0.05 })
+        self._thread.daemon = True
+        self._thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((peer[1], rcpttos, data))
+
+    def stop(self):
+        self.close()
+        asyncore.close_all()
+        self._thread.join()
+
+def unused_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class TestMailSender(unittest.TestCase):
+    def setUp(self):
+        self.storage = DefaultStorage(":memory:")
+        self.server = LocalSMTPServer()
+
+    def tearDown(self):
+        self.server.stop()
+        self.storage.close()
+
+    def test_sends_queued_mail_on_one_connection(self):
+        for i in range(3):
+            self.storage.queue_mail("user%d@example.com" % i, "Subject: Hello %d\n\nHello" % i)
+        sender = MailSender(self.storage, "127.0.0.1", self.server.port, sender = "noreply@example.com")
+
+        self.assertEqual(3, sender.send_pending())
+        sender._disconnect()
+
+        self.assertEqual(3, len(self.server.received))
+        self.assertEqual(1, len(set(port for port, recipients, data in self.server.received)))
+        self.assertEqual(["user0@example.com"], self.server.received[0][1])
+        self.assertEqual({ "sent" : 3, "failures" : 0, "connections" : 1 }, sender.stats())
+        self.assertEqual(0, self.storage.mail_queue_stats(time.time())["queued"])
+
+    def test_retries_with_backoff(self):
+        self.storage.queue_mail("dale@example.com", "Subject: Hello\n\nHello")
+        sender = MailSender(self.storage, "127.0.0.1", unused_port(), retry_delay = 60)
+
+        self.assertEqual(1, sender.send_pending())
+        # Not due again until the retry delay has passed
+        self.assertEqual(0, sender.send_pending())
+        stats = self.storage.mail_queue_stats(time.time())
+        self.assertEqual(1, stats["queued"])
+        self.assertEqual(1, stats["retrying"])
+        self.assertEqual(1, sender.stats()["failures"])
+
+        self.storage.execute("UPDATE outbox SET next_attempt=0;")
+        sender.port = self.server.port
+        self.assertEqual(1, sender.send_pending())
+        self.assertEqual(1, len(self.server.received))
+        self.assertEqual(0, self.storage.mail_queue_stats(time.time())["queued"])
+
+    def test_background_sender_is_woken(self):
+        sender = MailSender(self.storage, "127.0.0.1", self.server.port, poll_interval = 60)
+        sender.start()
+        try:
+            self.storage.queue_mail("dale@example.com", "Subject: Hello\n\nHello")
+            sender.wake()
+            deadline = time.time() + 5
+            while not self.server.received and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            sender.stop()
+        self.assertEqual(1, len(self.server.received))
+
+    def test_connects_over_tls_on_smtps_port(self):
+        connections = []
+        class FakeSMTP(object):
+            def __init__(self, host, port, timeout):
+                connections.append((self.__class__.__name__, port))
+            def ehlo(self):
+                pass
+            def starttls(self):
+                connections.append("starttls")
+            def login(self, user, password):
+                pass
+        class SMTP_SSL(FakeSMTP):
+            pass
+        class SMTP(FakeSMTP):
+            pass
+
+        smtp, smtp_ssl = smtplib.SMTP, smtplib.SMTP_SSL
+        smtplib.SMTP, smtplib.SMTP_SSL = SMTP, SMTP_SSL
+        try:
+            MailSender(self.storage, "smtp.example.com", 465, "joe", "secret")._connect()
+            MailSender(self.storage, "smtp.example.com", 587, "joe", "secret")._connect()
+            MailSender(self.storage, "smtp.example.com", 2465, "joe", "secret", ssl = True)._connect()
+        finally:
+            smtplib.SMTP, smtplib.SMTP_SSL = smtp, smtp_ssl
+
+        self.assertEqual([("SMTP_SSL", 465), ("SMTP", 587), "starttls", ("SMTP_SSL", 2465)], connections)
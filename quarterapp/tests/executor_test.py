@@ -0,0 +1,75 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+from quarterapp.domain import *
+from quarterapp.storage.default import DefaultStorage
+from quarterapp.storage.executor import AsyncStorage
+
+class TestAsyncStorage(unittest.TestCase):
+    """
+    Test the non-blocking storage facade using a file based database
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.storage = DefaultStorage(os.path.join(self.folder, "quarterapp.db"))
+        self.async_storage = AsyncStorage(self.storage, 2)
+
+    def tearDown(self):
+        self.async_storage.shutdown()
+        self.storage.close()
+        shutil.rmtree(self.folder)
+
+    def test_calls_return_futures(self):
+        future = self.async_storage.user_count()
+        self.assertEqual(1, future.result())
+
+    def test_calls_are_made_on_worker_threads(self):
+        caller = threading.current_thread()
+        future = self.async_storage.executor.submit(threading.current_thread)
+        self.assertNotEqual(caller, future.result())
+
+    def test_writes_are_visible_between_threads(self):
+        user = User("joe@example.com")
+        self.assertTrue(self.async_storage.save_user(user).result())
+
+        self.assertEqual("joe@example.com", self.storage.get_user(user.id).username)
+
+    def test_errors_are_raised_from_future(self):
+        future = self.async_storage.get_category(1, None)
+        self.assertRaises(AttributeError, future.result)
+
+    def test_writes_are_queued_on_the_writer(self):
+        user = User("joe@example.com")
+        self.storage.save_user(user)
+        jobs = self.storage._writer.stats()["jobs"]
+
+        # More writes in flight than there are worker threads
+        futures = [self.async_storage.save_category(Category("Category %d" % i), user) for i in range(20)]
+        self.assertTrue(all(future.result() for future in futures))
+        self.assertEqual(jobs + 20, self.storage._writer.stats()["jobs"])
+        self.assertEqual(20, self.storage.category_count(user))
+
+    def test_write_errors_are_raised_from_future(self):
+        def fail(storage):
+            raise ValueError()
+        self.assertRaises(ValueError, self.async_storage.run_in_transaction(fail).result)
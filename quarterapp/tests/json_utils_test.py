@@ -0,0 +1,65 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import datetime
+import json
+import unittest
+
+from quarterapp.domain import Activity, Category, Color, Comment, TimeSheet
+from quarterapp.json_utils import json_encode
+
+class TestJsonEncode(unittest.TestCase):
+
+    def test_plain_structure(self):
+        self.assertEqual('{"a":[1,2]}', json_encode({ "a" : [1, 2] }))
+
+    def test_apostrophes_are_kept(self):
+        activity = Activity(id = 1, title = "Markus' work", color = Color("#fcaf3e"), category_id = 2)
+        decoded = json.loads(json_encode(activity))
+        self.assertEqual({ "id" : 1, "category" : 2, "title" : "Markus' work",
+                           "color" : "#fcaf3e", "enabled" : True }, decoded)
+
+    def test_category_with_activities(self):
+        category = Category(title = "Work", id = 2)
+        self.assertEqual({ "id" : 2, "title" : "Work" }, json.loads(json_encode(category)))
+
+        category.activities = [Activity(id = 1, category_id = 2), Activity(id = 3, category_id = 2)]
+        decoded = json.loads(json_encode({ "categories" : [category] }))
+        self.assertEqual([1, 3], [a["id"] for a in decoded["categories"][0]["activities"]])
+
+    def test_sheet(self):
+        activities = [-1] * 96
+        activities[4] = 7
+        activities[95] = 8
+        sheet = TimeSheet(datetime.date(2013, 2, 4), activities, id = 2)
+        decoded = json.loads(json_encode(sheet))
+        self.assertEqual("2013-02-04", decoded["date"])
+        self.assertEqual([{ "id" : 196, "offset" : 4, "activity" : 7 },
+                          { "id" : 287, "offset" : 95, "activity" : 8 }], decoded["quarters"])
+
+    def test_unsaved_sheet(self):
+        sheet = TimeSheet(datetime.date(2013, 2, 4), [3] * 96)
+        decoded = json.loads(json_encode(sheet))
+        self.assertEqual(96, len(decoded["quarters"]))
+        self.assertEqual(-1, decoded["quarters"][0]["id"])
+
+    def test_comment(self):
+        self.assertEqual({ "id" : 4, "comment" : "It's done" },
+                         json.loads(json_encode(Comment(id = 4, comment = "It's done"))))
+
+    def test_unknown_object(self):
+        self.assertRaises(TypeError, json_encode, object())
@@ -0,0 +1,93 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import sqlite3
+
+from quarterapp.storage.migrations import *
+from quarterapp.storage.encoding import unpack_activities, unpack_comments
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _indexes(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL;")
+        return [row[0] for row in cursor.fetchall()]
+
+    def _tables(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        return [row[0] for row in cursor.fetchall()]
+
+    def test_empty_database_is_version_zero(self):
+        self.assertEqual(0, schema_version(self.conn))
+
+    def test_migrates_empty_database_to_latest(self):
+        version = migrate(self.conn)
+
+        self.assertEqual(migrations[-1].version, version)
+        self.assertEqual(version, schema_version(self.conn))
+        self.assertIn("sheets", self._tables())
+        self.assertNotIn("quarters", self._tables())
+
+    def test_migrate_is_idempotent(self):
+        migrate(self.conn)
+        self.assertEqual(migrations[-1].version, migrate(self.conn))
+
+    def test_unversioned_database_is_upgraded(self):
+        self.conn.executescript(initializing_sql)
+        self.assertEqual(1, schema_version(self.conn))
+
+        migrate(self.conn)
+
+        self.assertEqual(migrations[-1].version, schema_version(self.conn))
+        self.assertIn("signups_activation_code", self._indexes())
+
+    def test_failing_migration_is_rolled_back(self):
+        broken = migrations + [
+            Migration(100, "Add table", sql = "CREATE TABLE `extra` (`id` INTEGER);"),
+            Migration(101, "Broken", sql = "CREATE TABLE `extra` (`id` INTEGER);")]
+
+        self.assertRaises(sqlite3.OperationalError, migrate, self.conn, broken)
+
+        self.assertEqual(0, schema_version(self.conn))
+
+    def test_quarters_are_converted_to_sheets(self):
+        migrate(self.conn, migrations[:4])
+        self.conn.executemany("INSERT INTO quarters (`offset`, `activity`, `comment`, `date`, `user`) VALUES (?, ?, ?, ?, ?);",
+            [(0, 3, 0, "2013-02-04", 1), (95, 4, 7, "2013-02-04", 1), (10, 3, 0, "2013-02-05", 1), (10, 5, 0, "2013-02-04", 2)])
+        self.conn.commit()
+
+        migrate(self.conn)
+
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT `user`, `date`, `activities`, `comments` FROM sheets ORDER BY `user`, `date`;")
+        rows = cursor.fetchall()
+        self.assertEqual(3, len(rows))
+        user, date, activities, comments = rows[0]
+        activities = unpack_activities(activities)
+        self.assertEqual((1, "2013-02-04"), (user, date))
+        self.assertEqual(96, len(activities))
+        self.assertEqual(3, activities[0])
+        self.assertEqual(4, activities[95])
+        self.assertEqual(94, list(activities).count(-1))
+        self.assertEqual({95: 7}, unpack_comments(comments))
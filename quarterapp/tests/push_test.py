@@ -0,0 +1,157 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import urllib
+import tornado.web
+import tornado.websocket
+
+from tornado.httpclient import HTTPRequest, HTTPError
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from quarterapp.domain import User, UserState, Category, Activity, Color
+from quarterapp.handlers.api import SheetApiHandler, CommentHandler
+from quarterapp.handlers.push import PushChannels, PushHandler
+from quarterapp.storage.default import DefaultStorage
+from quarterapp.storage.executor import AsyncStorage
+
+class FakeConnection(object):
+    def __init__(self, closed = False):
+        self.closed = closed
+        self.messages = []
+
+    def write_message(self, message):
+        if self.closed:
+            raise tornado.websocket.WebSocketClosedError()
+        self.messages.append(json.loads(message))
+
+class TestPushChannels(unittest.TestCase):
+    def setUp(self):
+        self.channels = PushChannels()
+        self.dale = User("dale@example.com", id = 1)
+        self.alice = User("alice@example.com", id = 2)
+
+    def test_publish_reaches_all_connections_of_user(self):
+        phone, laptop, other = FakeConnection(), FakeConnection(), FakeConnection()
+        self.channels.subscribe(self.dale.id, phone)
+        self.channels.subscribe(self.dale.id, laptop)
+        self.channels.subscribe(self.alice.id, other)
+
+        self.channels.publish(self.dale, { "type" : "comment", "quarter" : 97, "deleted" : True })
+
+        self.assertEqual([{ "type" : "comment", "quarter" : 97, "deleted" : True }], phone.messages)
+        self.assertEqual(phone.messages, laptop.messages)
+        self.assertEqual([], other.messages)
+
+    def test_closed_connections_are_dropped(self):
+        self.channels.subscribe(self.dale.id, FakeConnection(closed = True))
+        self.channels.subscribe(self.dale.id, FakeConnection())
+        self.assertEqual(2, self.channels.connection_count())
+
+        self.channels.publish(self.dale, { "type" : "sheet" })
+        self.assertEqual(1, self.channels.connection_count())
+
+    def test_unsubscribe(self):
+        connection = FakeConnection()
+        self.channels.subscribe(self.dale.id, connection)
+        self.channels.unsubscribe(self.dale.id, connection)
+
+        self.channels.publish(self.dale, { "type" : "sheet" })
+        self.assertEqual([], connection.messages)
+        self.assertEqual(0, self.channels.connection_count())
+
+class TestPushHandler(AsyncHTTPTestCase):
+    """
+    Test the push channel through HTTP, using a file based database
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.storage = DefaultStorage(os.path.join(self.folder, "quarterapp.db"))
+        self.async_storage = AsyncStorage(self.storage, 2)
+        super(TestPushHandler, self).setUp()
+
+        self.dale = User("dale@example.com", state = UserState.Active)
+        self.storage.save_user(self.dale)
+        self.storage.save_session("dale-session", self.dale, time.time() + 60)
+        category = Category("Work")
+        self.storage.save_category(category, self.dale)
+        self.activity = Activity(title = "Dev", color = Color("#fcaf3e"))
+        self.storage.save_activity(self.activity, category, self.dale)
+
+    def tearDown(self):
+        super(TestPushHandler, self).tearDown()
+        self.async_storage.shutdown()
+        self.storage.close()
+        shutil.rmtree(self.folder)
+
+    def get_app(self):
+        application = tornado.web.Application([
+            (r"/api/sheet/([^\/]+)", SheetApiHandler),
+            (r"/api/comment/([^\/]+)", CommentHandler),
+            (r"/api/push", PushHandler)])
+        application.storage = self.storage
+        application.async_storage = self.async_storage
+        application.push = PushChannels()
+        return application
+
+    def _connect(self, session = "dale-session"):
+        url = "ws://127.0.0.1:%d/api/push" % self.get_http_port()
+        return tornado.websocket.websocket_connect(HTTPRequest(url, headers = { "Cookie" : "session=" + session }))
+
+    def _put(self, path, body):
+        return self.http_client.fetch(self.get_url(path), method = "PUT", body = urllib.urlencode(body),
+            headers = { "Cookie" : "session=dale-session", "Content-Type" : "application/x-www-form-urlencoded" })
+
+    @gen_test
+    def test_push_requires_a_session(self):
+        with self.assertRaises(HTTPError) as context:
+            yield self._connect("unknown")
+        self.assertEqual(403, context.exception.code)
+
+    @gen_test
+    def test_push_requires_an_active_user(self):
+        self.storage.save_user(User(self.dale.username, id = self.dale.id, state = UserState.Disabled))
+        with self.assertRaises(HTTPError) as context:
+            yield self._connect()
+        self.assertEqual(403, context.exception.code)
+
+    @gen_test
+    def test_sheet_and_comment_changes_are_pushed(self):
+        connection = yield self._connect()
+
+        yield self._put("/api/sheet/2013-02-04", { "indexes" : "1,2", "activity" : self.activity.id })
+        message = json.loads((yield connection.read_message()))
+        self.assertEqual("sheet", message["type"])
+        self.assertEqual("2013-02-04", message["date"])
+        self.assertEqual([1, 2], [quarter["offset"] for quarter in message["quarters"]])
+        self.assertEqual("0.50", message["total"])
+
+        quarter_id = message["quarters"][0]["id"]
+        yield self._put("/api/comment/%d" % quarter_id, { "comment" : "Meeting" })
+        message = json.loads((yield connection.read_message()))
+        self.assertEqual({ "type" : "comment", "quarter" : quarter_id, "comment" : "Meeting" }, message)
+
+        yield self.http_client.fetch(self.get_url("/api/comment/%d" % quarter_id), method = "DELETE",
+            headers = { "Cookie" : "session=dale-session" })
+        message = json.loads((yield connection.read_message()))
+        self.assertEqual({ "type" : "comment", "quarter" : quarter_id, "deleted" : True }, message)
+        connection.close()
@@ -17,6 +17,10 @@
 import unittest
 import os
 import tempfile
+import time
+import datetime
+import sqlite3
+import threading
 
 from quarterapp.domain import *
 from quarterapp.storage import Storage
@@ -43,9 +47,22 @@ class TestStorage(unittest.TestCase):
 
     def tearDown(self):
         self.storage.execute("DELETE FROM timeranges;")
+        self.storage.execute("DELETE FROM sessions;")
+        self.storage.execute("DELETE FROM data_versions;")
+        self.storage.execute("DELETE FROM changes;")
+        self.storage.execute("DELETE FROM change_horizons;")
+        self.storage.execute("DELETE FROM outbox;")
+        self.storage.execute("DELETE FROM sheets;")
+        self.storage.execute("DELETE FROM comments;")
+        self.storage.execute("DELETE FROM daily_activity_totals;")
         self.storage.execute("DELETE FROM activities;")
         self.storage.execute("DELETE FROM categories;")
         self.storage.execute("DELETE FROM users;")
+        self.storage._catalog_cache.clear()
+        self.storage._auth_cache.clear()
+        self.storage._session_cache.clear()
+        self.storage._sheet_cache.clear()
+        self.storage._data_versions.clear()
 
 
     ## User
@@ -174,6 +191,73 @@ class TestStorage(unittest.TestCase):
         invalid_jane = self.storage.get_user_by_username("jane@example.com")
         self.assertIsNone(invalid_jane)
 
+    def test_deleting_user_removes_dependent_rows(self):
+        self._setup_activities()
+        self.storage.save_user(self.user_roger)
+        day = datetime.date(2013, 2, 4)
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale)
+        self.storage.save_session("abc", self.user_dale, time.time() + 60)
+        self.storage.queue_mail("dale@example.com", "Subject: Reset")
+        self.storage.queue_mail("roger@example.com", "Subject: Reset")
+
+        # As given by the admin pages, without the username
+        self.assertTrue(self.storage.delete_user(User("", id = self.user_dale.id)))
+        self.assertFalse(self.storage.delete_user(User("", id = self.user_dale.id)))
+
+        self.assertIsNone(self.storage.get_session_user("abc"))
+        self.assertEqual(0, self.storage.get_change_cursor(self.user_dale))
+        self.assertEqual([], self.storage.get_timesheet(day, self.user_dale).quarters)
+        self.assertEqual(["roger@example.com"],
+            [row.recipient for row in self.storage.query("SELECT recipient FROM outbox;")])
+
+    def test_disabled_user_is_not_authenticated(self):
+        self.storage.save_user(self.user_dale)
+        self.user_dale.activate()
+        self.storage.save_user(self.user_dale)
+        before = self.storage.cache_stats()["authentication"]
+        self.assertTrue(self.storage.authenticate_user(self.user_dale.id))
+        self.assertTrue(self.storage.authenticate_user(self.user_dale.id))
+        self.assertEqual(before["hits"] + 1, self.storage.cache_stats()["authentication"]["hits"])
+
+        # The admin view saves users with the id given in the URL
+        self.storage.save_user(User(self.user_dale.username, id = str(self.user_dale.id), state = UserState.Disabled))
+
+        self.assertFalse(self.storage.authenticate_user(self.user_dale.id))
+        self.assertEqual(before["invalidations"] + 1, self.storage.cache_stats()["authentication"]["invalidations"])
+
+    ## Sessions
+
+    def test_session_resolves_user_until_revoked(self):
+        self.user_dale.activate()
+        self.storage.save_user(self.user_dale)
+        self.assertTrue(self.storage.save_session("abc", self.user_dale, time.time() + 60))
+
+        self.assertEqual(self.user_dale.username, self.storage.get_session_user("abc").username)
+        self.assertEqual(None, self.storage.get_session_user("unknown"))
+
+        self.storage.delete_session("abc")
+        self.assertEqual(None, self.storage.get_session_user("abc"))
+
+    def test_disabling_user_revokes_sessions(self):
+        self.user_dale.activate()
+        self.storage.save_user(self.user_dale)
+        self.storage.save_session("abc", self.user_dale, time.time() + 60)
+        self.assertIsNotNone(self.storage.get_session_user("abc"))
+
+        self.user_dale.disable()
+        self.storage.save_user(self.user_dale)
+
+        self.assertEqual(None, self.storage.get_session_user("abc"))
+
+    def test_expired_sessions_are_swept(self):
+        self.storage.save_user(self.user_dale)
+        self.storage.save_session("old", self.user_dale, time.time() - 1)
+        self.storage.save_session("new", self.user_dale, time.time() + 60)
+
+        self.assertEqual(None, self.storage.get_session_user("old"))
+        self.assertEqual(1, self.storage.delete_expired_sessions())
+        self.assertIsNotNone(self.storage.get_session_user("new"))
+
     def test_can_get_users(self):
         user_joe = User("joe@example.com")
         user_jane = User("jane@example.com")
@@ -230,4 +314,473 @@ class TestStorage(unittest.TestCase):
         self.storage.save_user(user_robert)
 
         self.assertEqual("alice@example.net", self.storage.get_filtered_users("alice")[0].username)
-        
\ No newline at end of file
+        
+    ## Time sheet
+
+    def _setup_activities(self):
+        self.storage.save_user(self.user_dale)
+        self.storage.save_category(self.default_category, self.user_dale)
+        self.work = Activity(title = "Work", color = Color("#fcaf3e"))
+        self.lunch = Activity(title = "Lunch", color = Color("#3465a4"))
+        self.storage.save_activity(self.work, self.default_category, self.user_dale)
+        self.storage.save_activity(self.lunch, self.default_category, self.user_dale)
+
+    def test_can_add_quarters_to_sheet(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+
+        quarters = [Quarter(offset = i, activity_id = self.work.id) for i in range(32, 40)]
+        added = self.storage.add_quarters_to_sheet(day, quarters, self.user_dale)
+
+        self.assertEqual(8, len(added))
+        self.assertTrue(all(q.id != -1 for q in added))
+        sheet = self.storage.get_timesheet(day, self.user_dale)
+        self.assertEqual(8, len(sheet.quarters))
+        self.assertEqual(2.0, sheet.time(self.work.id))
+
+    def test_update_sheet_summarizes_the_day(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+        self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.work.id) for i in range(0, 8)], self.user_dale)
+
+        quarters, summary, total = self.storage.update_sheet(day,
+            [Quarter(offset = i, activity_id = self.lunch.id) for i in range(6, 10)] +
+            [Quarter(offset = 0, activity_id = -1)], self.user_dale)
+
+        self.assertEqual(5, len(quarters))
+        self.assertEqual("2.25", total)
+        self.assertEqual([{"id": self.work.id, "color": "#fcaf3e", "title": "Work", "sum": "1.25"},
+                          {"id": self.lunch.id, "color": "#3465a4", "title": "Lunch", "sum": "1.00"}], summary)
+
+        quarters, summary, total = self.storage.update_sheet(day,
+            [Quarter(offset = i, activity_id = -1) for i in range(0, 10)], self.user_dale)
+        self.assertEqual(([], "0.00"), (summary, total))
+        self.assertEqual([], self.storage.get_timesheet(day, self.user_dale).quarters)
+
+    def test_update_sheets_writes_many_days(self):
+        self._setup_activities()
+        monday = datetime.date(2013, 2, 4)
+        tuesday = datetime.date(2013, 2, 5)
+
+        summaries = self.storage.update_sheets([
+            (monday, TimeRange(start = 32, length = 16, activity_id = self.work.id)),
+            (monday, TimeRange(start = 44, length = 4, activity_id = self.lunch.id)),
+            (tuesday, TimeRange(start = 32, length = 4, activity_id = self.work.id))], self.user_dale)
+
+        self.assertEqual(set([monday, tuesday]), set(summaries))
+        self.assertEqual("4.00", summaries[monday][2])
+        self.assertEqual(["3.00", "1.00"], [activity["sum"] for activity in summaries[monday][1]])
+        self.assertEqual("1.00", summaries[tuesday][2])
+        self.assertEqual(4, len(summaries[tuesday][0]))
+        self.assertEqual([(32, 12, self.work.id), (44, 4, self.lunch.id)],
+            self.storage.get_timesheet(monday, self.user_dale).runs())
+        self.assertEqual({monday: {self.work.id: 12, self.lunch.id: 4}, tuesday: {self.work.id: 4}},
+            self.storage.get_daily_totals(monday, tuesday, self.user_dale))
+
+    def test_add_quarters_replaces_and_erases(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+
+        self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.work.id) for i in range(0, 8)], self.user_dale)
+        changed = self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.lunch.id) for i in range(4, 8)] +
+            [Quarter(offset = i, activity_id = -1) for i in range(0, 2)], self.user_dale)
+
+        self.assertTrue(all(q.id != -1 for q in changed if q.activity_id != -1))
+        self.assertTrue(all(q.id == -1 for q in changed if q.activity_id == -1))
+        sheet = self.storage.get_timesheet(day, self.user_dale)
+        self.assertEqual(6, len(sheet.quarters))
+        self.assertEqual(0.5, sheet.time(self.work.id))
+        self.assertEqual(1.0, sheet.time(self.lunch.id))
+
+    def test_add_quarters_rejects_offsets_outside_the_day(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+
+        for offset in (-1, 96):
+            self.assertRaises(ValueError, self.storage.add_quarters_to_sheet, day,
+                [Quarter(offset = 1, activity_id = self.work.id), Quarter(offset = offset, activity_id = self.work.id)],
+                self.user_dale)
+        self.assertEqual([], self.storage.get_timesheet(day, self.user_dale).quarters)
+
+    def test_add_quarters_rejects_unknown_activities(self):
+        self._setup_activities()
+        self.storage.save_user(self.user_roger)
+        other = Activity(title = "Other", color = Color("#fcaf3e"))
+        self.storage.save_activity(other, self.default_category, self.user_roger)
+        day = datetime.date(2013, 2, 4)
+
+        # Unknown, and belonging to another user
+        for activity_id in (999999, other.id):
+            self.assertRaises(ValueError, self.storage.add_quarters_to_sheet, day,
+                [Quarter(offset = 1, activity_id = self.work.id), Quarter(offset = 2, activity_id = activity_id)],
+                self.user_dale)
+        self.assertEqual([], self.storage.get_timesheet(day, self.user_dale).quarters)
+
+    def test_quarters_are_per_user(self):
+        self._setup_activities()
+        self.storage.save_user(self.user_roger)
+        day = datetime.date(2013, 2, 4)
+
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale)
+
+        self.assertEqual(0, len(self.storage.get_timesheet(day, self.user_roger).quarters))
+
+    def test_can_get_timesheets_for_range(self):
+        self._setup_activities()
+        monday = datetime.date(2013, 2, 4)
+        wednesday = datetime.date(2013, 2, 6)
+        next_monday = datetime.date(2013, 2, 11)
+
+        self.storage.add_quarters_to_sheet(monday, [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale)
+        self.storage.add_quarters_to_sheet(wednesday,
+            [Quarter(offset = i, activity_id = self.lunch.id) for i in range(4)], self.user_dale)
+        self.storage.add_quarters_to_sheet(next_monday, [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale)
+
+        sheets = self.storage.get_timesheets(monday, datetime.date(2013, 2, 10), self.user_dale)
+
+        self.assertEqual([monday, wednesday], sorted(sheets.keys()))
+        self.assertEqual(0.25, sheets[monday].time(self.work.id))
+        self.assertEqual(1.0, sheets[wednesday].time(self.lunch.id))
+
+    def test_comments_are_kept_per_quarter(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+        added = self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.work.id) for i in range(2)], self.user_dale)
+
+        self.assertTrue(self.storage.save_comment(added[1].id, Comment(comment = "Meeting"), self.user_dale))
+
+        self.assertEqual("Meeting", self.storage.get_comment_for_quarter(added[1].id, self.user_dale).comment)
+        self.assertEqual(None, self.storage.get_comment_for_quarter(added[0].id, self.user_dale))
+
+        # Changing the quarter's activity drops its comment
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = self.lunch.id)], self.user_dale)
+        self.assertEqual(None, self.storage.get_comment_for_quarter(added[1].id, self.user_dale))
+
+    def test_cached_timesheet_follows_writes(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+        self.assertEqual(0, len(self.storage.get_timesheet(day, self.user_dale).quarters))
+
+        added = self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.work.id) for i in range(4)], self.user_dale)
+        self.storage.save_comment(added[0].id, Comment(comment = "Standup"), self.user_dale)
+        misses = self.storage.cache_stats()["timesheet"]["misses"]
+
+        sheet = self.storage.get_timesheet(day, self.user_dale)
+        self.assertEqual(misses, self.storage.cache_stats()["timesheet"]["misses"])
+        self.assertEqual(1.0, sheet.time(self.work.id))
+        self.assertNotEqual(0, sheet.quarters[0].comment_id)
+
+        self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = -1) for i in range(4)], self.user_dale)
+        self.assertEqual(0, len(self.storage.get_timesheet(day, self.user_dale).quarters))
+
+    ## Categories
+
+    def test_categories_with_usage(self):
+        self._setup_activities()
+        self.storage.save_category(self.second_category, self.user_dale)
+        day = datetime.date(2013, 2, 4)
+        self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.work.id) for i in range(6)], self.user_dale)
+
+        categories = self.storage.get_categories_and_activities_with_usage(self.user_dale)
+
+        self.assertEqual(2, len(categories))
+        self.assertFalse(categories[0].is_empty())
+        self.assertTrue(categories[1].is_empty())
+        self.assertEqual([], categories[1].activities)
+        usage = dict((a.id, a.usage) for a in categories[0].activities)
+        self.assertEqual({self.work.id: 6, self.lunch.id: 0}, usage)
+
+    def test_catalog_is_cached_until_changed(self):
+        self._setup_activities()
+        self.assertEqual(2, len(self.storage.get_activities(self.user_dale)))
+        hits = self.storage.cache_stats()["catalog"]["hits"]
+
+        activities = self.storage.get_activities(self.user_dale)
+        activities[0].title = "Changed without saving"
+
+        self.assertEqual(hits + 1, self.storage.cache_stats()["catalog"]["hits"])
+        self.assertEqual("Work", self.storage.get_activity(self.work.id, self.user_dale).title)
+
+        self.work.title = "Job"
+        self.storage.save_activity(self.work, self.default_category, self.user_dale)
+        self.assertEqual("Job", self.storage.get_activity(self.work.id, self.user_dale).title)
+
+        self.storage.delete_activity(self.lunch, self.user_dale)
+        self.assertEqual([self.work.id], [a.id for a in self.storage.get_activities(self.user_dale)])
+
+    def test_data_version_changes_on_writes(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+        versions = [self.storage.get_data_version(self.user_dale)]
+
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale)
+        versions.append(self.storage.get_data_version(self.user_dale))
+        # Nothing changes when the same quarter is written again
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale)
+        self.assertEqual(versions[-1], self.storage.get_data_version(self.user_dale))
+
+        self.work.title = "Job"
+        self.storage.save_activity(self.work, self.default_category, self.user_dale)
+        versions.append(self.storage.get_data_version(self.user_dale))
+        self.storage.delete_category(self.second_category, self.user_dale)
+        versions.append(self.storage.get_data_version(self.user_dale))
+
+        quarter_id = self.storage.get_timesheet(day, self.user_dale).quarters[0].id
+        self.storage.save_comment(quarter_id, Comment(comment = "Meeting"), self.user_dale)
+        versions.append(self.storage.get_data_version(self.user_dale))
+        # Editing the text of an existing comment
+        self.storage.save_comment(quarter_id, Comment(comment = "Planning"), self.user_dale)
+        versions.append(self.storage.get_data_version(self.user_dale))
+
+        self.assertEqual(len(versions), len(set(versions)))
+
+    def test_run_in_transaction_is_atomic(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+
+        def fail(storage):
+            storage.save_category(Category("Private"), self.user_dale)
+            storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale)
+            raise ValueError()
+
+        self.assertRaises(ValueError, self.storage.run_in_transaction, fail)
+        self.assertEqual(1, self.storage.category_count(self.user_dale))
+        self.assertEqual([], self.storage.get_timesheet(day, self.user_dale).quarters)
+
+        result = self.storage.run_in_transaction(lambda storage: storage.add_quarters_to_sheet(day,
+            [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale))
+        self.assertEqual(1, len(result))
+        self.assertEqual(1, len(self.storage.get_timesheet(day, self.user_dale).quarters))
+
+    ## Change log
+
+    def test_change_log_keeps_latest_change_per_entity(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+        cursor = self.storage.get_change_cursor(self.user_dale)
+
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale)
+        self.storage.save_comment(self.storage.get_timesheet(day, self.user_dale).quarter_id(1),
+            Comment(comment = "Meeting"), self.user_dale)
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = self.lunch.id)], self.user_dale)
+        self.storage.save_activity(self.lunch, self.default_category, self.user_dale)
+
+        changes = self.storage.get_changes(cursor, 100, self.user_dale)
+        self.assertEqual([(Change.Comment, True), (Change.Sheet, False), (Change.Activity, False)],
+            [(change.entity, change.deleted) for change in changes])
+        self.assertEqual(str(day), changes[1].key)
+        self.assertEqual(str(self.lunch.id), changes[2].key)
+        self.assertEqual(changes[-1].id, self.storage.get_change_cursor(self.user_dale))
+
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = -1)], self.user_dale)
+        changes = self.storage.get_changes(changes[-1].id, 100, self.user_dale)
+        self.assertEqual([(Change.Sheet, str(day), True)],
+            [(change.entity, change.key, change.deleted) for change in changes])
+
+    def test_pruning_old_deletions_moves_the_horizon(self):
+        self._setup_activities()
+        self.storage.save_user(self.user_roger)
+        day = datetime.date(2013, 2, 4)
+        self.assertEqual(0, self.storage.get_change_horizon(self.user_dale))
+
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = self.work.id)], self.user_dale)
+        self.storage.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = -1)], self.user_dale)
+        deleted = self.storage.get_change_cursor(self.user_dale)
+
+        # Deletions made after the given time are kept
+        self.assertEqual(0, self.storage.prune_changes(time.time() - 60))
+        self.assertEqual(1, self.storage.prune_changes(time.time() + 1))
+
+        # The cursor never goes back, even when the latest change was removed
+        self.assertEqual(deleted, self.storage.get_change_horizon(self.user_dale))
+        self.assertEqual(deleted, self.storage.get_change_cursor(self.user_dale))
+        self.assertEqual(0, self.storage.get_change_horizon(self.user_roger))
+        self.assertNotIn(Change.Sheet, [change.entity for change in self.storage.get_changes(0, 100, self.user_dale)])
+
+    ## Daily totals
+
+    def test_daily_totals_follow_sheet_changes(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+        self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.work.id) for i in range(8)], self.user_dale)
+        self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.lunch.id) for i in range(2)] +
+            [Quarter(offset = 7, activity_id = -1)], self.user_dale)
+
+        totals = self.storage.get_daily_totals(day, day, self.user_dale)
+
+        self.assertEqual({day: {self.work.id: 5, self.lunch.id: 2}}, totals)
+        self.assertEqual({self.work.id: 5, self.lunch.id: 2},
+            self.storage.get_activity_totals(day, day + datetime.timedelta(days=6), self.user_dale))
+        self.assertEqual(7, self.storage.quarter_count())
+
+    def test_deleting_activity_removes_its_quarters(self):
+        self._setup_activities()
+        day = datetime.date(2013, 2, 4)
+        self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.work.id) for i in range(4)] +
+            [Quarter(offset = 4, activity_id = self.lunch.id)], self.user_dale)
+
+        self.assertTrue(self.storage.delete_activity(self.work, self.user_dale))
+
+        self.assertEqual({day: {self.lunch.id: 1}}, self.storage.get_daily_totals(day, day, self.user_dale))
+        self.assertEqual(1, len(self.storage.get_timesheet(day, self.user_dale).quarters))
+
+    def test_deleting_activity_by_string_id(self):
+        self._setup_activities()
+        day = datetime.date(2013, 3, 4)
+        self.storage.add_quarters_to_sheet(day,
+            [Quarter(offset = i, activity_id = self.work.id) for i in range(2)], self.user_dale)
+
+        # As given in the URL of DELETE /api/activity/<id>
+        self.assertTrue(self.storage.delete_activity(Activity(id = str(self.work.id)), self.user_dale))
+
+        self.assertEqual([], self.storage.get_timesheet(day, self.user_dale).quarters)
+        self.assertEqual({}, self.storage.get_daily_totals(day, day, self.user_dale))
+
+    ## Outbox
+
+    def test_outbox(self):
+        now = time.time()
+        first = self.storage.queue_mail("dale@example.com", "Subject: One")
+        self.storage.queue_mail("roger@example.com", "Subject: Two")
+
+        mails = self.storage.claim_mail(now, 300, 10)
+        self.assertEqual(["dale@example.com", "roger@example.com"], [mail.recipient for mail in mails])
+        # Claimed mails are not returned again until the lease has passed
+        self.assertEqual([], self.storage.claim_mail(now, 300, 10))
+        self.assertEqual(2, len(self.storage.claim_mail(now + 301, 300, 10)))
+
+        self.storage.mail_sent(first)
+        self.storage.mail_failed(mails[1].id, now + 60, "Connection refused")
+        self.assertEqual({"queued": 1, "retrying": 1, "failed": 0, "oldest": 10},
+            self.storage.mail_queue_stats(self.storage.query("SELECT created FROM outbox;")[0].created + 10))
+        self.assertEqual(1, self.storage.claim_mail(now + 60, 300, 10)[0].attempts)
+
+        self.storage.mail_failed(mails[1].id, None, "Connection refused")
+        self.assertEqual([], self.storage.claim_mail(now + 3600, 300, 10))
+        self.assertEqual({"queued": 0, "retrying": 0, "failed": 1, "oldest": 0}, self.storage.mail_queue_stats(now))
+
+
+class TestSharedStorage(unittest.TestCase):
+    """
+    Test the default storage when several processes use the same database file
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        file_name = os.path.join(self.directory, "quarterapp.db")
+        self.first = DefaultStorage(file_name, single_process = False)
+        self.second = DefaultStorage(file_name, single_process = False)
+        self.user = User("dale@example.com")
+        self.first.save_user(self.user)
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_uses_wal(self):
+        self.assertEqual("wal", self.first.query("PRAGMA journal_mode;")[0].journal_mode)
+
+    def test_enforces_foreign_keys_on_existing_database(self):
+        # The second storage opened the database file created by the first
+        self.assertEqual(1, self.second.query("PRAGMA foreign_keys;")[0].foreign_keys)
+
+    def test_sees_writes_of_other_process(self):
+        day = datetime.date(2013, 2, 4)
+        category = Category("Work")
+        self.first.save_category(category, self.user)
+        activity = Activity(title = "Dev", color = Color("#fcaf3e"))
+        self.first.save_activity(activity, category, self.user)
+
+        self.assertEqual([], self.second.get_timesheet(day, self.user).quarters)
+        version = self.second.get_data_version(self.user)
+        self.assertEqual(1, self.second.activity_count(self.user))
+
+        self.first.add_quarters_to_sheet(day, [Quarter(offset = 1, activity_id = activity.id)], self.user)
+        self.first.save_activity(Activity(title = "Lunch", color = Color("#3465a4")), category, self.user)
+
+        self.assertEqual(1, len(self.second.get_timesheet(day, self.user).quarters))
+        self.assertNotEqual(version, self.second.get_data_version(self.user))
+        self.assertEqual(2, self.second.activity_count(self.user))
+
+    def test_retries_when_locked(self):
+        attempts = []
+        def locked():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise sqlite3.OperationalError("database is locked")
+            return True
+
+        self.assertTrue(self.first._retry_when_busy(locked))
+        self.assertEqual(3, len(attempts))
+
+
+class TestGroupCommit(unittest.TestCase):
+    """
+    Test that concurrent writes to a database file are committed together
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = DefaultStorage(os.path.join(self.directory, "quarterapp.db"))
+        self.user = User("dale@example.com")
+        self.storage.save_user(self.user)
+
+    def tearDown(self):
+        self.storage.close()
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_concurrent_writes(self):
+        categories = [Category("Category %d" % i) for i in range(20)]
+        threads = [threading.Thread(target = self.storage.save_category, args = (category, self.user))
+            for category in categories]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(20, len(set(category.id for category in categories)))
+        self.assertEqual(20, self.storage.category_count(self.user))
+
+    def test_failing_write_is_isolated(self):
+        results = []
+        def save_users():
+            # Breaks the unique constraint on the username
+            results.append(self.storage.save_user(User("dale@example.com")))
+        threads = [threading.Thread(target = save_users)] + [threading.Thread(target = self.storage.save_category,
+            args = (Category("Category %d" % i), self.user)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([False], results)
+        self.assertEqual(5, self.storage.category_count(self.user))
+
+    def test_group_restores_isolation_level(self):
+        self.storage._run_group([])
+        self.assertEqual("IMMEDIATE", self.storage.conn.isolation_level)
+
+    def test_raising_transaction_is_rolled_back(self):
+        def failing(storage):
+            storage.save_category(Category("Work"), self.user)
+            raise ValueError("Fail")
+
+        self.assertRaises(ValueError, self.storage.run_in_transaction, failing)
+        self.assertEqual(0, self.storage.category_count(self.user))
+        self.storage.save_category(Category("Home"), self.user)
+        self.assertEqual(1, self.storage.category_count(self.user))
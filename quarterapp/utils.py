@@ -129,12 +129,22 @@ def extract_date(date):
 def summarize_quarters(quarters, activity_dict):
     # Convert the list of quarters to a list of only activity_id
     quarter_values = map(lambda q: q.activity_id, quarters)
+    return summarize_activity_counts(Counter(quarter_values), activity_dict)
+
+
+def summarize_activity_counts(counts, activity_dict):
+    """
+    Summarize the hours spent per activity from already counted quarters
+
+    @param counts Dictionary with the number of quarters keyed on activity id
+    @param activity_dict Dictionary with the activities keyed on id
+    @return A tuple with the list of summarized activities and the total hours
+    """
     summary_list = []
-    summary_dict = Counter(quarter_values)
     summary_total = 0
 
-    for activity_id in summary_dict:
-        if activity_id == -1:
+    for activity_id in sorted(counts):
+        if activity_id == -1 or counts[activity_id] <= 0:
             continue
 
         activity_color = "#ccc"
@@ -144,13 +154,22 @@ def summarize_quarters(quarters, activity_dict):
             activity_color = activity_dict[long(activity_id)].color.hex()
             activity_title = activity_dict[long(activity_id)].title
 
-        activity_summary = float(summary_dict[activity_id] / 4.0)
+        activity_summary = float(counts[activity_id] / 4.0)
         summary_total += activity_summary
         summary_list.append({"id": activity_id, "color": activity_color,
                              "title": activity_title, "sum": "%.2f" % activity_summary})
     return summary_list, "%.2f" % summary_total
 
 
+def session_id():
+    """
+    Generate and return a random session id that is safe to use in a cookie
+
+    @return The session id
+    """
+    return base64.urlsafe_b64encode(os.urandom(15))
+
+
 def activation_code():
     """
     Generate and return a URL friendly activation code